@@ -0,0 +1,77 @@
+"""Время запуска и память client .py: импорт, телеметрия устройства и безголовый сценарий.
+
+Каждый замер - отдельный процесс python, поэтому кэш модулей не влияет на результат.
+Сценарий выполняется против CarlaServer с fake_carla. Сравнить со старой версией:
+    git show HEAD~1:"client .py" > /tmp/client_old.py
+    python benchmarks/bench_client_startup.py --client /tmp/client_old.py
+Запуск: python benchmarks/bench_client_startup.py --repeat 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from common import ROOT, percentile, start_server_process
+
+# Выполняется в дочернем процессе: argv = путь к клиенту, замер, порт
+CHILD = r"""
+import importlib.util, io, json, os, sys, time
+started = time.perf_counter()
+sys.path.insert(0, sys.argv[4])
+spec = importlib.util.spec_from_file_location("carla_client", sys.argv[1])
+client = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(client)
+result = {"import_ms": (time.perf_counter() - started) * 1000}
+stdout, sys.stdout = sys.stdout, io.StringIO()
+if sys.argv[2] == "device":
+    client.DeviceTelemetry().next_update()
+elif sys.argv[2] == "session":
+    session = client.CarlaClient("127.0.0.1", int(sys.argv[3]), headless=True)
+    session.connect(["spawn 5", "subscribe 10", "wait 0.5", "info"], device_info=False, linger=0.2)
+result["total_ms"] = (time.perf_counter() - started) * 1000
+try:
+    import resource
+    result["rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+except ImportError:
+    result["rss_mb"] = float("nan")
+result["modules"] = len(sys.modules)
+stdout.write(json.dumps(result) + "\n")  # поток приёма клиента ещё может печатать в подменённый stdout
+"""
+
+
+def measure(client, scenario, port, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", CHILD, client, scenario, str(port), ROOT],
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {name: percentile([run[name] for run in runs], 50) for name in runs[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--client", default=os.path.join(ROOT, "client .py"), help="какой файл клиента мерить")
+    parser.add_argument("--repeat", type=int, default=5, help="процессов на замер (берётся медиана)")
+    parser.add_argument("--scenarios", nargs="+", default=["import", "device", "session"],
+                        choices=["import", "device", "session"])
+    args = parser.parse_args()
+
+    process, port = start_server_process(fake_options={"rpc_latency": 0}) if "session" in args.scenarios else (None, 0)
+    try:
+        print(f"Клиент: {args.client}, медиана {args.repeat} процессов")
+        for scenario in args.scenarios:
+            try:
+                result = measure(args.client, scenario, port, args.repeat)
+            except subprocess.CalledProcessError as e:
+                print(f"{scenario:>8}: не поддерживается ({e.stderr.strip().splitlines()[-1]})")
+                continue
+            print(f"{scenario:>8}: импорт {result['import_ms']:.0f} мс, всего {result['total_ms']:.0f} мс, "
+                  f"пик RSS {result['rss_mb']:.1f} МБ, модулей {result['modules']:.0f}")
+    finally:
+        if process is not None:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
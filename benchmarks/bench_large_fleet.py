@@ -0,0 +1,82 @@
+"""Режим большого парка: FPS синхронного тика и число машин с полной физикой.
+
+Сервер тикает без пауз (шаг --fixed-delta-ms), одна машина под ручным управлением -
+вокруг неё режим большого парка держит полную физику. fake_carla считает шаг по числу
+машин с физикой (--physics-us) и без неё (--kinematic-us), так что цифры показывают, во
+сколько раз меньше физики считает симулятор, а не FPS настоящей CARLA.
+Запуск: python benchmarks/bench_large_fleet.py --vehicles 200 500 1000 2000
+"""
+import argparse
+import os
+import sys
+import time
+
+from common import load_server_module
+
+
+class NullConnection:
+    queue = None
+
+    def send(self, data, kind=None):
+        return True
+
+    def close(self):
+        pass
+
+
+def run(module, vehicles, large_fleet, duration, fixed_delta, radius):
+    server = module.CarlaServer("127.0.0.1", 0, pool_size=0, quiet=True, fleet_options={"radius": radius, "interval": 0.2})
+    server.register_client("bench", NullConnection())
+    spawned = 0
+    while spawned < vehicles:
+        count = server.spawn_vehicles("bench", vehicles - spawned)
+        if not count:
+            break
+        spawned += count
+    focus = next(iter(server.client_vehicles["bench"]))
+    server.apply_vehicle_control("bench", focus, 0.5, 0.0, 0.0, False, False)
+    time.sleep(0.3)  # управление применено, в кэше тика есть положения машин
+    if large_fleet:
+        server.fleet.enable()
+    coordinator = server.tick_coordinator
+    coordinator.fixed_delta = fixed_delta
+    coordinator.enable()
+    time.sleep(0.5)
+    first, started = coordinator.tick_id, time.perf_counter()
+    time.sleep(duration)
+    ticks, elapsed = coordinator.tick_id - first, time.perf_counter() - started
+    stats = dict(server.fleet.stats)
+    coordinator.disable()
+    server.fleet.disable()
+    actors = server.shards[0].snapshot_cache.actor_count()
+    detail = stats["detail"] + 1 if large_fleet else spawned  # ручная машина всегда с физикой
+    return ticks / elapsed, spawned, actors, detail
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vehicles", type=int, nargs="+", default=[200, 500, 1000, 2000])
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--fixed-delta-ms", type=float, default=1.0, help="шаг синхронного режима; меньше - тик без пауз")
+    parser.add_argument("--radius", type=float, default=70.0, help="радиус полной физики, м")
+    parser.add_argument("--physics-us", type=float, default=40.0, help="стоимость шага машины с физикой в fake_carla")
+    parser.add_argument("--kinematic-us", type=float, default=4.0, help="стоимость шага машины гибридного режима")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    module = load_server_module(rpc_latency=0, spawn_points=max(args.vehicles) + 100,
+                                physics_cost=args.physics_us / 1e6, kinematic_cost=args.kinematic_us / 1e6)
+    for vehicles in args.vehicles:
+        results = {}
+        for large_fleet in (False, True):
+            sys.stdout = open(os.devnull, "w")
+            results[large_fleet] = run(module, vehicles, large_fleet, args.duration, args.fixed_delta_ms / 1000.0, args.radius)
+        sys.stdout = stdout
+        for large_fleet, (fps, spawned, actors, detail) in results.items():
+            print(f"{'большой парк' if large_fleet else 'обычный':>12}: машин {spawned}, акторов {actors}, "
+                  f"с полной физикой {detail}, FPS {fps:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Микробенчмарк протокола: сообщений в секунду и байт на сообщение.
+
+Сравнивает старый разбор (str + split по 1 КБ), JSON-строки через MessageDecoder
+и кадры с длиной (JSON и msgpack). Запуск: python benchmarks/bench_protocol.py
+"""
+import argparse
+import json
+import time
+
+import common  # noqa: F401  (добавляет корень репозитория в sys.path)
+import protocol
+
+
+def vehicle_info(count):
+    return {"action": "vehicle_info", "vehicles": [
+        {"id": 100 + i, "speed": 8.25, "location": {"x": 1234.56 + i, "y": -87.65 - i}, "control_mode": "autopilot"}
+        for i in range(count)]}
+
+
+def legacy_decode(stream, chunk_size=1024):
+    """Разбор как в исходном handle_client: decode каждого чанка и split буфера-строки"""
+    messages = 0
+    buffer = ""
+    for offset in range(0, len(stream), chunk_size):
+        buffer += stream[offset:offset + chunk_size].decode()
+        while "\n" in buffer:
+            json_obj, buffer = buffer.split("\n", 1)
+            json.loads(json_obj)
+            messages += 1
+    return messages
+
+
+def decoder_decode(stream, framed, chunk_size=65536):
+    decoder = protocol.MessageDecoder()
+    if framed:
+        decoder.switch_to_framed()
+    messages = 0
+    for offset in range(0, len(stream), chunk_size):
+        decoder.feed(stream[offset:offset + chunk_size])
+        for _ in decoder:
+            messages += 1
+    return messages
+
+
+def measure(name, encode, decode, message, repeat):
+    started = time.perf_counter()
+    encoded = [encode(message) for _ in range(repeat)]
+    encode_time = time.perf_counter() - started
+    stream = b"".join(encoded)
+    started = time.perf_counter()
+    decoded = decode(stream)
+    decode_time = time.perf_counter() - started
+    assert decoded == repeat, (name, decoded)
+    return name, repeat / encode_time, repeat / decode_time, len(stream) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--vehicles", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    cases = [
+        ("json-lines legacy", lambda m: protocol.encode_message(m), legacy_decode),
+        ("json-lines decoder", lambda m: protocol.encode_message(m), lambda s: decoder_decode(s, False)),
+        ("framed json", lambda m: protocol.encode_message(m, protocol.CODEC_JSON), lambda s: decoder_decode(s, True)),
+    ]
+    if protocol.msgpack is not None:
+        cases.append(("framed msgpack", lambda m: protocol.encode_message(m, protocol.CODEC_MSGPACK),
+                      lambda s: decoder_decode(s, True)))
+    else:
+        print("⚠️ msgpack не установлен, кадры msgpack пропущены")
+
+    header = f"{'vehicles':>8}  {'encoding':<20}{'enc msg/s':>12}{'dec msg/s':>12}{'bytes/msg':>11}"
+    print(header)
+    print("-" * len(header))
+    for count in args.vehicles:
+        message = vehicle_info(count)
+        repeat = max(20, args.messages // max(1, count // 10))
+        for name, encode, decode in cases:
+            _, enc_rate, dec_rate, size = measure(name, encode, decode, message, repeat)
+            print(f"{count:>8}  {name:<20}{enc_rate:>12.0f}{dec_rate:>12.0f}{size:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Стоимость записи телеметрии и скорость воспроизведения на 10k машинах.
+
+Сервер с fake_carla работает в этом же процессе. Для каждого тика измеряется
+построение кэша снимка (общее с vehicle_info) и отдельно сама запись в колонки;
+затем запись читается обратно: сырые тики, сообщения vehicle_info и их кодирование.
+Запуск: python benchmarks/bench_recorder.py --vehicles 10000 --ticks 100
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from common import load_server_module, percentile
+import protocol
+import recorder
+
+
+def record(server, ticks):
+    """Возвращает ([мс построения снимка], [мс записи тика])"""
+    cache = server.shards[0].snapshot_cache
+    refresh_ms, capture_ms = [], []
+    cache.ticked.clear()
+    while len(capture_ms) < ticks:
+        cache.ticked.wait()
+        cache.ticked.clear()
+        started = time.perf_counter()
+        cache.refresh()
+        refreshed = time.perf_counter()
+        server.recorder.capture()
+        refresh_ms.append((refreshed - started) * 1000)
+        capture_ms.append((time.perf_counter() - refreshed) * 1000)
+    return refresh_ms, capture_ms
+
+
+def replay(path, codec):
+    """Пропускная способность чтения: (тиков, машин, с на чтение, с на сообщения, с на кодирование)"""
+    reader = recorder.TelemetryReader(path)
+    started = time.perf_counter()
+    ticks = vehicles = 0
+    for _, _, columns in reader.ticks():
+        ticks += 1
+        vehicles += len(columns["tick"])
+    read_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    messages = [{"action": "vehicle_info", "subscription": True, "full": True, "replay": {"tick": tick, "time": timestamp},
+                 "vehicles": recorder.replay_vehicles(columns, reader.modes), "removed": []}
+                for tick, timestamp, columns in reader.ticks()]
+    format_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    size = sum(len(protocol.encode_message(message, codec)) for message in messages)
+    encode_time = time.perf_counter() - started
+    return ticks, vehicles, read_time, format_time, encode_time, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vehicles", type=int, default=10000)
+    parser.add_argument("--ticks", type=int, default=100)
+    parser.add_argument("--tick-ms", type=float, default=100.0, help="шаг fake_carla (должен покрывать построение снимка)")
+    parser.add_argument("--chunk-rows", type=int, default=1 << 18)
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    module = load_server_module(rpc_latency=0, spawn_points=args.vehicles, tick_seconds=args.tick_ms / 1000.0)
+    server = module.CarlaServer("127.0.0.1", 0, quiet=True)
+    server.client_vehicles["bench"] = {}
+    spawned = server.spawn_vehicles("bench", args.vehicles)
+    sys.stdout = stdout
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, "bench")
+        server.recorder.writer = recorder.TelemetryWriter(path, args.chunk_rows)
+        refresh_ms, capture_ms = record(server, args.ticks)
+        server.recorder.writer.close()
+        # Чанки выделяются заранее разреженными файлами, считаем реально занятые блоки
+        disk = sum(os.stat(os.path.join(directory, name)).st_blocks * 512
+                   for directory, _, names in os.walk(path) for name in names)
+
+        print(f"Машин: {spawned}, тиков: {args.ticks}, на диске {disk / 1024 / 1024:.1f} МБ "
+              f"({disk / max(1, spawned * args.ticks):.0f} байт на машину-тик)")
+        print(f"Снимок тика (общий с vehicle_info): p50 {percentile(refresh_ms, 50):.2f} мс, p99 {percentile(refresh_ms, 99):.2f} мс")
+        print(f"Запись тика: p50 {percentile(capture_ms, 50):.2f} мс, p99 {percentile(capture_ms, 99):.2f} мс")
+
+        codec = protocol.CODEC_MSGPACK if protocol.msgpack is not None else protocol.CODEC_JSON
+        ticks, vehicles, read_time, format_time, encode_time, size = replay(path, codec)
+        print(f"Чтение: {ticks / read_time:.0f} тиков/с, {vehicles / read_time / 1e6:.1f} млн машин/с")
+        print(f"Сообщения vehicle_info: {ticks / format_time:.1f} тиков/с, {vehicles / format_time:.0f} машин/с")
+        print(f"Кодирование ({'msgpack' if codec == protocol.CODEC_MSGPACK else 'json'}): "
+              f"{ticks / encode_time:.1f} тиков/с, {size / ticks / 1024:.0f} КБ на тик")
+
+
+if __name__ == "__main__":
+    main()
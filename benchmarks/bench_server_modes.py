@@ -0,0 +1,98 @@
+"""Сравнение серверов threaded и async: число удерживаемых клиентов и задержка команд.
+
+Запуск: python benchmarks/bench_server_modes.py --clients 100 500 1000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import psutil
+
+from common import percentile, raise_fd_limit, start_server_process
+
+
+async def open_clients(port, count, timeout):
+    connections = []
+
+    async def open_one():
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", port), timeout)
+            connections.append((reader, writer))
+        except (OSError, asyncio.TimeoutError):
+            pass
+
+    started = time.perf_counter()
+    await asyncio.gather(*(open_one() for _ in range(count)))
+    return connections, time.perf_counter() - started
+
+
+async def request(reader, writer, command, reply_action, timeout):
+    started = time.perf_counter()
+    writer.write((json.dumps(command) + "\n").encode())
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if not line:
+            raise ConnectionError("closed")
+        if json.loads(line).get("action") == reply_action:
+            return time.perf_counter() - started
+
+
+async def run_case(mode, clients, requests, vehicles, timeout, rpc_latency):
+    process, port = start_server_process({"mode": mode}, {"rpc_latency": rpc_latency, "spawn_points": 10 ** 5})
+    server_proc = psutil.Process(process.pid)
+    try:
+        connections, connect_time = await open_clients(port, clients, timeout)
+
+        async def session(reader, writer):
+            await request(reader, writer, {"action": "request_spawn", "num_vehicles": vehicles}, "spawn_vehicles", timeout)
+            latencies = []
+            for _ in range(requests):
+                latencies.append(await request(reader, writer, {"action": "get_vehicle_info"}, "vehicle_info", timeout))
+            return latencies
+
+        results = await asyncio.gather(*(session(r, w) for r, w in connections), return_exceptions=True)
+        latencies = [lat for res in results if isinstance(res, list) for lat in res]
+        served = sum(1 for res in results if isinstance(res, list))
+        stats = {
+            "mode": mode,
+            "clients": clients,
+            "connected": len(connections),
+            "served": served,
+            "connect_s": connect_time,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "threads": server_proc.num_threads(),
+            "rss_mb": server_proc.memory_info().rss / 1024 ** 2,
+        }
+        for _, writer in connections:
+            writer.close()
+        return stats
+    finally:
+        process.kill()
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--requests", type=int, default=5, help="get_vehicle_info на клиента")
+    parser.add_argument("--vehicles", type=int, default=2, help="машин на клиента")
+    parser.add_argument("--rpc-latency-ms", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    header = f"{'mode':<9}{'clients':>8}{'conn':>7}{'served':>8}{'conn s':>8}{'p50 ms':>9}{'p99 ms':>9}{'threads':>9}{'RSS MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for clients in args.clients:
+        for mode in ("threaded", "async"):
+            s = asyncio.run(run_case(mode, clients, args.requests, args.vehicles, args.timeout,
+                                     args.rpc_latency_ms / 1000.0))
+            print(f"{s['mode']:<9}{s['clients']:>8}{s['connected']:>7}{s['served']:>8}{s['connect_s']:>8.2f}"
+                  f"{s['p50_ms']:>9.2f}{s['p99_ms']:>9.2f}{s['threads']:>9}{s['rss_mb']:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
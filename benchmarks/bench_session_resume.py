@@ -0,0 +1,123 @@
+"""Обрыв сети у всех клиентов сразу: возобновление сессии по токену против повторного спавна.
+
+Клиенты подключаются, получают машины, затем сервер обрывает все соединения (как при
+сбое коммутатора). С токеном клиент подключается заново и шлёт resume_session; без
+возобновления (--session-grace 0) его машины уничтожаются, и он просит их снова.
+Сравниваются время до возврата парка, число уничтоженных и заново созданных машин.
+Запуск: python benchmarks/bench_session_resume.py --clients 20 --vehicles 50
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+from common import load_server_module, percentile
+import protocol
+
+
+def wait_for(sock, decoder, action):
+    """Читает сообщения до action, возвращает его и всё прочитанное по пути"""
+    seen = []
+    while True:
+        decoder.recv_from(sock)
+        for message in decoder:
+            seen.append(message)
+            if message.get("action") == action:
+                return message, seen
+
+
+def connect(port, vehicles):
+    sock = socket.create_connection(("127.0.0.1", port))
+    decoder = protocol.MessageDecoder()
+    sock.sendall(protocol.encode_message({"action": "request_spawn", "num_vehicles": vehicles}, None))
+    _, seen = wait_for(sock, decoder, "spawn_vehicles")
+    token = next((message["token"] for message in seen if message.get("action") == "session"), None)
+    return sock, token
+
+
+def come_back(port, token, vehicles, latencies, sockets):
+    """Переподключение после обрыва: возобновление по токену или новый спавн"""
+    started = time.perf_counter()
+    sock = socket.create_connection(("127.0.0.1", port))
+    decoder = protocol.MessageDecoder()
+    if token is not None:
+        sock.sendall(protocol.encode_message({"action": "resume_session", "token": token}, None))
+        message, _ = wait_for(sock, decoder, "session_resumed")
+        assert len(message["vehicles"]) == vehicles
+    else:
+        sock.sendall(protocol.encode_message({"action": "request_spawn", "num_vehicles": vehicles}, None))
+        wait_for(sock, decoder, "spawn_vehicles")
+    latencies.append((time.perf_counter() - started) * 1000)
+    sockets.append(sock)
+
+
+def wait_for_teardown(server, timeout=30.0):
+    """Отключение оборванных сессий идёт в фоне: ждём, пока каждое запланированное завершится или будет отменено"""
+    teardown = server.teardown
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with teardown.cond:
+            stats = teardown.stats
+            if not teardown.destroy_queue and stats["completed"] + stats["cancelled"] >= stats["scheduled"]:
+                return
+        time.sleep(0.01)
+    raise TimeoutError("отключение клиентов не завершилось")
+
+
+def run(module, session_grace, clients, vehicles):
+    server = module.CarlaServer("127.0.0.1", 0, pool_size=0, session_grace=session_grace, quiet=True,
+                                admission_options={"interval": 0.01})
+    server.teardown.grace_period = 0.2
+    port = server.server_socket.getsockname()[1]
+    threading.Thread(target=server.start, daemon=True).start()
+    sessions = [connect(port, vehicles) for _ in range(clients)]
+    spawned = server.vehicle_pool.stats["spawned"]
+
+    started = time.perf_counter()
+    for connection in server.clients.values():
+        connection.abort()  # сбой сети: сервер видит разрыв всех соединений
+    latencies, sockets = [], []
+    threads = [threading.Thread(target=come_back, args=(port, token, vehicles, latencies, sockets))
+               for _, token in sessions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = (time.perf_counter() - started) * 1000
+    # Машины оборванных сессий уничтожаются по истечении grace period - считаем после этого
+    wait_for_teardown(server)
+    destroyed = server.teardown.stats["destroyed"]
+    respawned = server.vehicle_pool.stats["spawned"] - spawned
+    for sock in sockets:
+        sock.sendall(protocol.encode_message({"action": "disconnect"}, None))
+        sock.close()
+    for sock, _ in sessions:
+        sock.close()
+    server.cleanup_all()
+    return latencies, elapsed, destroyed, respawned
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--vehicles", type=int, default=50, help="машин у каждого клиента")
+    parser.add_argument("--rpc-latency-ms", type=float, default=2.0, help="задержка одного RPC fake_carla")
+    parser.add_argument("--session-grace", type=float, default=30.0, help="ожидание возобновления сессии на сервере, с")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    module = load_server_module(rpc_latency=args.rpc_latency_ms / 1000.0, spawn_points=2 * args.clients * args.vehicles + 100)
+    for session_grace in dict.fromkeys((0.0, args.session_grace)):  # --session-grace 0 - только повторный спавн
+        sys.stdout = open(os.devnull, "w")
+        latencies, elapsed, destroyed, respawned = run(module, session_grace, args.clients, args.vehicles)
+        sys.stdout = stdout
+        print(f"{'возобновление' if session_grace else 'повторный спавн':>15}: {args.clients} клиентов по {args.vehicles} машин "
+              f"вернули парк за p50 {percentile(latencies, 50):.1f} мс, max {max(latencies):.1f} мс (все - {elapsed:.0f} мс); "
+              f"уничтожено машин {destroyed}, создано заново {respawned}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Телеметрия подписки: TCP loopback против кольца разделяемой памяти.
+
+Клиент - отдельный процесс на том же хосте, подписан на все свои машины без порогов
+(каждое обновление - полное состояние). Через TCP он принимает кадры, декодирует их и
+собирает массив координат; через разделяемую память берёт последний слот и читает
+координаты прямо из него. Сравниваются CPU клиента и сервера на обновление, байты в
+сокете и задержка от публикации до чтения (для разделяемой памяти).
+Запуск: python benchmarks/bench_shm_telemetry.py --vehicles 1000 10000 --rate 30
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from common import ROOT, load_server_module, percentile
+
+# Выполняется в процессе клиента: argv = порт, транспорт, длительность, частота, ROOT
+CHILD = r"""
+import json, socket, sys, time
+sys.path.insert(0, sys.argv[5])
+import numpy as np, protocol
+port, transport, duration, rate = int(sys.argv[1]), sys.argv[2], float(sys.argv[3]), float(sys.argv[4])
+sock = socket.create_connection(("127.0.0.1", port))
+decoder = protocol.MessageDecoder()
+codec = None
+sock.sendall(protocol.encode_message({"action": "negotiate_protocol", "framing": protocol.FRAMING,
+                                      "codecs": protocol.supported_codecs()}, None))
+while codec is None:
+    decoder.recv_from(sock)
+    for message in decoder:
+        if message.get("action") == "protocol":
+            decoder.switch_to_framed()
+            codec = protocol.CODEC_NAMES[message["codec"]]
+            break
+print("ready", flush=True)
+sys.stdin.readline()
+command = {"action": "subscribe_vehicle_info", "rate": rate, "threshold": 0, "speed_threshold": 0}
+if transport == "shm":
+    import shared_ring
+    command["transport"] = "shm"
+sock.sendall(protocol.encode_message(command, codec))
+ring, updates, received, latencies, checksum = None, 0, 0, [], 0.0
+started = time.perf_counter()
+cpu = time.process_time()
+while time.perf_counter() - started < duration:
+    if ring is not None:
+        latest = ring.latest()
+        if latest is None:
+            time.sleep(0.0005)
+            continue
+        seq, published, _, records = latest
+        checksum += float(records["x"].sum())  # координаты читаются прямо из разделяемой памяти
+        latencies.append((time.monotonic_ns() - published) / 1e6)
+        updates += 1
+        continue
+    sock.settimeout(0.05)
+    try:
+        count = decoder.recv_from(sock)
+    except socket.timeout:
+        continue
+    received += count
+    for message in decoder:
+        if message.get("action") == "shm_telemetry":
+            ring = shared_ring.RingReader(message["name"])
+        elif message.get("action") == "vehicle_info":
+            vehicles = message["vehicles"]
+            x = np.fromiter((v["location"]["x"] for v in vehicles), dtype=np.float64, count=len(vehicles))
+            checksum += float(x.sum())
+            updates += 1
+cpu = time.process_time() - cpu
+if ring is not None:
+    latest = records = None  # представления держат отображение сегмента
+    ring.close()
+print(json.dumps({"updates": updates, "cpu_ms": cpu * 1000 / max(1, updates), "bytes": received / max(1, updates),
+                  "latency_ms": sorted(latencies)[len(latencies) // 2] if latencies else None}), flush=True)
+"""
+
+
+def run(module, vehicles, transport, duration, rate):
+    server = module.CarlaServer("127.0.0.1", 0, pool_size=0, quiet=True)
+    threading.Thread(target=server.start, daemon=True).start()
+    port = server.server_socket.getsockname()[1]
+    push_times = []
+    push = server.push_vehicle_updates
+
+    def timed_push(client_id, sub):
+        started = time.perf_counter()
+        push(client_id, sub)
+        push_times.append((time.perf_counter() - started) * 1000)
+
+    server.push_vehicle_updates = timed_push
+    child = subprocess.Popen([sys.executable, "-c", CHILD, str(port), transport, str(duration), str(rate), ROOT],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        child.stdout.readline()
+        client_id = next(iter(server.clients))
+        spawned = 0
+        while spawned < vehicles:
+            count = server.spawn_vehicles(client_id, vehicles - spawned)
+            if not count:
+                break
+            spawned += count
+        time.sleep(0.2)  # положения машин в кэше тика
+        child.stdin.write("go\n")
+        child.stdin.flush()
+        result = json.loads(child.stdout.readline())
+        child.wait()
+        server.cleanup_all()
+    finally:
+        if child.poll() is None:
+            child.kill()
+        # Отключение клиента сессия ждёт session_grace, а очистка идёт в фоне: закрываем и удаляем
+        # сегменты (RingWriter.close - close() и unlink()) сразу, иначе resource_tracker сообщит об утечке
+        for client_id in server.subscriptions.keys():
+            server.drop_subscription(client_id)
+    result["server_ms"] = percentile(push_times, 50)
+    return spawned, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vehicles", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--rate", type=float, default=30.0, help="частота подписки, Гц")
+    parser.add_argument("--duration", type=float, default=3.0)
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    module = load_server_module(rpc_latency=0, spawn_points=max(args.vehicles) + 100)
+    for vehicles in args.vehicles:
+        for transport in ("tcp", "shm"):
+            sys.stdout = open(os.devnull, "w")
+            spawned, result = run(module, vehicles, transport, args.duration, args.rate)
+            sys.stdout = stdout
+            latency = f", задержка p50 {result['latency_ms']:.2f} мс" if result["latency_ms"] is not None else ""
+            print(f"{'TCP' if transport == 'tcp' else 'shm':>3}, машин {spawned}: обновлений {result['updates'] / args.duration:.1f}/с, "
+                  f"CPU клиента {result['cpu_ms']:.2f} мс и сервера {result['server_ms']:.2f} мс на обновление, "
+                  f"в сокете {result['bytes'] / 1024:.1f} КБ на обновление{latency}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Конкурентный доступ к состоянию сервера: пропускная способность и конкуренция за блокировки.
+
+Потоки-клиенты добавляют, передают и удаляют машины, отдельный поток подключает и
+отключает клиентов, ещё один обходит таблицы как меню администратора. Сравнивается
+число потоков-клиентов на одной блокировке машин; ошибки обхода (изменение словаря
+во время итерации) считаются отдельно и должны быть нулевыми. CARLA не нужна: машины - заглушки.
+Запуск: python benchmarks/bench_state_locks.py --threads 1 8 32
+"""
+import argparse
+import itertools
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+from common import load_server_module
+
+
+class NullConnection:
+    queue = None
+
+    def send(self, data, kind=None):
+        return True
+
+    def close(self):
+        pass
+
+
+def run(module, threads, duration, batch, pause):
+    server = module.CarlaServer("127.0.0.1", 0, quiet=True)
+    shard = SimpleNamespace(vehicle_id=lambda actor_id: actor_id, tm_port=8000)
+    actor_ids = itertools.count(1)
+    clients = [f"client-{index}" for index in range(threads)]
+    for client_id in clients:
+        server.register_client(client_id, NullConnection())
+    stop = threading.Event()
+    counts = {"vehicle_ops": 0, "churn": 0, "scans": 0, "errors": 0}
+
+    def worker(index):
+        client_id, neighbour = clients[index], clients[(index + 1) % len(clients)]
+        ops = 0
+        while not stop.is_set():
+            records = [module.VehicleRecord(SimpleNamespace(id=next(actor_ids)), shard, client_id) for _ in range(batch)]
+            server.register_vehicles(client_id, records)
+            server.transfer_vehicle(records[0].id, neighbour)
+            for record in records[1:]:
+                server.detach_vehicle(record.id)
+            server.send_message(client_id, {"action": "vehicle_info", "vehicles": []})
+            ops += batch + 1
+            if pause:
+                time.sleep(pause)  # поток клиента ждёт следующую команду из сокета
+        counts["vehicle_ops"] += ops
+
+    def churn():
+        for number in itertools.count():
+            if stop.is_set():
+                break
+            client_id = f"churn-{number}"
+            server.register_client(client_id, NullConnection())
+            server.register_vehicles(client_id, [module.VehicleRecord(SimpleNamespace(id=next(actor_ids)), shard, client_id)])
+            server.finish_client_teardown(client_id)
+            counts["churn"] += 1
+            if pause:
+                time.sleep(pause)
+
+    def scanner():
+        while not stop.is_set():
+            try:
+                for client_id in server.clients:  # как show_clients и cleanup_all
+                    server.client_vehicles.get(client_id)
+                sum(1 for _ in list(server.vehicle_index.values()))  # как show_vehicles
+            except RuntimeError:
+                counts["errors"] += 1
+            counts["scans"] += 1
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    workers += [threading.Thread(target=churn), threading.Thread(target=scanner)]
+    for thread in workers:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    return counts, server
+
+
+def report(stats):
+    acquired = max(1, stats["acquired"])
+    return (f"захватов {stats['acquired']}, с ожиданием {stats['contended'] / acquired:.2%}, "
+            f"ожидание ср. {stats['wait_ns'] / max(1, stats['contended']) / 1000:.1f} / макс. {stats['max_wait_ns'] / 1000:.0f} мкс, "
+            f"удержание ср. {stats['hold_ns'] / acquired / 1000:.2f} / макс. {stats['max_hold_ns'] / 1000:.0f} мкс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--duration", type=float, default=3.0)
+    parser.add_argument("--batch", type=int, default=10, help="машин за одну регистрацию")
+    parser.add_argument("--pause-ms", type=float, default=0.0,
+                        help="пауза потока между командами (ожидание сокета); 0 - все потоки без пауз")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    module = load_server_module(rpc_latency=0)
+    for threads in args.threads:
+        sys.stdout = open(os.devnull, "w")
+        counts, server = run(module, threads, args.duration, args.batch, args.pause_ms / 1000.0)
+        sys.stdout = stdout
+        print(f"Потоков: {threads}: операций с машинами {counts['vehicle_ops'] / args.duration:.0f}/с, "
+              f"подключений-отключений {counts['churn'] / args.duration:.0f}/с, обходов {counts['scans'] / args.duration:.0f}/с, "
+              f"ошибок обхода {counts['errors']}")
+        print(f"  машины: {report(server.vehicles_lock.summary())}")
+        print(f"  клиенты: {report(server.clients_lock.summary())}")
+
+
+if __name__ == "__main__":
+    main()
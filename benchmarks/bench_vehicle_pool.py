@@ -0,0 +1,72 @@
+"""Пул машин: задержка спавна при повторных сессиях клиентов с пулом и без него.
+
+Каждая сессия подключается, просит N машин, ждёт spawn_vehicles и отключается; после
+отсрочки удаления машины уходят в пул (или уничтожаются при --pool-size 0).
+Запуск: python benchmarks/bench_vehicle_pool.py --sessions 5 --vehicles 50 --pool-size 0 256
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+from common import load_server_module, percentile
+import protocol
+
+
+def session(port, vehicles):
+    sock = socket.create_connection(("127.0.0.1", port))
+    decoder = protocol.MessageDecoder()
+    started = time.perf_counter()
+    sock.sendall(protocol.encode_message({"action": "request_spawn", "num_vehicles": vehicles}, None))
+    while True:
+        decoder.recv_from(sock)
+        if any(message.get("action") == "spawn_vehicles" for message in decoder):
+            break
+    elapsed = time.perf_counter() - started
+    sock.sendall(protocol.encode_message({"action": "disconnect"}, None))
+    sock.close()
+    return elapsed
+
+
+def run(module, pool_size, sessions, vehicles, grace):
+    server = module.CarlaServer("127.0.0.1", 0, pool_size=pool_size, quiet=True, admission_options={"interval": 0.01})
+    server.teardown.grace_period = grace
+    port = server.server_socket.getsockname()[1]
+    threading.Thread(target=server.start, daemon=True).start()
+    latencies = []
+    for _ in range(sessions):
+        latencies.append(session(port, vehicles) * 1000)
+        time.sleep(grace + 0.3)  # отсрочка удаления и парковка
+    stats = dict(server.vehicle_pool.stats)
+    server.cleanup_all()
+    server.running = False
+    return latencies, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=5)
+    parser.add_argument("--vehicles", type=int, default=50)
+    parser.add_argument("--pool-size", type=int, nargs="+", default=[0, 256])
+    parser.add_argument("--rpc-latency-ms", type=float, default=2.0, help="задержка одного RPC fake_carla")
+    parser.add_argument("--grace", type=float, default=0.2, help="отсрочка удаления машин после отключения, с")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    module = load_server_module(rpc_latency=args.rpc_latency_ms / 1000.0, spawn_points=max(200, args.vehicles * 2))
+    for pool_size in args.pool_size:
+        sys.stdout = open(os.devnull, "w")
+        latencies, stats = run(module, pool_size, args.sessions, args.vehicles, args.grace)
+        sys.stdout = stdout
+        taken = stats["reused"] + stats["spawned"]
+        print(f"Пул {pool_size}: спавн {args.vehicles} машин p50 {percentile(latencies, 50):.1f} мс, "
+              f"первая сессия {latencies[0]:.1f} мс, последняя {latencies[-1]:.1f} мс; "
+              f"из пула {stats['reused']}/{taken} ({stats['reused'] / max(1, taken):.1%}), "
+              f"вытеснено {stats['evicted']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Кэш метаданных мира: задержка запроса спавна с холодным и тёплым кэшем.
+
+Холодный кэш сбрасывается перед каждым запросом - как раньше, когда каждый спавн вызывал
+get_blueprint_library() и get_map() (передача OpenDRIVE, --map-latency-ms). Также
+сравнивается размер ответа get_map_info с версией у клиента и без неё, и проверяется,
+что после load_world кэш перечитывается.
+Запуск: python benchmarks/bench_world_metadata.py --requests 50 --vehicles 10
+"""
+import argparse
+import os
+import sys
+import time
+
+from common import load_server_module, percentile
+
+
+class RecordingConnection:
+    """Соединение без сокета: запоминает размер отправленных сообщений"""
+    queue = None
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data, kind=None):
+        self.sent.append(data)
+        return True
+
+    def close(self):
+        pass
+
+
+def spawn_latencies(server, client_id, requests, vehicles, cold):
+    shard = server.shards[0]
+    latencies = []
+    for _ in range(requests):
+        if cold:
+            shard.metadata.invalidate()
+        started = time.perf_counter()
+        server.spawn_vehicles(client_id, vehicles)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--vehicles", type=int, default=10, help="машин в запросе")
+    parser.add_argument("--rpc-latency-ms", type=float, default=1.0, help="задержка одного RPC fake_carla")
+    parser.add_argument("--map-latency-ms", type=float, default=50.0, help="передача OpenDRIVE в get_map")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    module = load_server_module(rpc_latency=args.rpc_latency_ms / 1000.0, map_latency=args.map_latency_ms / 1000.0,
+                                spawn_points=2 * args.requests * args.vehicles + 100)
+    server = module.CarlaServer("127.0.0.1", 0, pool_size=0, quiet=True)
+    connection = RecordingConnection()
+    server.register_client("bench", connection)
+    results = {mode: spawn_latencies(server, "bench", args.requests, args.vehicles, mode == "cold")
+               for mode in ("cold", "warm")}
+
+    connection.sent.clear()
+    server.send_map_info("bench", {"action": "get_map_info"})
+    version = server.shards[0].metadata.current().version
+    server.send_map_info("bench", {"action": "get_map_info", "known": [version]})
+    full, unchanged = (len(data) for data in connection.sent)
+
+    shard = server.shards[0]
+    loads = shard.metadata.stats["loads"]
+    shard.client.load_world("Town_Fake_2")
+    shard.metadata.checked = 0.0  # не ждать интервала проверки
+    server.spawn_vehicles("bench", args.vehicles)
+    reloaded = shard.metadata.stats["loads"] - loads
+    sys.stdout = stdout
+
+    print(f"Спавн {args.vehicles} машин, {args.requests} запросов (RPC {args.rpc_latency_ms} мс, get_map {args.map_latency_ms} мс):")
+    for mode, latencies in results.items():
+        print(f"  {'холодный' if mode == 'cold' else 'тёплый':>8} кэш: p50 {percentile(latencies, 50):.1f} мс, "
+              f"p99 {percentile(latencies, 99):.1f} мс")
+    print(f"get_map_info: {full} байт без версии у клиента, {unchanged} байт с актуальной версией {version}")
+    print(f"После load_world: карта перечитана {reloaded} раз, теперь {shard.metadata.metadata.map_name}, "
+          f"свободных точек спавна {shard.spawn_allocator.available()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Общие функции бенчмарков: загрузка сервера с fake_carla и статистика."""
+import importlib.util
+import multiprocessing
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+# Общие модули (protocol.py и др.) лежат в корне репозитория
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def load_module(filename, name):
+    """Импортирует скрипт из корня репозитория (имена файлов содержат пробелы)"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_server_module(**fake_options):
+    """Загружает server_test .py, подменив carla на fake_carla"""
+    if BENCH_DIR not in sys.path:
+        sys.path.insert(0, BENCH_DIR)
+    import fake_carla
+    fake_carla.configure(**fake_options)
+    sys.modules["carla"] = fake_carla
+    return load_module("server_test .py", "carla_server")
+
+
+def _run_server(ready, server_kwargs, fake_options, quiet):
+    if quiet:
+        sys.stdout = open(os.devnull, "w")
+    module = load_server_module(**fake_options)
+    server = module.CarlaServer("127.0.0.1", 0, quiet=quiet, **server_kwargs)
+    ready.put(server.server_socket.getsockname()[1])
+    server.start()
+
+
+def start_server_process(server_kwargs=None, fake_options=None, quiet=True):
+    """Запускает CarlaServer в отдельном процессе, возвращает (процесс, порт)"""
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Queue()
+    process = ctx.Process(target=_run_server, args=(ready, server_kwargs or {}, fake_options or {}, quiet),
+                          daemon=True)
+    process.start()
+    port = ready.get(timeout=60)
+    return process, port
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
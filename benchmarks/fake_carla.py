@@ -0,0 +1,623 @@
+"""Лёгкая замена модуля carla для бенчмарков без симулятора.
+
+Эмулирует мир, акторов и точки спавна с задержкой на каждый RPC.
+Подключается через sys.modules["carla"] до импорта сервера (см. common.py).
+"""
+import itertools
+import math
+import threading
+import time
+
+# Задержка одного RPC в секундах, настраивается через configure()
+RPC_LATENCY = 0.001
+SPAWN_POINTS = 200
+TICK_SECONDS = 0.05  # Шаг симуляции для on_tick/get_snapshot
+MAP_LATENCY = 0.0  # Дополнительная задержка get_map: передача OpenDRIVE карты
+# Стоимость синхронного тика на машину: с физикой и без неё (гибридный режим Traffic Manager)
+PHYSICS_COST = 0.0
+KINEMATIC_COST = 0.0
+
+
+def configure(rpc_latency=None, spawn_points=None, tick_seconds=None, map_latency=None,
+              physics_cost=None, kinematic_cost=None):
+    global RPC_LATENCY, SPAWN_POINTS, TICK_SECONDS, MAP_LATENCY, PHYSICS_COST, KINEMATIC_COST
+    if physics_cost is not None:
+        PHYSICS_COST = physics_cost
+    if kinematic_cost is not None:
+        KINEMATIC_COST = kinematic_cost
+    if rpc_latency is not None:
+        RPC_LATENCY = rpc_latency
+    if map_latency is not None:
+        MAP_LATENCY = map_latency
+    if spawn_points is not None:
+        SPAWN_POINTS = spawn_points
+    if tick_seconds is not None:
+        TICK_SECONDS = tick_seconds
+
+
+def _rpc():
+    if RPC_LATENCY:
+        time.sleep(RPC_LATENCY)
+
+
+class Vector3D:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        self.x = x
+        self.y = y
+        self.z = z
+
+
+class Location(Vector3D):
+    def distance(self, other):
+        return math.sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2 + (self.z - other.z) ** 2)
+
+
+class Rotation:
+    def __init__(self, pitch=0.0, yaw=0.0, roll=0.0):
+        self.pitch = pitch
+        self.yaw = yaw
+        self.roll = roll
+
+
+class Transform:
+    def __init__(self, location=None, rotation=None):
+        self.location = location or Location()
+        self.rotation = rotation or Rotation()
+
+
+class VehicleControl:
+    def __init__(self, throttle=0.0, steer=0.0, brake=0.0, hand_brake=False, reverse=False):
+        self.throttle = throttle
+        self.steer = steer
+        self.brake = brake
+        self.hand_brake = hand_brake
+        self.reverse = reverse
+
+
+class ActorBlueprint:
+    def __init__(self, bp_id):
+        self.id = bp_id
+        self.attributes = {}
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+
+class BlueprintLibrary(list):
+    def filter(self, pattern):
+        prefix = pattern.rstrip("*")
+        return BlueprintLibrary(bp for bp in self if bp.id.startswith(prefix))
+
+    def find(self, bp_id):
+        for bp in self:
+            if bp.id == bp_id:
+                return bp
+        raise IndexError(bp_id)
+
+
+class ActorList(list):
+    def filter(self, pattern):
+        prefix = pattern.rstrip("*")
+        return ActorList(a for a in self if a.type_id.startswith(prefix))
+
+
+class Actor:
+    def __init__(self, world, actor_id, type_id, transform):
+        self.world = world
+        self.id = actor_id
+        self.type_id = type_id
+        self.spawn_transform = transform
+        self.spawn_time = time.monotonic()
+        self.speed = 0.0
+        self.physics = True
+        self.tm_port = None  # Traffic Manager автопилота
+        self.alive = True
+
+    @property
+    def is_alive(self):
+        _rpc()
+        return self.alive
+
+    def _location(self, now=None):
+        # Машина едет вдоль своего yaw с постоянной скоростью
+        dt = (now or time.monotonic()) - self.spawn_time
+        yaw = math.radians(self.spawn_transform.rotation.yaw)
+        loc = self.spawn_transform.location
+        return Location(loc.x + math.cos(yaw) * self.speed * dt,
+                        loc.y + math.sin(yaw) * self.speed * dt, loc.z)
+
+    def get_transform(self):
+        _rpc()
+        return Transform(self._location(), self.spawn_transform.rotation)
+
+    def get_location(self):
+        _rpc()
+        return self._location()
+
+    def get_velocity(self):
+        _rpc()
+        return self._velocity()
+
+    def _velocity(self):
+        yaw = math.radians(self.spawn_transform.rotation.yaw)
+        return Vector3D(math.cos(yaw) * self.speed, math.sin(yaw) * self.speed, 0.0)
+
+    def set_autopilot(self, enabled=True, tm_port=8000):
+        _rpc()
+        self.speed = 8.0 if enabled else 0.0
+        if enabled:
+            self.tm_port = tm_port
+        elif self.tm_port == tm_port:
+            self.tm_port = None
+
+    def apply_control(self, control):
+        _rpc()
+        self.speed = 10.0 * control.throttle * (-1 if control.reverse else 1)
+
+    def destroy(self):
+        _rpc()
+        return self.world._destroy(self.id)
+
+
+class Image:
+    """Кадр камеры в формате BGRA, как carla.Image"""
+
+    def __init__(self, frame, width, height, raw_data):
+        self.frame = frame
+        self.width = width
+        self.height = height
+        self.raw_data = raw_data
+
+
+class Sensor(Actor):
+    """Камера: поток генерирует кадры с заданной частотой, пока вызван listen"""
+
+    def __init__(self, world, actor_id, blueprint, transform, parent):
+        super().__init__(world, actor_id, blueprint.id, transform)
+        self.parent = parent
+        self.width = int(blueprint.attributes.get("image_size_x", 800))
+        self.height = int(blueprint.attributes.get("image_size_y", 600))
+        self.period = float(blueprint.attributes.get("sensor_tick", 0.0)) or TICK_SECONDS
+        self.listening = False
+
+    def listen(self, callback):
+        self.listening = True
+        threading.Thread(target=self._stream, args=(callback,), daemon=True).start()
+
+    def _stream(self, callback):
+        # Горизонтальный градиент, сдвигающийся от кадра к кадру
+        row = bytes(value for x in range(self.width) for value in (x % 256, (x * 2) % 256, 128, 255))
+        pattern = row * self.height
+        frame = 0
+        while self.listening and self.alive:
+            offset = (frame * 16) % len(row)
+            callback(Image(frame, self.width, self.height, pattern[offset:] + pattern[:offset]))
+            frame += 1
+            time.sleep(self.period)
+
+    def stop(self):
+        self.listening = False
+
+    def destroy(self):
+        self.listening = False
+        return super().destroy()
+
+
+class Timestamp:
+    def __init__(self, frame, elapsed_seconds, delta_seconds, platform_timestamp):
+        self.frame = frame
+        self.elapsed_seconds = elapsed_seconds
+        self.delta_seconds = delta_seconds
+        self.platform_timestamp = platform_timestamp
+
+
+class ActorSnapshot:
+    """Состояние актора на момент тика, методы не делают RPC"""
+
+    def __init__(self, actor, now):
+        self.id = actor.id
+        self._actor = actor
+        self._now = now
+
+    def get_transform(self):
+        return Transform(self._actor._location(self._now), self._actor.spawn_transform.rotation)
+
+    def get_velocity(self):
+        return self._actor._velocity()
+
+
+class WorldSnapshot:
+    def __init__(self, frame, now, actors):
+        self.id = 1
+        self.frame = frame
+        self.timestamp = Timestamp(frame, frame * TICK_SECONDS, TICK_SECONDS, now)
+        self._now = now
+        self._actors = actors
+
+    def __iter__(self):
+        return (ActorSnapshot(actor, self._now) for actor in self._actors)
+
+    def __len__(self):
+        return len(self._actors)
+
+    def find(self, actor_id):
+        for actor in self._actors:
+            if actor.id == actor_id:
+                return ActorSnapshot(actor, self._now)
+        return None
+
+    def has_actor(self, actor_id):
+        return any(actor.id == actor_id for actor in self._actors)
+
+
+class Waypoint:
+    def __init__(self, transform):
+        self.transform = transform
+
+
+class Map:
+    def __init__(self, name, spawn_points):
+        self.name = name
+        self._spawn_points = spawn_points
+
+    def get_spawn_points(self):
+        _rpc()
+        return list(self._spawn_points)
+
+    def generate_waypoints(self, distance):
+        """Отрезки дорог от каждой точки спавна вдоль её направления"""
+        _rpc()
+        waypoints = []
+        for point in self._spawn_points:
+            yaw = math.radians(point.rotation.yaw)
+            for step in range(int(50.0 / distance)):
+                location = Location(point.location.x + math.cos(yaw) * step * distance,
+                                    point.location.y + math.sin(yaw) * step * distance, point.location.z)
+                waypoints.append(Waypoint(Transform(location, point.rotation)))
+        return waypoints
+
+    def get_topology(self):
+        """Отрезок дороги длиной 50 м от каждой точки спавна"""
+        topology = []
+        for point in self._spawn_points:
+            yaw = math.radians(point.rotation.yaw)
+            end = Location(point.location.x + math.cos(yaw) * 50.0, point.location.y + math.sin(yaw) * 50.0, point.location.z)
+            topology.append((Waypoint(point), Waypoint(Transform(end, point.rotation))))
+        return topology
+
+
+class WorldSettings:
+    def __init__(self, synchronous_mode=False, fixed_delta_seconds=None, no_rendering_mode=False):
+        self.synchronous_mode = synchronous_mode
+        self.fixed_delta_seconds = fixed_delta_seconds
+        self.no_rendering_mode = no_rendering_mode
+
+
+class TrafficManager:
+    def __init__(self, port=8000):
+        self.port = port
+        self.synchronous = False
+        self.hybrid = False  # машины этого TM без физики (героев fake_carla не различает)
+        self.hybrid_radius = 50.0
+        self.respawn_dormant = False
+        self.respawn_bounds = (25.0, 700.0)
+
+    def get_port(self):
+        return self.port
+
+    def set_synchronous_mode(self, enabled):
+        _rpc()
+        self.synchronous = enabled
+
+    def set_hybrid_physics_mode(self, enabled=True):
+        _rpc()
+        self.hybrid = enabled
+
+    def set_hybrid_physics_radius(self, radius=50.0):
+        _rpc()
+        self.hybrid_radius = radius
+
+    def set_respawn_dormant_vehicles(self, enabled=False):
+        _rpc()
+        self.respawn_dormant = enabled
+
+    def set_boundaries_respawn_dormant_vehicles(self, lower_bound=25.0, upper_bound=700.0):
+        _rpc()
+        self.respawn_bounds = (lower_bound, upper_bound)
+
+
+class World:
+    def __init__(self, map_name="Town_Fake", episode_id=1):
+        self.id = episode_id
+        self._ids = itertools.count(100)
+        self._actors = {}
+        self._occupied = {}
+        self._lock = threading.Lock()
+        self._blueprints = BlueprintLibrary([ActorBlueprint("vehicle.tesla.model3"),
+                                             ActorBlueprint("vehicle.audi.tt"),
+                                             ActorBlueprint("sensor.camera.rgb")])
+        side = max(1, int(math.sqrt(SPAWN_POINTS)))
+        points = [Transform(Location(float(i % side) * 50.0, float(i // side) * 50.0, 0.5), Rotation(yaw=float(i * 37 % 360)))
+                  for i in range(SPAWN_POINTS)]
+        self._map = Map(map_name, points)
+        self._start = time.monotonic()
+        self._tick_callbacks = {}
+        self._callback_ids = itertools.count(1)
+        self._tick_thread = None
+        self._settings = WorldSettings()
+        self._sync_frame = 0
+        self._traffic_managers = {}  # {порт: TrafficManager}, общий с Client
+
+    def _frame(self):
+        if self._settings.synchronous_mode:
+            return self._sync_frame
+        return int((time.monotonic() - self._start) / TICK_SECONDS)
+
+    def get_settings(self):
+        _rpc()
+        return WorldSettings(self._settings.synchronous_mode, self._settings.fixed_delta_seconds,
+                             self._settings.no_rendering_mode)
+
+    def apply_settings(self, settings):
+        _rpc()
+        if settings.synchronous_mode and not self._settings.synchronous_mode:
+            self._sync_frame = self._frame()
+        self._settings = settings
+        return self._frame()
+
+    def _physics_cost(self):
+        """Время шага: машины с физикой дороже машин гибридного режима"""
+        if not PHYSICS_COST and not KINEMATIC_COST:
+            return 0.0
+        with self._lock:
+            vehicles = [actor for actor in self._actors.values() if actor.type_id.startswith("vehicle.")]
+        physics = 0
+        for actor in vehicles:
+            manager = self._traffic_managers.get(actor.tm_port)
+            if actor.physics and not (manager is not None and manager.hybrid):
+                physics += 1
+        return physics * PHYSICS_COST + (len(vehicles) - physics) * KINEMATIC_COST
+
+    def tick(self, seconds=10.0):
+        """Шаг симуляции в синхронном режиме: кадр и on_tick только по вызову"""
+        _rpc()
+        cost = self._physics_cost()
+        if cost:
+            time.sleep(cost)
+        self._sync_frame += 1
+        self._notify_tick()
+        return self._sync_frame
+
+    def wait_for_tick(self, seconds=10.0):
+        time.sleep(TICK_SECONDS)
+        return self._snapshot()
+
+    def _notify_tick(self):
+        snapshot = self._snapshot()
+        for callback in list(self._tick_callbacks.values()):
+            callback(snapshot)
+
+    def _snapshot(self):
+        with self._lock:
+            actors = list(self._actors.values())
+        return WorldSnapshot(self._frame(), time.monotonic(), actors)
+
+    def get_snapshot(self):
+        _rpc()
+        return self._snapshot()
+
+    def on_tick(self, callback):
+        callback_id = next(self._callback_ids)
+        self._tick_callbacks[callback_id] = callback
+        if self._tick_thread is None:
+            self._tick_thread = threading.Thread(target=self._tick_loop, daemon=True)
+            self._tick_thread.start()
+        return callback_id
+
+    def remove_on_tick(self, callback_id):
+        self._tick_callbacks.pop(callback_id, None)
+
+    def _tick_loop(self):
+        while True:
+            time.sleep(TICK_SECONDS)
+            if not self._settings.synchronous_mode:
+                self._notify_tick()
+
+    def get_map(self):
+        _rpc()
+        if MAP_LATENCY:
+            time.sleep(MAP_LATENCY)
+        return self._map
+
+    def get_blueprint_library(self):
+        _rpc()
+        return self._blueprints
+
+    def _spawn(self, blueprint, transform):
+        key = (round(transform.location.x, 1), round(transform.location.y, 1))
+        with self._lock:
+            occupant = self._occupied.get(key)
+            if occupant is not None and occupant in self._actors:
+                return None
+            actor = Actor(self, next(self._ids), blueprint.id, transform)
+            self._actors[actor.id] = actor
+            self._occupied[key] = actor.id
+            return actor
+
+    def try_spawn_actor(self, blueprint, transform, attach_to=None):
+        _rpc()
+        return self._spawn(blueprint, transform)
+
+    def spawn_actor(self, blueprint, transform, attach_to=None):
+        if blueprint.id.startswith("sensor."):
+            _rpc()
+            with self._lock:
+                sensor = Sensor(self, next(self._ids), blueprint, transform, attach_to)
+                self._actors[sensor.id] = sensor
+            return sensor
+        actor = self.try_spawn_actor(blueprint, transform, attach_to)
+        if actor is None:
+            raise RuntimeError("Spawn failed because of collision at spawn position")
+        return actor
+
+    def _move(self, actor, transform):
+        """Перенос актора (ApplyTransform): точка спавна, которую он занимал, освобождается"""
+        with self._lock:
+            old = (round(actor.spawn_transform.location.x, 1), round(actor.spawn_transform.location.y, 1))
+            if self._occupied.get(old) == actor.id:
+                del self._occupied[old]
+            self._occupied[(round(transform.location.x, 1), round(transform.location.y, 1))] = actor.id
+        actor.spawn_transform = transform
+        actor.spawn_time = time.monotonic()
+
+    def _destroy(self, actor_id):
+        with self._lock:
+            actor = self._actors.pop(actor_id, None)
+        if actor is None:
+            return False
+        actor.alive = False
+        return True
+
+    def get_actors(self, actor_ids=None):
+        _rpc()
+        with self._lock:
+            if actor_ids is None:
+                return ActorList(self._actors.values())
+            return ActorList(self._actors[i] for i in actor_ids if i in self._actors)
+
+
+class command:
+    """Пакетные команды (carla.command)"""
+
+    FutureActor = object()
+
+    class _Command:
+        def __init__(self):
+            self.next = None
+
+        def then(self, other):
+            self.next = other
+            return self
+
+    class SpawnActor(_Command):
+        def __init__(self, blueprint, transform, parent=None):
+            super().__init__()
+            self.blueprint = blueprint
+            self.transform = transform
+
+    class SetAutopilot(_Command):
+        def __init__(self, actor, enabled, tm_port=8000):
+            super().__init__()
+            self.actor = actor
+            self.enabled = enabled
+            self.tm_port = tm_port
+
+    class DestroyActor(_Command):
+        def __init__(self, actor):
+            super().__init__()
+            self.actor = actor
+
+    class SetSimulatePhysics(_Command):
+        def __init__(self, actor, enabled):
+            super().__init__()
+            self.actor = actor
+            self.enabled = enabled
+
+    class ApplyTransform(_Command):
+        def __init__(self, actor, transform):
+            super().__init__()
+            self.actor = actor
+            self.transform = transform
+
+    class ApplyVehicleControl(_Command):
+        def __init__(self, actor, control):
+            super().__init__()
+            self.actor = actor
+            self.control = control
+
+
+class CommandResponse:
+    def __init__(self, actor_id=0, error=""):
+        self.actor_id = actor_id
+        self.error = error
+
+    def has_error(self):
+        return bool(self.error)
+
+
+def _actor_id(actor):
+    if isinstance(actor, Actor):
+        return actor.id
+    return actor
+
+
+class Client:
+    def __init__(self, host="localhost", port=2000):
+        self.host = host
+        self.port = port
+        self._traffic_managers = {}
+        self._world = World()
+        self._world._traffic_managers = self._traffic_managers
+
+    def set_timeout(self, seconds):
+        pass
+
+    def get_trafficmanager(self, port=8000):
+        if port not in self._traffic_managers:
+            self._traffic_managers[port] = TrafficManager(port)
+        return self._traffic_managers[port]
+
+    def get_world(self):
+        _rpc()
+        return self._world
+
+    def load_world(self, map_name):
+        """Новый эпизод с другой картой: акторы старого мира пропадают"""
+        _rpc()
+        self._world = World(map_name, self._world.id + 1)
+        self._world._traffic_managers = self._traffic_managers
+        return self._world
+
+    def reload_world(self):
+        return self.load_world(self._world._map.name)
+
+    def _execute(self, cmd, future_id=None):
+        world = self._world
+        if isinstance(cmd, command.SpawnActor):
+            actor = world._spawn(cmd.blueprint, cmd.transform)
+            if actor is None:
+                return CommandResponse(error="Spawn failed because of collision at spawn position")
+            response = CommandResponse(actor.id)
+            if cmd.next is not None:
+                self._execute(cmd.next, actor.id)
+            return response
+        actor_id = future_id if cmd.actor is command.FutureActor else _actor_id(cmd.actor)
+        actor = world._actors.get(actor_id)
+        if actor is None:
+            return CommandResponse(actor_id, f"actor {actor_id} not found")
+        if isinstance(cmd, command.SetAutopilot):
+            actor.speed = 8.0 if cmd.enabled else 0.0
+            if cmd.enabled:
+                actor.tm_port = cmd.tm_port
+            elif actor.tm_port == cmd.tm_port:
+                actor.tm_port = None
+        elif isinstance(cmd, command.DestroyActor):
+            world._destroy(actor_id)
+        elif isinstance(cmd, command.SetSimulatePhysics):
+            actor.physics = cmd.enabled
+            if not cmd.enabled:
+                actor.speed = 0.0
+        elif isinstance(cmd, command.ApplyTransform):
+            world._move(actor, cmd.transform)
+        elif isinstance(cmd, command.ApplyVehicleControl):
+            actor.speed = 10.0 * cmd.control.throttle * (-1 if cmd.control.reverse else 1)
+        return CommandResponse(actor_id)
+
+    def apply_batch(self, commands):
+        _rpc()
+        for cmd in commands:
+            self._execute(cmd)
+
+    def apply_batch_sync(self, commands, do_tick=False):
+        _rpc()
+        return [self._execute(cmd) for cmd in commands]
@@ -0,0 +1,217 @@
+"""Нагрузочный тест: N безголовых клиентов в одном процессе против CarlaServer с fake_carla.
+
+Клиенты говорят тем же протоколом, что и client .py (согласование кадров, device info,
+спавн, запросы и подписка vehicle_info). Не нужны ни CARLA, ни GPU, ни сеть.
+
+Запуск: python benchmarks/swarm.py --clients 1 100 1000 --mode async --duration 10
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import psutil
+
+from common import percentile, raise_fd_limit, start_server_process
+import protocol
+
+REPLIES = {"negotiate_protocol": "protocol", "request_spawn": "spawn_vehicles", "get_vehicle_info": "vehicle_info"}
+
+
+class SwarmClient:
+    """Один безголовый клиент: последовательные запросы с замером задержки каждого действия"""
+
+    def __init__(self, port, stats, codecs):
+        self.port = port
+        self.stats = stats
+        self.codecs = codecs
+        self.codec = None
+        self.decoder = protocol.MessageDecoder()
+        self.reader = None
+        self.writer = None
+        self.pending = None  # (ожидаемое действие ответа, future)
+
+    async def connect(self, timeout):
+        started = time.perf_counter()
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", self.port), timeout)
+        self.stats.record("connect", time.perf_counter() - started)
+        asyncio.get_running_loop().create_task(self.read_loop())
+        if self.codecs:
+            reply = await self.request({"action": "negotiate_protocol", "framing": protocol.FRAMING,
+                                        "codecs": self.codecs}, timeout)
+            if reply.get("framing") == protocol.FRAMING:
+                self.codec = protocol.CODEC_NAMES[reply["codec"]]
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.decoder.feed(data)
+                for message in self.decoder:
+                    self.stats.received += 1
+                    if message.get("action") == "protocol" and message.get("framing") == protocol.FRAMING:
+                        self.decoder.switch_to_framed()
+                    if message.get("subscription"):
+                        continue
+                    if self.pending and message.get("action") == self.pending[0] and not self.pending[1].done():
+                        self.pending[1].set_result(message)
+        except (ConnectionError, OSError):
+            pass
+        if self.pending and not self.pending[1].done():
+            self.pending[1].set_exception(ConnectionError("соединение закрыто"))
+
+    def send(self, command):
+        self.writer.write(protocol.encode_message(command, self.codec))
+        self.stats.sent += 1
+
+    async def request(self, command, timeout):
+        future = asyncio.get_running_loop().create_future()
+        self.pending = (REPLIES[command["action"]], future)
+        started = time.perf_counter()
+        self.send(command)
+        try:
+            reply = await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            self.stats.errors[command["action"]] = self.stats.errors.get(command["action"], 0) + 1
+            if isinstance(e, asyncio.TimeoutError):
+                # Соединение живо, а ответа нет - сервер потерял его (например, вытеснил телеметрией)
+                self.stats.unanswered[command["action"]] = self.stats.unanswered.get(command["action"], 0) + 1
+            raise
+        self.stats.record(command["action"], time.perf_counter() - started)
+        return reply
+
+    def send_device_info(self):
+        self.send({"action": "send_device_info", "device_info": {
+            "static": {"OS": "Swarm", "OS Version": "1", "CPU": "virtual", "RAM Total": 16.0, "GPU": []},
+            "sample": {"cpu_percent": random.uniform(0, 100), "ram_used_gb": 4.0, "ram_percent": 25.0}}})
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class SwarmStats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.unanswered = {}  # {действие: запросов без ответа при живом соединении}
+        self.sent = 0
+        self.received = 0
+
+    def record(self, action, seconds):
+        self.latencies.setdefault(action, []).append(seconds)
+
+
+class ServerSampler:
+    """Периодически снимает CPU и RSS процесса сервера"""
+
+    def __init__(self, pid):
+        self.process = psutil.Process(pid)
+        self.peak_rss = 0
+        self.cpu_start = None
+        self.wall_start = None
+
+    def start(self):
+        self.cpu_start = sum(self.process.cpu_times()[:2])
+        self.wall_start = time.perf_counter()
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+
+    def cpu_percent(self):
+        return 100.0 * (sum(self.process.cpu_times()[:2]) - self.cpu_start) / (time.perf_counter() - self.wall_start)
+
+
+async def run_swarm(args, count):
+    process, port = start_server_process({"mode": args.mode}, {"rpc_latency": args.rpc_latency_ms / 1000.0,
+                                                                "spawn_points": max(1000, count * args.vehicles)})
+    sampler = ServerSampler(process.pid)
+    stats = SwarmStats()
+    codecs = [] if args.codec == "lines" else [args.codec]
+    clients = [SwarmClient(port, stats, codecs) for _ in range(count)]
+    try:
+        sampler.start()
+        started = time.perf_counter()
+        results = await asyncio.gather(*(client.connect(args.timeout) for client in clients), return_exceptions=True)
+        accept_time = time.perf_counter() - started
+        connected = [client for client, result in zip(clients, results) if not isinstance(result, Exception)]
+
+        async def scenario(client):
+            client.send_device_info()
+            await client.request({"action": "request_spawn", "num_vehicles": args.vehicles}, args.timeout)
+            if args.subscribe:
+                client.send({"action": "subscribe_vehicle_info", "rate": args.subscribe})
+            deadline = time.perf_counter() + args.duration
+            while time.perf_counter() < deadline:
+                await client.request({"action": "get_vehicle_info"}, args.timeout)
+                if random.random() < 0.1:
+                    client.send_device_info()
+                await asyncio.sleep(args.think_ms / 1000.0)
+
+        async def sample_loop():
+            while True:
+                sampler.sample()
+                await asyncio.sleep(0.5)
+
+        sampling = asyncio.get_running_loop().create_task(sample_loop())
+        load_started = time.perf_counter()
+        await asyncio.gather(*(scenario(client) for client in connected), return_exceptions=True)
+        load_time = time.perf_counter() - load_started
+        sampling.cancel()
+        sampler.sample()
+        return {
+            "clients": count,
+            "connected": len(connected),
+            "accept_rate": len(connected) / accept_time if accept_time else float("inf"),
+            "msgs_per_s": (stats.sent + stats.received) / load_time,
+            "cpu": sampler.cpu_percent(),
+            "rss_mb": sampler.peak_rss / 1024 ** 2,
+            "stats": stats,
+        }
+    finally:
+        for client in clients:
+            client.close()
+        process.kill()
+        process.join()
+
+
+def report(result):
+    stats = result["stats"]
+    print(f"\n👥 Клиентов: {result['clients']} (подключено {result['connected']}), "
+          f"приём соединений: {result['accept_rate']:.0f}/с, сообщений: {result['msgs_per_s']:.0f}/с, "
+          f"CPU сервера: {result['cpu']:.0f}%, пик RSS: {result['rss_mb']:.1f} МБ")
+    print(f"   {'action':<22}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for action, values in sorted(stats.latencies.items()):
+        print(f"   {action:<22}{len(values):>8}{percentile(values, 50) * 1000:>10.2f}"
+              f"{percentile(values, 99) * 1000:>10.2f}{stats.errors.get(action, 0):>8}")
+    if stats.unanswered:
+        print("   ❌ Запросы без ответа: " + ", ".join(f"{action} {count}" for action, count in sorted(stats.unanswered.items())))
+    return sum(stats.unanswered.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--mode", choices=["threaded", "async"], default="async")
+    parser.add_argument("--codec", choices=["lines", "json", "msgpack"], default="msgpack")
+    parser.add_argument("--vehicles", type=int, default=5, help="машин на клиента")
+    parser.add_argument("--duration", type=float, default=10.0, help="секунд нагрузки")
+    parser.add_argument("--think-ms", type=float, default=100.0, help="пауза клиента между запросами")
+    parser.add_argument("--subscribe", type=float, default=0.0, help="частота подписки vehicle_info, 0 - без подписки")
+    parser.add_argument("--rpc-latency-ms", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+    if args.codec == "msgpack" and protocol.msgpack is None:
+        parser.error("msgpack не установлен, используйте --codec json")
+    raise_fd_limit()
+
+    unanswered = sum(report(asyncio.run(run_swarm(args, count))) for count in args.clients)
+    if unanswered:
+        # Каждый запрос должен получить ответ: потерянный ответ - ошибка сервера, а не нагрузки
+        raise SystemExit(f"❌ Без ответа осталось запросов: {unanswered}")
+
+
+if __name__ == "__main__":
+    main()
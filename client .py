@@ -1,242 +1,868 @@
+import argparse
 import socket
 import json
+import shlex
+import sys
 import threading
 import platform
-import psutil
-import GPUtil
 import time
-import pygame
-import numpy as np
-import carla
 import math
+import protocol
+from collections import deque
+from types import SimpleNamespace
+
+# Тяжёлые модули загружаются при первом использовании: безголовому клиенту не нужны
+# pygame, numpy, cv2 и CARLA, а GPUtil при импорте тянет distutils (~0.2 с)
+np = cv2 = pygame = carla = av = None
+psutil = GPUtil = None
+shared_ring = None
+
+
+def load_video_modules():
+    """numpy, cv2 и pygame для окна ручного управления; carla и av необязательны"""
+    global np, cv2, pygame, carla, av
+    if pygame is not None:
+        return
+    import numpy as np
+    import cv2
+    try:
+        import carla  # нужна только для камеры напрямую из CARLA, если сервер не передаёт видео
+    except ImportError:
+        carla = None
+    try:
+        import av  # декодирование H.264; без него видео запрашивается в JPEG
+    except ImportError:
+        av = None
+    import pygame
+
+
+def load_device_modules(gpu=False):
+    """psutil для CPU/RAM; GPUtil только к первому опросу GPU, без него список GPU пуст"""
+    global psutil, GPUtil
+    if psutil is None:
+        import psutil
+    if gpu and GPUtil is None:
+        try:
+            import GPUtil
+        except ImportError:
+            GPUtil = SimpleNamespace(getGPUs=list)
+
+
+def load_ring_module():
+    """shared_ring (numpy, multiprocessing.shared_memory) - только для подписки через разделяемую память"""
+    global shared_ring
+    if shared_ring is None:
+        import shared_ring
+
+
+SPAWN_REJECT_REASONS = {
+    "quota": "превышена квота машин на клиента",
+    "queue_full": "слишком много запросов в очереди",
+    "no_carla": "сервер не подключён к CARLA",
+    "no_spawn_points": "нет свободных точек спавна",
+}
+SPAWN_QUEUE_REASONS = {
+    "fair_share": "сервер делит спавн между клиентами",
+    "cpu": "сервер перегружен по CPU",
+    "ram": "на сервере мало памяти",
+    "frame_time": "симулятор не успевает за реальным временем",
+}
+
+
+class DeviceTelemetry:
+    """Телеметрия устройства: статические данные отправляются один раз за сессию, дальше - только изменившиеся числа.
+
+    Интервал подстраивается под скорость изменения: при скачках нагрузки опрос
+    учащается, при стабильных значениях - становится реже.
+    """
+
+    # Минимальное изменение, которое стоит отправлять
+    THRESHOLDS = {"cpu_percent": 1.0, "ram_used_gb": 0.05, "ram_percent": 0.5}
+    GPU_THRESHOLDS = {"load": 1.0, "memory_used": 64.0}
+
+    def __init__(self, interval=5.0, min_interval=1.0, max_interval=30.0, gpu_every=3):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.gpu_every = gpu_every  # GPUtil запускает nvidia-smi, поэтому GPU опрашивается реже
+        self.static = None
+        self.last_sent = {}
+        self.samples = 0
+        self.sent_static = False
+        self.wakeup = threading.Event()  # прерывает ожидание следующего опроса
+
+    def static_info(self):
+        """Данные, которые не меняются за время работы клиента"""
+        if self.static is None:
+            load_device_modules(gpu=True)
+            self.static = {
+                "OS": platform.system(),
+                "OS Version": platform.version(),
+                "CPU": platform.processor(),
+                "RAM Total": round(psutil.virtual_memory().total / 1024 ** 3, 2),
+                "GPU": [{"Name": gpu.name, "Memory Total": gpu.memoryTotal} for gpu in GPUtil.getGPUs()],
+            }
+        return self.static
+
+    def sample(self):
+        """Один опрос psutil (и GPUtil раз в gpu_every опросов)"""
+        load_device_modules(gpu=self.samples % self.gpu_every == 0)
+        memory = psutil.virtual_memory()
+        values = {
+            "cpu_percent": psutil.cpu_percent(),
+            "ram_used_gb": round(memory.used / 1024 ** 3, 2),
+            "ram_percent": memory.percent,
+        }
+        if self.samples % self.gpu_every == 0:
+            for index, gpu in enumerate(GPUtil.getGPUs()):
+                values[f"gpu{index}_load"] = round(gpu.load * 100, 1)
+                values[f"gpu{index}_memory_used"] = gpu.memoryUsed
+        self.samples += 1
+        return values
+
+    def restart(self):
+        """Сервер начал новую сессию и ничего не знает об устройстве: статика и все значения уходят заново сразу"""
+        self.sent_static = False
+        self.last_sent = {}
+        self.wakeup.set()
+
+    def threshold(self, name):
+        if name.startswith("gpu"):
+            return self.GPU_THRESHOLDS[name.split("_", 1)[1]]
+        return self.THRESHOLDS[name]
+
+    def next_update(self):
+        """Возвращает device_info для отправки или None, если ничего заметно не изменилось"""
+        values = self.sample()
+        changes = {name: value for name, value in values.items()
+                   if name not in self.last_sent or abs(value - self.last_sent[name]) >= self.threshold(name)}
+
+        # Насколько быстро меняются значения (в долях порога)
+        known = [abs(values[name] - self.last_sent[name]) / self.threshold(name) for name in changes if name in self.last_sent]
+        rate = max(known, default=0.0)
+        if rate >= 5:
+            self.interval = max(self.min_interval, self.interval / 2)
+        elif rate < 1:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+
+        self.last_sent.update(changes)
+        update = {}
+        if not self.sent_static:
+            update["static"] = self.static_info()
+            self.sent_static = True
+        if changes:
+            update["sample"] = changes
+        return update or None
+
+
+class FrameTimer:
+    """Скользящее среднее времени кадра и его частей в миллисекундах"""
+
+    def __init__(self, window=120):
+        self.samples = {}
+        self.started = {}
+        self.window = window
+
+    def start(self, name):
+        self.started[name] = time.perf_counter()
+
+    def stop(self, name):
+        elapsed = (time.perf_counter() - self.started.pop(name)) * 1000
+        self.samples.setdefault(name, deque(maxlen=self.window)).append(elapsed)
+
+    def mean(self, name):
+        values = self.samples.get(name)
+        return sum(values) / len(values) if values else 0.0
+
+    def summary(self):
+        lines = []
+        for name, values in self.samples.items():
+            ordered = sorted(values)
+            lines.append(f"{name}: среднее {self.mean(name):.2f} мс, p95 {ordered[int(0.95 * (len(ordered) - 1))]:.2f} мс")
+        return lines
+
+
+class FrameRing:
+    """Кольцо заранее выделенных буферов BGRA для кадров камеры, побеждает последний кадр.
+
+    Поток сенсора CARLA только копирует raw_data в свободный слот, преобразование
+    в поверхность pygame делается в потоке отрисовки и только для последнего кадра.
+    """
+
+    def __init__(self, width, height, slots=3):
+        self.width = width
+        self.height = height
+        self.frames = np.zeros((slots, height, width, 4), dtype=np.uint8)
+        self.arrivals = [0.0] * slots
+        self.lock = threading.Lock()
+        self.write_slot = -1  # слот последнего записанного кадра
+        self.read_slot = -1  # слот, который сейчас читает поток отрисовки
+        self.seq = 0  # номер последнего записанного кадра
+        self.shown_seq = 0  # номер последнего показанного кадра
+        self.received = 0
+        self.displayed = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=120)  # мс от прихода кадра до показа
+
+    def put(self, raw_data):
+        """Вызывается из потока сенсора"""
+        self.put_image(np.frombuffer(raw_data, dtype=np.uint8).reshape(self.height, self.width, 4))
+
+    def put_image(self, image):
+        """Кадр BGR или BGRA в размере окна (например, распакованный кадр видео от сервера)"""
+        with self.lock:
+            slot = (self.write_slot + 1) % len(self.frames)
+            if slot == self.read_slot:
+                slot = (slot + 1) % len(self.frames)
+        np.copyto(self.frames[slot][:, :, :image.shape[2]], image)
+        with self.lock:
+            self.write_slot = slot
+            self.arrivals[slot] = time.perf_counter()
+            self.seq += 1
+            self.received += 1
+
+    def blit_latest(self, surface):
+        """Копирует последний новый кадр в surface, возвращает время его прихода или None"""
+        with self.lock:
+            if self.seq == self.shown_seq:
+                return None
+            self.dropped += self.seq - self.shown_seq - 1
+            self.shown_seq = self.seq
+            self.read_slot = slot = self.write_slot
+            arrival = self.arrivals[slot]
+        # BGRA -> RGB без промежуточных копий, (h, w) -> (w, h) для surfarray
+        pygame.surfarray.blit_array(surface, self.frames[slot][:, :, 2::-1].swapaxes(0, 1))
+        with self.lock:
+            self.read_slot = -1
+        return arrival
+
+    def mark_displayed(self, arrival):
+        self.displayed += 1
+        self.latencies.append((time.perf_counter() - arrival) * 1000)
+
+    def stats(self):
+        latency = sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+        return {"received": self.received, "displayed": self.displayed, "dropped": self.dropped, "latency_ms": latency}
+
+
+class RemoteVideo:
+    """Видео с камеры, которую ставит сервер: кадры распаковываются в потоке приёма в FrameRing"""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.stream_id = None
+        self.h264 = None
+        self.received_bytes = 0
+
+    @staticmethod
+    def formats():
+        """Форматы в порядке предпочтения: JPEG переживает пропуск кадров, H.264 экономнее по трафику"""
+        return ["jpeg", "h264"] if av is not None else ["jpeg"]
+
+    def on_frame(self, command):
+        self.received_bytes += len(command["data"])
+        if command["format"] == "h264":
+            if self.h264 is None:
+                self.h264 = av.CodecContext.create("h264", "r")
+            images = [frame.to_ndarray(format="bgr24") for frame in self.h264.decode(av.Packet(command["data"]))]
+        else:
+            images = [cv2.imdecode(np.frombuffer(command["data"], dtype=np.uint8), cv2.IMREAD_COLOR)]
+        for image in images:
+            if image is None:
+                continue
+            if image.shape[1] != self.frames.width or image.shape[0] != self.frames.height:
+                # Сервер уменьшил разрешение из-за очереди - растягиваем до окна
+                image = cv2.resize(image, (self.frames.width, self.frames.height), interpolation=cv2.INTER_LINEAR)
+            self.frames.put_image(image)
+
+
+class Minimap:
+    """Мини-карта: дороги загружаются один раз на карту и заранее рисуются на поверхность.
+
+    В кадре остаётся один blit нужного участка. Если карта слишком велика для одной
+    поверхности, точки берутся запросом по сетке и рисуются только в радиусе.
+    """
+
+    MAX_SURFACE_SIZE = 8192
+
+    def __init__(self, radius=100, size=200, spacing=2.0):
+        self.radius = radius
+        self.size = size
+        self.spacing = spacing
+        self.scale = size / 2 / radius  # пикселей на метр
+        self.map_name = None
+        self.points = np.empty((0, 2))
+        self.cells = {}  # {(cx, cy): индексы точек}
+        self.surface = None
+        self.origin = (0.0, 0.0)  # мировые (min_x, max_y) левого верхнего угла поверхности
+
+    def load(self, carla_map):
+        """Загружает геометрию дорог, если карта сменилась"""
+        if carla_map.name == self.map_name:
+            return
+        waypoints = carla_map.generate_waypoints(self.spacing)
+        self.set_points(np.array([(wp.transform.location.x, wp.transform.location.y) for wp in waypoints]).reshape(-1, 2))
+        self.map_name = carla_map.name
+
+    def load_points(self, map_name, points):
+        """Точки дорог, присланные сервером плоским списком [x, y, ...]"""
+        if map_name == self.map_name:
+            return
+        self.set_points(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+        self.map_name = map_name
+
+    def set_points(self, points):
+        self.points = points
+        # Сетка с ячейкой в радиус: для запроса достаточно 3x3 ячеек вокруг машины
+        keys = np.floor(points / self.radius).astype(np.int64)
+        unique, inverse = np.unique(keys, axis=0, return_inverse=True)
+        order = np.argsort(inverse.ravel(), kind="stable")
+        bounds = np.searchsorted(inverse.ravel()[order], np.arange(len(unique) + 1))
+        self.cells = {tuple(key): order[bounds[i]:bounds[i + 1]] for i, key in enumerate(unique.tolist())}
+        self.surface = self.prerender(points)
+
+    def prerender(self, points):
+        if not len(points):
+            return None
+        min_x, min_y = points.min(axis=0) - self.radius
+        max_x, max_y = points.max(axis=0) + self.radius
+        width, height = int((max_x - min_x) * self.scale) + 1, int((max_y - min_y) * self.scale) + 1
+        if max(width, height) > self.MAX_SURFACE_SIZE:
+            return None
+        surface = pygame.Surface((width, height))
+        surface.fill((0, 0, 0))
+        self.origin = (min_x, max_y)
+        pixels = np.empty((len(points), 2), dtype=np.int64)
+        pixels[:, 0] = (points[:, 0] - min_x) * self.scale
+        pixels[:, 1] = (max_y - points[:, 1]) * self.scale
+        for px, py in pixels.tolist():
+            pygame.draw.circle(surface, (255, 255, 255), (px, py), 2)
+        return surface
+
+    def query(self, x, y):
+        """Точки дорог в радиусе от (x, y)"""
+        cx, cy = int(math.floor(x / self.radius)), int(math.floor(y / self.radius))
+        indices = [self.cells[key] for key in ((cx + i, cy + j) for i in (-1, 0, 1) for j in (-1, 0, 1)) if key in self.cells]
+        if not indices:
+            return np.empty((0, 2))
+        nearby = self.points[np.concatenate(indices)]
+        offsets = nearby - (x, y)
+        return nearby[np.einsum("ij,ij->i", offsets, offsets) < self.radius ** 2]
+
+    def draw(self, display, vehicle_location, vehicle_rotation, x, y):
+        """Отрисовывает мини-карту дорог в радиусе radius вокруг машины"""
+        half = self.size // 2
+        pygame.draw.rect(display, (0, 0, 0), (x, y, self.size, self.size))  # Фон мини-карты
+        if self.surface is not None:
+            px = (vehicle_location.x - self.origin[0]) * self.scale
+            py = (self.origin[1] - vehicle_location.y) * self.scale
+            display.blit(self.surface, (x, y), pygame.Rect(int(px) - half, int(py) - half, self.size, self.size))
+        else:
+            for road_x, road_y in self.query(vehicle_location.x, vehicle_location.y).tolist():
+                map_x = int(x + half + (road_x - vehicle_location.x) * self.scale)
+                map_y = int(y + half - (road_y - vehicle_location.y) * self.scale)
+                pygame.draw.circle(display, (255, 255, 255), (map_x, map_y), 2)
+        pygame.draw.rect(display, (200, 200, 200), (x, y, self.size, self.size), 2)  # Граница
+
+        # Отрисовываем машину
+        pygame.draw.circle(display, (255, 0, 0), (x + half, y + half), 5)
+        pygame.draw.line(display, (255, 0, 0), (x + half, y + half),
+                         (x + half + 10 * math.cos(math.radians(vehicle_rotation)),
+                          y + half - 10 * math.sin(math.radians(vehicle_rotation))), 2)
+
 
 class CarlaClient:
-    def __init__(self, server_ip, server_port):
+    def __init__(self, server_ip, server_port, headless=False, map_cache=None, shared_memory=False, reconnect_timeout=30.0):
         self.server_ip = server_ip
         self.server_port = server_port
+        self.headless = headless  # без окна pygame: numpy, cv2 и pygame не загружаются
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.running = True
+        self.session_token = None  # токен возобновления: после обрыва сервер вернёт прежние машины
+        self.client_id = None
+        self.resuming = False  # переподключились и ждём ответа на resume_session
+        self.reconnect_timeout = reconnect_timeout  # сколько пытаться переподключиться после обрыва, с
+        self.decoder = protocol.MessageDecoder()
+        self.codec = None  # None - JSON-строки, иначе кодек кадров
+        self.protocol_ready = threading.Event()  # согласование формата завершено, до этого команды ждут
+        self.negotiation_timeout = 2.0  # старый сервер на согласование не отвечает
+        self.send_lock = threading.Lock()
+        self.subscribed = False
+        self.vehicles = {}  # {id: данные машины}, обновляется подпиской vehicle_info
+        self.shared_memory = shared_memory  # подписка через разделяемую память (клиент на хосте сервера)
+        self.ring = None  # RingReader, когда сервер публикует телеметрию в разделяемую память
+        self.ring_state = None  # последний прочитанный слот (номер, время, вид, записи)
+        self.control_state = None  # последний ответ сервера на кадр ручного управления
+        self.control_sent = {}  # {seq: время отправки} для задержки управления
+        self.control_rtt = deque(maxlen=60)
+        self.video = None  # RemoteVideo на время ручного управления
+        self.minimap_update = None  # точки дорог от сервера, применяются в цикле отрисовки
+        self.telemetry = None  # DeviceTelemetry, если клиент отправляет данные об устройстве
+        self.map_cache = map_cache  # файл с метаданными карт между запусками
+        self.maps = {}  # {версия: map_info} - сервер не присылает метаданные, которые уже есть
+        self.shard_maps = {}  # {шард: версия карты}
+        if map_cache:
+            try:
+                with open(map_cache, encoding="utf-8") as f:
+                    self.maps = json.load(f)
+            except (OSError, ValueError):
+                pass
 
-    def connect(self):
+    def connect(self, script=None, device_info=True, linger=1.0):
+        """Подключается и работает по меню; script - список команд для работы без input()"""
         try:
             self.client_socket.connect((self.server_ip, self.server_port))
             print(f"✅ Подключено к серверу {self.server_ip}:{self.server_port}")
 
-            # Автоматическая отправка информации об устройстве
-            self.send_device_info()
             threading.Thread(target=self.listen_for_messages, daemon=True).start()
+            self.negotiate_protocol()
 
-            while self.running:
-                print("\nВыберите действие:")
-                print("1. Запрос на спавн автомобилей")
-                print("2. Получить информацию о транспорте")
-                print("3. Отключиться")
-                print("5. Выбрать автомобиль для ручного управления")
-                choice = input("Введите выбор (1-6): ").strip()
-
-                if choice == "1":
-                    num_vehicles = int(input("Введите число автомобилей для спавна: "))
-                    self.send_command({"action": "request_spawn", "num_vehicles": num_vehicles})
-                elif choice == "2":
-                    self.send_command({"action": "get_vehicle_info"})
-                elif choice == "3":
-                    self.disconnect()
-                elif choice == "5":
-                    self.manual_control()
-                else:
-                    print("\n❌ Некорректный ввод, попробуйте снова.")
+            # Автоматическая отправка информации об устройстве
+            if device_info:
+                self.send_device_info()
+
+            if script is None:
+                self.menu()
+            else:
+                self.run_script(script, linger)
 
         except Exception as e:
             print(f"\n❌ Ошибка подключения: {e}")
 
-    def send_command(self, command):
+    def menu(self):
+        while self.running:
+            print("\nВыберите действие:")
+            print("1. Запрос на спавн автомобилей")
+            print("2. Получить информацию о транспорте")
+            print("3. Отключиться")
+            print("4. Подписка на телеметрию (вкл/выкл)")
+            print("5. Выбрать автомобиль для ручного управления")
+            print("6. Воспроизвести запись телеметрии с сервера")
+            print("7. Метаданные карты (точки спавна, дороги, модели машин)")
+            choice = input("Введите выбор (1-7): ").strip()
+
+            if choice == "1":
+                num_vehicles = int(input("Введите число автомобилей для спавна: "))
+                self.request_spawn(num_vehicles)
+            elif choice == "2":
+                self.show_vehicles()
+            elif choice == "3":
+                self.disconnect()
+            elif choice == "4":
+                self.toggle_subscription()
+            elif choice == "5":
+                self.manual_control()
+            elif choice == "6":
+                self.request_replay()
+            elif choice == "7":
+                self.request_map_info()
+            else:
+                print("\n❌ Некорректный ввод, попробуйте снова.")
+
+    def run_script(self, lines, linger=1.0):
+        """Выполняет команды сценария по порядку, затем ждёт linger с ответов и отключается.
+
+        Команды: spawn N, info, subscribe [ГЦ], unsubscribe, wait С, recordings,
+        replay ИМЯ [СКОРОСТЬ] [КЛИЕНТ], map [ШАРД], drive [ID], disconnect. # - комментарий.
+        """
+        for number, line in enumerate(lines, 1):
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            if not self.running:
+                break
+            name, args = words[0], words[1:]
+            handler = self.SCRIPT_COMMANDS.get(name)
+            if handler is None:
+                print(f"❌ Строка {number}: неизвестная команда {name!r}")
+                continue
+            try:
+                handler(self, *args)
+            except (TypeError, ValueError) as e:
+                print(f"❌ Строка {number}: {line.strip()!r} - {e}")
+        if self.running:
+            time.sleep(linger)
+            self.disconnect()
+
+    def request_spawn(self, num_vehicles):
+        self.send_command({"action": "request_spawn", "num_vehicles": int(num_vehicles)})
+
+    def show_vehicles(self):
+        if self.ring is not None:
+            self.print_vehicles(self.ring_vehicles())
+        elif self.subscribed:
+            self.print_vehicles(list(self.vehicles.values()))
+        else:
+            self.send_command({"action": "get_vehicle_info"})
+
+    def negotiate_protocol(self):
+        """Предлагает серверу кадры с длиной; старый сервер не ответит, и останемся на JSON-строках"""
+        self.offer_protocol()
+        if not self.protocol_ready.wait(self.negotiation_timeout):
+            print("⚠️ Сервер не поддерживает кадры, используются JSON-строки")
+            self.protocol_ready.set()
+
+    def offer_protocol(self):
+        self.send_command({"action": "negotiate_protocol", "framing": protocol.FRAMING,
+                           "codecs": protocol.supported_codecs()}, wait=False)
+
+    def send_command(self, command, wait=True):
+        """Отправляет команду в согласованном формате.
+
+        Пока согласование не завершено, сервер может перейти на кадры в любой момент, поэтому
+        команды (ручное управление, телеметрия, меню) ждут его ответа, но не дольше negotiation_timeout.
+        """
+        if wait and not self.protocol_ready.wait(self.negotiation_timeout):
+            self.protocol_ready.set()  # сервер не ответил - остаёмся на JSON-строках
         try:
-            self.client_socket.send((json.dumps(command) + "\n").encode())
+            with self.send_lock:
+                self.client_socket.sendall(protocol.encode_message(command, self.codec))
         except Exception as e:
             print(f"\n❌ Ошибка отправки команды: {e}")
 
     def listen_for_messages(self):
-        buffer = ""
         while self.running:
             try:
-                chunk = self.client_socket.recv(1024).decode()
-                if not chunk:
+                if not self.decoder.recv_from(self.client_socket):
+                    if self.reconnect():
+                        continue
                     break
-                buffer += chunk
-                while "\n" in buffer:
-                    json_obj, buffer = buffer.split("\n", 1)
-                    command = json.loads(json_obj)
+                for command in self.decoder:
                     self.process_command(command)
             except Exception as e:
                 print(f"\n❌ Ошибка при получении данных: {e}")
+                if isinstance(e, OSError) and self.reconnect():
+                    continue
                 break
 
-    def get_device_info(self):
-        """Собирает данные о системе: CPU, GPU, RAM и их загрузке"""
-        device_info = {
-            "OS": platform.system(),
-            "OS Version": platform.version(),
-            "CPU": platform.processor(),
-            "CPU Usage": f"{psutil.cpu_percent()}%",
-            "RAM Total": f"{round(psutil.virtual_memory().total / 1024 ** 3, 2)} GB",
-            "RAM Used": f"{round(psutil.virtual_memory().used / 1024 ** 3, 2)} GB",
-            "RAM Usage": f"{psutil.virtual_memory().percent}%",
-            "GPU": [],
-        }
-
-        # Получаем информацию о всех доступных GPU
-        gpus = GPUtil.getGPUs()
-        for gpu in gpus:
-            device_info["GPU"].append({
-                "Name": gpu.name,
-                "Load": f"{gpu.load * 100:.1f}%",
-                "Memory Used": f"{gpu.memoryUsed} MB",
-                "Memory Total": f"{gpu.memoryTotal} MB"
-            })
-
-        return device_info
+    def reconnect(self):
+        """После обрыва подключается заново и возобновляет сессию по токену (ответ на согласование протокола
+        отправляет resume_session). False - сессии нет, клиент отключается сам или сервер так и не ответил.
+        """
+        if not self.running or self.session_token is None or self.reconnect_timeout <= 0:
+            return False
+        print(f"\n⚠️ Соединение с сервером потеряно, переподключение (до {self.reconnect_timeout:g} с)...")
+        deadline = time.monotonic() + self.reconnect_timeout
+        delay = 0.2
+        while self.running and time.monotonic() < deadline:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(max(0.1, min(5.0, deadline - time.monotonic())))
+            try:
+                sock.connect((self.server_ip, self.server_port))
+            except OSError:
+                sock.close()
+                time.sleep(max(0.0, min(delay, deadline - time.monotonic())))
+                delay = min(2 * delay, 2.0)
+                continue
+            sock.settimeout(None)
+            with self.send_lock:
+                previous, self.client_socket = self.client_socket, sock
+                self.decoder = protocol.MessageDecoder()
+                self.codec = None
+            previous.close()
+            self.protocol_ready.clear()
+            self.resuming = True
+            self.offer_protocol()
+            return True
+        print("❌ Сервер недоступен, переподключение не удалось.")
+        return False
 
     def send_device_info(self):
-        """Отправляет информацию об устройстве при подключении и затем раз в 5 секунд"""
+        """Отправляет информацию об устройстве при подключении и затем с адаптивным интервалом (1-30 с)"""
+        self.telemetry = telemetry = DeviceTelemetry()
+
         def send_loop():
             while self.running:
-                device_info = self.get_device_info()
-                self.send_command({"action": "send_device_info", "device_info": device_info})
-                time.sleep(5)
+                device_info = telemetry.next_update()
+                if device_info:
+                    self.send_command({"action": "send_device_info", "device_info": device_info})
+                telemetry.wakeup.wait(telemetry.interval)
+                telemetry.wakeup.clear()
 
-        # Запускаем фоновый поток для отправки данных каждые 5 секунд
         threading.Thread(target=send_loop, daemon=True).start()
 
     def process_command(self, command):
         if command.get("action") == "spawn_vehicles":
             num_spawned = command.get("num_vehicles", 0)
             print(f"\n🚗 Сервер сообщил: заспавнено {num_spawned} машин.")
+            if command.get("rejected"):
+                reason = SPAWN_REJECT_REASONS.get(command.get("reason"), "нет свободных точек спавна")
+                print(f"⚠️ Запрошено {command.get('requested')}, отклонено {command['rejected']} ({reason})")
+        elif command.get("action") == "spawn_queued":
+            print(f"\n⏳ Спавн в очереди: готово {command.get('spawned', 0)}, ожидают {command.get('pending')} машин "
+                  f"({SPAWN_QUEUE_REASONS.get(command.get('reason'), command.get('reason'))})")
         elif command.get("action") == "vehicle_info":
-            vehicles = command.get("vehicles", [])
-            print("\n🚙 Ваши машины:")
-            for v in vehicles:
-                print(f" - ID: {v['id']}, Скорость: {v['speed']} м/с, Позиция: {v['location']}, режим: {v.get('control_mode', 'N/A')}")
+            if command.get("subscription"):
+                self.apply_vehicle_update(command)
+            else:
+                self.print_vehicles(command.get("vehicles", []))
         elif command.get("action") == "disconnect":
             print("🔌\nСервер подтвердил отключение.")
             self.disconnect()
         elif command.get("action") == "disconnect_warning":
             print("\n🔌 Сервер отключил Вас принудительно.")
             self.running = False
+        elif command.get("action") == "protocol":
+            if command.get("framing") == protocol.FRAMING:
+                # Всё, что сервер пришлёт дальше, уже идёт кадрами
+                self.decoder.switch_to_framed()
+                self.codec = protocol.CODEC_NAMES[command["codec"]]
+            self.protocol_ready.set()
+            if self.resuming:
+                self.send_command({"action": "resume_session", "token": self.session_token})
+        elif command.get("action") == "session":
+            if not self.resuming:  # токен нового соединения нужен, только если сессию не вернули
+                self.session_token, self.client_id = command["token"], command["client_id"]
+        elif command.get("action") == "session_resumed":
+            self.resuming = False
+            self.session_token, self.client_id = command["token"], command["client_id"]
+            print(f"\n🔁 Сессия {self.client_id} восстановлена: машин {len(command['vehicles'])}, "
+                  f"пропущенных сообщений {command['missed']}")
+        elif command.get("action") == "session_expired":
+            self.resuming = False
+            self.session_token, self.client_id = command["token"], command["client_id"]
+            self.vehicles = {}
+            self.subscribed = False
+            self.detach_ring()
+            if self.telemetry is not None:
+                self.telemetry.restart()  # новый ID: сервер не получал данных об устройстве
+            print("\n⚠️ Сессия на сервере уже завершена: машины не сохранились, подключение начато заново.")
+        elif command.get("action") == "control_state":
+            # Старые ответы просто перезаписываются более новыми
+            self.control_state = command
+            sent = self.control_sent.pop(command.get("seq"), None)
+            if sent is not None:
+                self.control_rtt.append((time.perf_counter() - sent) * 1000)
+        elif command.get("action") == "video_frame":
+            if self.video is not None:
+                self.video.on_frame(command)
+        elif command.get("action") == "video_stream":
+            if self.video is not None:
+                self.video.stream_id = command["stream"]
+            print(f"\n📹 Сервер передаёт видео: {command['format']} {command['width']}x{command['height']}")
+        elif command.get("action") == "minimap":
+            self.minimap_update = command
+        elif command.get("action") == "shm_telemetry":
+            self.attach_ring(command)
+        elif command.get("action") == "map_info":
+            self.apply_map_info(command)
+        elif command.get("action") == "recordings":
+            print("\n⏺️ Записи на сервере: " + (", ".join(command["recordings"]) or "нет"))
+        elif command.get("action") == "replay_finished":
+            print(f"\n⏯️ Воспроизведение завершено: {command['ticks']} тиков, {command['vehicles']} записей машин "
+                  f"за {command['seconds']} с, пункт 2 показывает последний тик")
+        elif command.get("action") == "error":
+            print(f"\n❌ Ошибка сервера: {command.get('message')}")
         else:
             print(f"Получена неизвестная команда: {command}")
 
-    def disconnect(self):
-        print("\n🔌 Отключение от сервера...")
-        self.running = False
-        self.send_command({"action": "disconnect"})
-        self.client_socket.close()
-
-    def manual_control(self):
-        print("Запуск режима ручного управления с видеопередачей...")
+    def print_vehicles(self, vehicles):
+        print("\n🚙 Ваши машины:")
+        for v in vehicles:
+            print(f" - ID: {v['id']}, Скорость: {v.get('speed', 'N/A')} м/с, Позиция: {v.get('location', 'N/A')}, "
+                  f"режим: {v.get('control_mode', 'N/A')}")
 
-        # Подключаемся к CARLA-серверу
+    def toggle_subscription(self):
+        if self.subscribed:
+            self.unsubscribe()
+            return
+        rate = input("Частота обновлений, Гц (по умолчанию 5): ").strip()
+        self.subscribe(float(rate) if rate else 5.0)
+
+    def subscribe(self, rate=5.0, shared_memory=None):
+        command = {"action": "subscribe_vehicle_info", "rate": float(rate)}
+        if self.shared_memory if shared_memory is None else shared_memory:
+            command["transport"] = "shm"
+        self.send_command(command)
+        self.subscribed = True
+        print("📡 Подписка включена, пункт 2 показывает локальное состояние без запроса к серверу.")
+
+    def unsubscribe(self):
+        self.send_command({"action": "unsubscribe_vehicle_info"})
+        self.subscribed = False
+        self.detach_ring()
+        print("📡 Подписка на телеметрию отключена.")
+
+    def attach_ring(self, command):
+        """Сервер публикует телеметрию в разделяемую память; не вышло подключиться - обычная подписка"""
+        self.detach_ring()
         try:
-            carla_client = carla.Client("localhost", 2000)
-            carla_client.set_timeout(10.0)
-            world = carla_client.get_world()
+            load_ring_module()
+            self.ring = shared_ring.RingReader(command["name"])
+            print(f"\n⚡ Телеметрия через разделяемую память {command['name']} (до {command['capacity']} машин)")
         except Exception as e:
-            print(f"Ошибка подключения к CARLA: {e}")
+            print(f"\n⚠️ Разделяемая память сервера недоступна ({e}), телеметрия пойдёт через сокет.")
+            self.subscribe(command.get("rate", 5.0), shared_memory=False)
+
+    def detach_ring(self):
+        ring, self.ring, self.ring_state = self.ring, None, None
+        if ring is not None:
+            ring.close()
+
+    def ring_vehicles(self):
+        """Машины последнего слота разделяемой памяти; записи читаются прямо из неё, без копии"""
+        ring = self.ring
+        while True:
+            latest = ring.latest()
+            if latest is not None:
+                self.ring_state = latest
+            if self.ring_state is None:
+                return []
+            seq, _, _, records = self.ring_state
+            vehicles = [{"id": vehicle_id, "speed": round(speed, 2), "location": {"x": round(x, 2), "y": round(y, 2)},
+                         "control_mode": shared_ring.MODES[mode]}
+                        for vehicle_id, x, y, speed, mode in zip(records["id"].tolist(), records["x"].tolist(),
+                                                                 records["y"].tolist(), records["speed"].tolist(),
+                                                                 records["mode"].tolist())]
+            if ring.valid(seq):
+                return vehicles
+            self.ring_state = None  # сервер уже перезаписал слот - берём более новый
+
+    def apply_vehicle_update(self, command):
+        """Применяет полный список или дельту из подписки vehicle_info"""
+        if command.get("full"):
+            self.vehicles = {}
+        for v in command.get("vehicles", []):
+            self.vehicles.setdefault(v["id"], {}).update(v)
+        for vehicle_id in command.get("removed", []):
+            self.vehicles.pop(vehicle_id, None)
+
+    def request_map_info(self, shard=None):
+        """Запрашивает метаданные карт; версии из локального кэша сервер только подтверждает"""
+        command = {"action": "get_map_info", "known": list(self.maps)}
+        if shard not in (None, ""):
+            command["shard"] = int(shard)
+        self.send_command(command)
+
+    def apply_map_info(self, command):
+        version = command["version"]
+        self.shard_maps[command["shard"]] = version
+        if command.get("unchanged") and version in self.maps:
+            print(f"\n🗺️ Шард {command['shard']}: карта {command['map']} (версия {version}) из локального кэша")
             return
+        self.maps[version] = {key: value for key, value in command.items() if key not in ("action", "shard", "unchanged")}
+        print(f"\n🗺️ Шард {command['shard']}: карта {command['map']} (версия {version}), "
+              f"точек спавна {len(command.get('spawn_points', [])) // 4}, отрезков дорог {len(command.get('topology', [])) // 4}, "
+              f"моделей машин {len(command.get('blueprints', []))}")
+        if self.map_cache:
+            try:
+                with open(self.map_cache, "w", encoding="utf-8") as f:
+                    json.dump(self.maps, f)
+            except OSError as e:
+                print(f"⚠️ Не удалось сохранить кэш карт: {e}")
+
+    def request_replay(self):
+        self.list_recordings()
+        name = input("Имя записи: ").strip()
+        speed = input("Скорость воспроизведения (1 - реальное время, 0 - без пауз): ").strip()
+        owner = input("Клиент записи (пусто - все машины): ").strip()
+        self.replay(name, float(speed) if speed else 1.0, owner or None)
+
+    def list_recordings(self):
+        self.send_command({"action": "list_recordings"})
+
+    def replay(self, name, speed=1.0, owner=None):
+        """Запись приходит обычными сообщениями vehicle_info и обновляет локальный список машин"""
+        self.subscribed = True  # пункт 2 показывает состояние из воспроизведения
+        self.send_command({"action": "replay", "recording": name, "speed": float(speed), "owner": owner})
 
-        # Запрашиваем ID транспортного средства
-        vehicle_id_input = input("Введите ID транспортного средства (оставьте пустым для первого найденного): ").strip()
-        vehicles = world.get_actors().filter('vehicle.*')
+    def disconnect(self):
+        print("\n🔌 Отключение от сервера...")
+        self.running = False
+        self.detach_ring()
+        self.send_command({"action": "disconnect"})
+        self.client_socket.close()
 
-        if not vehicles:
-            print("❌ Транспортное средство не найдено! Спавните авто и попробуйте снова.")
+    def manual_control(self, vehicle_id_input=None):
+        if self.headless:
+            print("❌ Ручное управление недоступно в безголовом режиме.")
             return
+        print("Запуск режима ручного управления с видеопередачей...")
+        load_video_modules()
 
-        # Ищем транспортное средство
+        # Управление идёт через наш сервер, поэтому машина должна принадлежать этому клиенту
+        if vehicle_id_input is None:
+            vehicle_id_input = input("Введите ID транспортного средства (оставьте пустым для первой своей машины): ").strip()
         if vehicle_id_input:
             try:
                 vehicle_id = int(vehicle_id_input)
             except ValueError:
                 print("❌ Ошибка: ID должно быть числом.")
                 return
+        elif self.vehicles:
+            vehicle_id = next(iter(self.vehicles))
+        elif self.ring is not None and self.ring_vehicles():
+            vehicle_id = self.ring_vehicles()[0]["id"]
+        else:
+            print("❌ Список машин неизвестен: включите подписку на телеметрию (пункт 4) или введите ID.")
+            return
+        print(f"🚗 Ручное управление машиной {vehicle_id} через сервер.")
 
-            vehicle = next((v for v in vehicles if v.id == vehicle_id), None)
-            if vehicle is None:
-                print(f"❌ Транспортное средство с ID {vehicle_id} не найдено.")
-                return
+        window_width, window_height = 1280, 720
+        frames = FrameRing(window_width, window_height)
+        camera = None
+        minimap = Minimap(radius=100, size=200)
+        if self.codec is not None:
+            # Камеру ставит сервер, видео и мини-карта идут по этому же соединению - своя CARLA не нужна
+            self.video = RemoteVideo(frames)
+            self.send_command({"action": "subscribe_video", "vehicle_id": vehicle_id, "width": window_width,
+                               "height": window_height, "formats": RemoteVideo.formats()})
+            self.send_command({"action": "get_minimap", "vehicle_id": vehicle_id})
+        elif carla is None:
+            print("⚠️ Сервер не передаёт видео, а CARLA не установлена: работаем без камеры и мини-карты.")
         else:
-            vehicle = vehicles[0]
-
-        print(f"✅ Найден транспорт: ID = {vehicle.id}")
-        vehicle.set_autopilot(False)
-        print("🚗 Автопилот отключён. Включено ручное управление.")
-
-        # Установка камеры (третье лицо)
-        blueprint_library = world.get_blueprint_library()
-        camera_bp = blueprint_library.find('sensor.camera.rgb')
-        camera_transform = carla.Transform(carla.Location(x=-5, z=3))
-        camera = world.spawn_actor(camera_bp, camera_transform, attach_to=vehicle)
-        print("📷 Камера установлена.")
-
-        # Переменная для видеопотока
-        image_surface = None
-        lock = threading.Lock()
-
-        def process_img(image):
-            array = np.frombuffer(image.raw_data, dtype=np.uint8)
-            array = np.reshape(array, (image.height, image.width, 4))
-            array = array[:, :, :3][:, :, ::-1]
-            return pygame.surfarray.make_surface(array.swapaxes(0, 1))
-
-        def sensor_callback(image):
-            nonlocal image_surface
-            surface = process_img(image)
-            with lock:
-                image_surface = surface
-
-        def draw_minimap(display, world, vehicle_location, vehicle_rotation, radius, x, y):
-            """ Отрисовывает мини-карту дорог в радиусе 'radius' вокруг машины. """
-            pygame.draw.rect(display, (0, 0, 0), (x, y, 200, 200))  # Фон мини-карты
-            pygame.draw.rect(display, (200, 200, 200), (x, y, 200, 200), 2)  # Граница
-
-            # Получаем карту дорог
-            map = world.get_map()
-            waypoints = map.generate_waypoints(2.0)
-
-            for wp in waypoints:
-                road_x, road_y = wp.transform.location.x, wp.transform.location.y
-                dx, dy = road_x - vehicle_location.x, road_y - vehicle_location.y
-                dist = math.sqrt(dx ** 2 + dy ** 2)
-
-                if dist < radius:
-                    # Преобразуем координаты в мини-карту
-                    map_x = int(x + 100 + (dx / radius) * 100)
-                    map_y = int(y + 100 - (dy / radius) * 100)
-                    pygame.draw.circle(display, (255, 255, 255), (map_x, map_y), 2)
-
-            # Отрисовываем машину
-            pygame.draw.circle(display, (255, 0, 0), (x + 100, y + 100), 5)
-            pygame.draw.line(display, (255, 0, 0), (x + 100, y + 100),
-                             (x + 100 + 10 * math.cos(math.radians(vehicle_rotation)),
-                              y + 100 - 10 * math.sin(math.radians(vehicle_rotation))), 2)
-
-        camera.listen(sensor_callback)
+            camera = self.connect_camera_directly(vehicle_id, frames, minimap)
+        self.run_manual_control(vehicle_id, frames, minimap, camera, window_width, window_height)
+
+    def connect_camera_directly(self, vehicle_id, frames, minimap):
+        """Старый путь: камера и карта напрямую из CARLA на машине сервера, возвращает камеру или None"""
+        camera = None
+        try:
+            carla_client = carla.Client(self.server_ip, 2000)
+            carla_client.set_timeout(10.0)
+            world = carla_client.get_world()
+            vehicle = world.get_actor(vehicle_id)
+
+            # Установка камеры (третье лицо), кадры сразу в размере окна - без масштабирования
+            camera_bp = world.get_blueprint_library().find('sensor.camera.rgb')
+            camera_bp.set_attribute("image_size_x", str(frames.width))
+            camera_bp.set_attribute("image_size_y", str(frames.height))
+            camera_transform = carla.Transform(carla.Location(x=-5, z=3))
+            camera = world.spawn_actor(camera_bp, camera_transform, attach_to=vehicle)
+            # Кадры камеры: поток сенсора пишет в кольцо, главный цикл показывает последний
+            camera.listen(lambda image: frames.put(image.raw_data))
+            print("📷 Камера установлена.")
+
+            # Геометрия дорог загружается и рисуется один раз на карту
+            minimap.load(world.get_map())
+        except Exception as e:
+            print(f"⚠️ CARLA недоступна напрямую ({e}), работаем без камеры и мини-карты.")
+        return camera
 
+    def run_manual_control(self, vehicle_id, frames, minimap, camera, window_width, window_height):
         # Инициализация Pygame
         pygame.init()
-        window_width, window_height = 1280, 720
         display = pygame.display.set_mode((window_width, window_height))
         pygame.display.set_caption("CARLA - Ручное управление")
         clock = pygame.time.Clock()
         font = pygame.font.SysFont("Arial", 20)
+        camera_surface = pygame.Surface((window_width, window_height))
+        has_frame = False
+        timer = FrameTimer()
+        seq = 0
 
         try:
             while True:
+                timer.start("кадр")
                 for event in pygame.event.get():
                     if event.type == pygame.QUIT:
                         raise KeyboardInterrupt
+                if self.minimap_update is not None:
+                    update, self.minimap_update = self.minimap_update, None
+                    minimap.load_points(update["map"], update["points"])
 
                 keys = pygame.key.get_pressed()
-                control = carla.VehicleControl()
+                control = SimpleNamespace(throttle=0.0, steer=0.0, brake=0.0, hand_brake=False, reverse=False)
 
                 # Управление автомобилем (WASD + X)
                 if keys[pygame.K_w]:
@@ -256,60 +882,132 @@ class CarlaClient:
                     control.steer = 0.0
 
                 control.hand_brake = keys[pygame.K_SPACE]
-                vehicle.apply_control(control)
 
-                # Получаем скорость (м/с → км/ч)
-                velocity = vehicle.get_velocity()
-                speed = math.sqrt(velocity.x ** 2 + velocity.y ** 2 + velocity.z ** 2) * 3.6
+                # Один компактный кадр на кадр экрана; скорость и положение приходят в ответе
+                seq += 1
+                self.control_sent[seq] = time.perf_counter()
+                if len(self.control_sent) > 100:
+                    self.control_sent = {seq: self.control_sent[seq]}  # ответы на старые кадры не придут
+                self.send_command({"action": "control", "seq": seq,
+                                   "c": protocol.pack_control(vehicle_id, control.throttle, control.steer, control.brake,
+                                                              control.hand_brake, control.reverse)})
+                state = self.control_state["s"] if self.control_state else [vehicle_id, 0.0, 0.0, 0.0, 0.0, 0.0]
+                speed = state[1] * 3.6  # м/с → км/ч
 
                 # Отрисовка видеопотока и UI
-                display.fill((0, 0, 0))
-                with lock:
-                    if image_surface:
-                        scaled_surface = pygame.transform.scale(image_surface, (window_width, window_height))
-                        display.blit(scaled_surface, (0, 0))
-
-
-                # Получаем местоположение машины
-                vehicle_transform = vehicle.get_transform()
-                vehicle_location = vehicle_transform.location
-                vehicle_rotation = vehicle_transform.rotation.yaw
+                timer.start("камера")
+                arrival = frames.blit_latest(camera_surface)
+                has_frame = has_frame or arrival is not None
+                if has_frame:
+                    display.blit(camera_surface, (0, 0))
+                else:
+                    display.fill((0, 0, 0))
+                timer.stop("камера")
 
-                # Отрисовка мини-карты
-                draw_minimap(display, world, vehicle_location, vehicle_rotation, 100, 20, 200) # радиус, положение по x, положение по y
+                # Отрисовка мини-карты по положению из ответа сервера
+                timer.start("мини-карта")
+                vehicle_location = SimpleNamespace(x=state[2], y=state[3], z=state[4])
+                minimap.draw(display, vehicle_location, state[5], 20, 200) # положение по x, положение по y
+                timer.stop("мини-карта")
 
                 # Информационная панель
+                rtt = sum(self.control_rtt) / len(self.control_rtt) if self.control_rtt else 0.0
                 info_lines = [
-                    f"ID автомобиля: {vehicle.id}",
+                    f"ID автомобиля: {vehicle_id}",
                     f"Скорость: {speed:.2f} км/ч",
+                    f"Задержка управления: {rtt:.1f} мс",
                     f"Газ (W): {control.throttle:.2f}",
                     f"Назад (S): {'Да' if control.reverse else 'Нет'}",
                     f"Руль (A/D): {control.steer:.2f}",
                     f"Ручной тормоз (Пробел): {'Да' if control.hand_brake else 'Нет'}",
                 ]
                 y_offset = 20
-                pygame.draw.rect(display, (30, 30, 30), (10, 10, 280, 190)) #черный прямоугольник (фон) первые две - верхний левый угол вторые 2 размер
-                pygame.draw.rect(display, (200, 200, 200), (10, 10, 280, 190), 2) #белая рамка
+                pygame.draw.rect(display, (30, 30, 30), (10, 10, 280, 215)) #черный прямоугольник (фон) первые две - верхний левый угол вторые 2 размер
+                pygame.draw.rect(display, (200, 200, 200), (10, 10, 280, 215), 2) #белая рамка
 
                 for line in info_lines:
                     text_surface = font.render(line, True, (255, 255, 255))
                     display.blit(text_surface, (20, y_offset))
                     y_offset += text_surface.get_height() + 5
 
+                # Время кадра (без ожидания clock.tick)
+                timing = font.render(f"Кадр: {timer.mean('кадр'):.1f} мс, мини-карта: {timer.mean('мини-карта'):.2f} мс, "
+                                     f"камера: {timer.mean('камера'):.2f} мс", True, (255, 255, 0))
+                display.blit(timing, (window_width - timing.get_width() - 20, 20))
+                camera_stats = frames.stats()
+                video = font.render(f"Кадры камеры: показано {camera_stats['displayed']}, пропущено {camera_stats['dropped']}, "
+                                    f"задержка {camera_stats['latency_ms']:.1f} мс", True, (255, 255, 0))
+                display.blit(video, (window_width - video.get_width() - 20, 45))
+
                 pygame.display.flip()
+                if arrival is not None:
+                    frames.mark_displayed(arrival)
+                timer.stop("кадр")
                 clock.tick(30)
 
         except KeyboardInterrupt:
             print("Остановка режима ручного управления...")
 
         finally:
-            camera.stop()
-            camera.destroy()
+            print("⏱️ Время кадра: " + "; ".join(timer.summary()))
+            print("📷 Камера: получено {received}, показано {displayed}, пропущено {dropped}, "
+                  "средняя задержка до экрана {latency_ms:.1f} мс".format(**frames.stats()))
+            if camera is not None:
+                camera.stop()
+                camera.destroy()
+            if self.video is not None:
+                if self.video.stream_id is not None:
+                    self.send_command({"action": "unsubscribe_video", "stream": self.video.stream_id})
+                print(f"📹 Видео от сервера: {self.video.received_bytes / 1024 / 1024:.1f} МБ")
+                self.video = None
             pygame.quit()
-            vehicle.set_autopilot(True)
-            print(f"🚙 Автомобиль {vehicle.id} снова в режиме автопилота.")
+            self.send_command({"action": "release_control", "vehicle_id": vehicle_id})
+            self.control_state = None
+            print(f"🚙 Автомобиль {vehicle_id} снова в режиме автопилота.")
+
+
+# Команды сценария: имя -> метод, аргументы - строки из сценария
+CarlaClient.SCRIPT_COMMANDS = {
+    "spawn": CarlaClient.request_spawn,
+    "info": CarlaClient.show_vehicles,
+    "subscribe": CarlaClient.subscribe,
+    "unsubscribe": CarlaClient.unsubscribe,
+    "wait": lambda client, seconds: time.sleep(float(seconds)),
+    "recordings": CarlaClient.list_recordings,
+    "replay": CarlaClient.replay,
+    "map": CarlaClient.request_map_info,
+    "drive": lambda client, vehicle_id="": client.manual_control(vehicle_id),
+    "disconnect": CarlaClient.disconnect,
+}
+
+
+def read_script(path):
+    if path == "-":
+        return sys.stdin.read().splitlines()
+    with open(path, encoding="utf-8") as f:
+        return f.read().splitlines()
 
 
 if __name__ == "__main__":
-    client = CarlaClient("172.23.16.1", 52399)  # Изменяйте в соответствии с IP и портом сервера
-    client.connect()
+    parser = argparse.ArgumentParser(description="Клиент сервера CARLA",
+                                     epilog='Пример: client.py --headless "spawn 10" "subscribe 2" "wait 5" info')
+    parser.add_argument("commands", nargs="*", help="Команды сценария вместо меню (см. CarlaClient.run_script)")
+    parser.add_argument("--host", default="172.23.16.1")  # Изменяйте в соответствии с IP и портом сервера
+    parser.add_argument("--port", type=int, default=52399)
+    parser.add_argument("--script", help="Файл со сценарием, по команде в строке ('-' - stdin)")
+    parser.add_argument("--headless", action="store_true", help="Без окна pygame: ручное управление недоступно")
+    parser.add_argument("--no-device-info", action="store_true", help="Не отправлять телеметрию устройства (без psutil/GPUtil)")
+    parser.add_argument("--linger", type=float, default=1.0, help="Сколько ждать ответов после сценария, с")
+    parser.add_argument("--map-cache", help="Файл кэша метаданных карт: повторно они не скачиваются")
+    parser.add_argument("--reconnect-timeout", type=float, default=30.0,
+                        help="Сколько пытаться переподключиться после обрыва, чтобы вернуть свои машины, с (0 - не пытаться)")
+    parser.add_argument("--shm", action="store_true",
+                        help="Телеметрия подписки через разделяемую память (клиент на одном хосте с сервером)")
+    args = parser.parse_args()
+
+    script = None
+    if args.script or args.commands:
+        script = (read_script(args.script) if args.script else []) + args.commands
+    client = CarlaClient(args.host, args.port, headless=args.headless, map_cache=args.map_cache,
+                         shared_memory=args.shm, reconnect_timeout=args.reconnect_timeout)
+    client.connect(script, device_info=not args.no_device_info, linger=args.linger)
@@ -0,0 +1,171 @@
+"""Протокол обмена сообщениями между клиентом и сервером.
+
+По умолчанию сообщения - JSON-строки, разделённые "\n" (так работают старые клиенты).
+После согласования (action "negotiate_protocol") стороны переходят на кадры:
+4 байта длины (big-endian) + 1 байт кодека + полезная нагрузка (msgpack или JSON).
+Кадры видео идут с кодеком CODEC_VIDEO: короткий двоичный заголовок и сжатое
+изображение без перекодирования в msgpack/JSON.
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = struct.Struct("!IB")
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+CODEC_VIDEO = 2  # только от сервера к клиенту, см. encode_video_frame
+CODEC_NAMES = {"json": CODEC_JSON, "msgpack": CODEC_MSGPACK}
+FRAMING = "length-prefixed"
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+JSON_LINE_START = ord("{")
+
+# Компактный кадр ручного управления: {"action": "control", "c": [id, газ, руль, тормоз, флаги], "seq": n}
+CONTROL_HAND_BRAKE = 1
+CONTROL_REVERSE = 2
+
+# Заголовок кадра видео: поток, номер кадра, ширина, высота, формат, ключевой кадр
+VIDEO_HEADER = struct.Struct("!IIHHBB")
+VIDEO_FORMATS = ["jpeg", "h264"]
+
+
+def supported_codecs():
+    """Кодеки в порядке предпочтения"""
+    return ["msgpack", "json"] if msgpack is not None else ["json"]
+
+
+def encode_message(message, codec=None):
+    """Кодирует сообщение: codec=None - JSON-строка с "\n", иначе кадр с длиной"""
+    if codec is None:
+        return (json.dumps(message) + "\n").encode()
+    if codec == CODEC_MSGPACK:
+        payload = msgpack.packb(message, use_bin_type=True)
+    else:
+        payload = json.dumps(message, separators=(",", ":"), ensure_ascii=False).encode()
+    return HEADER.pack(len(payload), codec) + payload
+
+
+def pack_control(vehicle_id, throttle, steer, brake, hand_brake=False, reverse=False):
+    flags = (CONTROL_HAND_BRAKE if hand_brake else 0) | (CONTROL_REVERSE if reverse else 0)
+    return [vehicle_id, round(throttle, 3), round(steer, 3), round(brake, 3), flags]
+
+
+def unpack_control(values):
+    """Возвращает (id, газ, руль, тормоз, ручной тормоз, задний ход)"""
+    vehicle_id, throttle, steer, brake, flags = values
+    return vehicle_id, float(throttle), float(steer), float(brake), bool(flags & CONTROL_HAND_BRAKE), bool(flags & CONTROL_REVERSE)
+
+
+def encode_video_frame(stream_id, seq, width, height, video_format, data, keyframe=True):
+    """Кадр видео: data - сжатое изображение (bytes или буфер NumPy)"""
+    header = VIDEO_HEADER.pack(stream_id, seq, width, height, VIDEO_FORMATS.index(video_format), keyframe)
+    return b"".join((HEADER.pack(len(header) + len(data), CODEC_VIDEO), header, data))
+
+
+def decode_video_frame(payload):
+    stream_id, seq, width, height, video_format, keyframe = VIDEO_HEADER.unpack_from(payload)
+    return {"action": "video_frame", "stream": stream_id, "seq": seq, "width": width, "height": height,
+            "format": VIDEO_FORMATS[video_format], "keyframe": bool(keyframe), "data": bytes(payload[VIDEO_HEADER.size:])}
+
+
+def decode_payload(codec, payload):
+    if codec == CODEC_VIDEO:
+        return decode_video_frame(payload)
+    if codec == CODEC_MSGPACK:
+        if msgpack is None:
+            raise ValueError("Получен кадр msgpack, но модуль msgpack не установлен")
+        return msgpack.unpackb(payload, raw=False)
+    if codec == CODEC_JSON:
+        return json.loads(bytes(payload))
+    raise ValueError(f"Неизвестный кодек кадра: {codec}")
+
+
+class MessageDecoder:
+    """Инкрементальный разбор входящего потока.
+
+    Данные принимаются прямо в заранее выделенный bytearray (recv_into), сообщения
+    разбираются только целиком, поэтому многобайтовые символы UTF-8 на границе
+    чанков не ломают декодирование. Поиск "\n" не повторяется по уже просмотренным байтам.
+    """
+
+    def __init__(self, capacity=65536):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # начало неразобранных данных
+        self.end = 0  # конец принятых данных
+        self.scan = 0  # до этой позиции "\n" уже искали
+        self.framed = False
+
+    def switch_to_framed(self):
+        self.framed = True
+
+    def reserve(self, size):
+        """Гарантирует size свободных байт в конце буфера"""
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.end - self.start
+        if len(self.buffer) - pending >= size:
+            self.view[:pending] = self.view[self.start:self.end]
+        else:
+            buffer = bytearray(max(len(self.buffer) * 2, pending + size))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.scan -= self.start
+        self.start = 0
+        self.end = pending
+
+    def recv_from(self, sock, size=65536):
+        """Читает из сокета прямо в буфер, возвращает число байт (0 - соединение закрыто)"""
+        self.reserve(size)
+        received = sock.recv_into(self.view[self.end:self.end + size])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_message(self):
+        """Возвращает следующее целое сообщение или None, если данных пока не хватает"""
+        while True:
+            # Кадр не начинается с "{" (длина 0x7b...... больше MAX_FRAME_SIZE): это JSON-строка,
+            # отправленная собеседником до того, как он получил ответ на согласование
+            if self.framed and (self.start == self.end or self.buffer[self.start] != JSON_LINE_START):
+                if self.end - self.start < HEADER.size:
+                    return None
+                length, codec = HEADER.unpack_from(self.buffer, self.start)
+                if length > MAX_FRAME_SIZE:
+                    raise ValueError(f"Слишком большой кадр: {length} байт")
+                frame_end = self.start + HEADER.size + length
+                if frame_end > self.end:
+                    return None
+                message = decode_payload(codec, self.view[self.start + HEADER.size:frame_end])
+                self.consume(frame_end)
+                return message
+
+            newline = self.buffer.find(b"\n", max(self.scan, self.start), self.end)
+            if newline < 0:
+                self.scan = self.end
+                return None
+            line = bytes(self.view[self.start:newline])
+            self.consume(newline + 1)
+            if line.strip():
+                return json.loads(line)
+
+    def consume(self, position):
+        self.start = self.scan = position
+        if self.start == self.end:
+            self.start = self.end = self.scan = 0
+
+    def __iter__(self):
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+            yield message
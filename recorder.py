@@ -0,0 +1,180 @@
+"""Запись состояния машин по тикам в колоночные файлы и их воспроизведение.
+
+Запись - каталог с manifest.json и чанками: в каждом чанке по файлу .npy на колонку,
+открытому как np.memmap, поэтому запись - это копирование массивов в отображённую
+память, а чтение не загружает чанк целиком. Строки одного тика всегда лежат в
+одном чанке.
+"""
+import json
+import os
+import time
+
+import numpy as np
+
+COLUMNS = {
+    "tick": np.int64,  # номер тика записи
+    "time": np.float64,  # время тика, с (time.time())
+    "vehicle_id": np.int64,
+    "owner": np.int32,  # индекс в manifest["owners"]
+    "x": np.float32,
+    "y": np.float32,
+    "z": np.float32,
+    "yaw": np.float32,
+    "vx": np.float32,
+    "vy": np.float32,
+    "vz": np.float32,
+    "mode": np.uint8,  # индекс в manifest["modes"]
+}
+MODES = ["autopilot", "manual"]
+MODE_CODES = {mode: code for code, mode in enumerate(MODES)}
+MANIFEST = "manifest.json"
+
+
+class TelemetryWriter:
+    """Дописывает тики в чанки фиксированного размера.
+
+    Манифест обновляется при закрытии чанка и каждые checkpoint_ticks тиков, так что
+    после падения сервера теряется не больше последних тиков до контрольной точки.
+    """
+
+    def __init__(self, path, chunk_rows=1 << 20, checkpoint_ticks=100):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.checkpoint_ticks = checkpoint_ticks
+        self.owners = {}  # {client_id: индекс}
+        self.chunks = []  # описания закрытых чанков
+        self.columns = None  # {колонка: memmap} текущего чанка
+        self.rows = 0  # заполнено строк в текущем чанке
+        self.first_tick = None
+        self.last_tick = None
+        self.ticks = 0
+        os.makedirs(path, exist_ok=True)
+        self.write_manifest()
+
+    def owner_codes(self, owners):
+        codes = np.empty(len(owners), dtype=np.int32)
+        for row, owner in enumerate(owners):
+            code = self.owners.get(owner)
+            if code is None:
+                code = self.owners[owner] = len(self.owners)
+            codes[row] = code
+        return codes
+
+    def append(self, tick, timestamp, vehicle_ids, owners, locations, yaws, velocities, modes):
+        """Записывает тик: массивы длины N (locations, velocities - Nx3), owners - список client_id"""
+        count = len(vehicle_ids)
+        if self.columns is not None and self.rows + count > len(self.columns["tick"]):
+            self.close_chunk()
+        if self.columns is None:
+            self.open_chunk(max(self.chunk_rows, count))
+        rows = slice(self.rows, self.rows + count)
+        columns = self.columns
+        columns["tick"][rows] = tick
+        columns["time"][rows] = timestamp
+        columns["vehicle_id"][rows] = vehicle_ids
+        columns["owner"][rows] = self.owner_codes(owners)
+        columns["x"][rows], columns["y"][rows], columns["z"][rows] = locations.T
+        columns["yaw"][rows] = yaws
+        columns["vx"][rows], columns["vy"][rows], columns["vz"][rows] = velocities.T
+        columns["mode"][rows] = modes
+        self.rows += count
+        self.first_tick = tick if self.first_tick is None else self.first_tick
+        self.last_tick = tick
+        self.ticks += 1
+        if self.ticks % self.checkpoint_ticks == 0:
+            self.checkpoint()
+
+    def open_chunk(self, rows):
+        directory = os.path.join(self.path, f"chunk_{len(self.chunks):05d}")
+        os.makedirs(directory, exist_ok=True)
+        self.columns = {name: np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+",
+                                                        dtype=dtype, shape=(rows,))
+                        for name, dtype in COLUMNS.items()}
+        self.rows = 0
+        self.first_tick = self.last_tick = None
+
+    def current_chunk(self):
+        directory = os.path.basename(os.path.dirname(self.columns["tick"].filename))
+        return {"dir": directory, "rows": self.rows, "first_tick": self.first_tick, "last_tick": self.last_tick}
+
+    def checkpoint(self):
+        """Сбрасывает текущий чанк на диск и записывает в манифест уже заполненные строки"""
+        if self.columns is None:
+            return
+        for column in self.columns.values():
+            column.flush()
+        self.write_manifest([self.current_chunk()])
+
+    def close_chunk(self):
+        if self.columns is None:
+            return
+        for column in self.columns.values():
+            column.flush()
+        self.chunks.append(self.current_chunk())
+        self.columns = None
+        self.write_manifest()
+
+    def write_manifest(self, open_chunks=()):
+        manifest = {"columns": {name: np.dtype(dtype).str for name, dtype in COLUMNS.items()},
+                    "modes": MODES, "owners": list(self.owners), "chunks": self.chunks + list(open_chunks)}
+        temporary = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(temporary, os.path.join(self.path, MANIFEST))
+
+    def close(self):
+        self.close_chunk()
+
+
+class TelemetryReader:
+    """Чтение записи по тикам: колонки чанков отображаются в память только на время чтения"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST), encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        self.owners = self.manifest["owners"]
+        self.modes = self.manifest["modes"]
+
+    def chunk(self, index):
+        """{колонка: массив} заполненной части чанка"""
+        info = self.manifest["chunks"][index]
+        directory = os.path.join(self.path, info["dir"])
+        return {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")[:info["rows"]]
+                for name in self.manifest["columns"]}
+
+    def ticks(self, owner=None):
+        """Генератор (tick, время, {колонка: срез}) по порядку; owner - только машины этого клиента"""
+        owner_code = self.owners.index(owner) if owner in self.owners else None
+        if owner is not None and owner_code is None:
+            return
+        for index in range(len(self.manifest["chunks"])):
+            columns = self.chunk(index)
+            if owner_code is not None:
+                mask = columns["owner"] == owner_code
+                columns = {name: column[mask] for name, column in columns.items()}
+            ticks = columns["tick"]
+            if not len(ticks):
+                continue
+            bounds = np.concatenate(([0], np.flatnonzero(np.diff(ticks)) + 1, [len(ticks)]))
+            for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+                yield int(ticks[start]), float(columns["time"][start]), {name: column[start:end] for name, column in columns.items()}
+
+    def summary(self):
+        chunks = self.manifest["chunks"]
+        return {"chunks": len(chunks), "rows": sum(chunk["rows"] for chunk in chunks),
+                "first_tick": chunks[0]["first_tick"] if chunks else None,
+                "last_tick": chunks[-1]["last_tick"] if chunks else None, "owners": len(self.owners)}
+
+
+def replay_vehicles(columns, modes=MODES):
+    """Элементы сообщения vehicle_info из строк одного тика"""
+    speeds = np.round(np.sqrt(columns["vx"].astype(np.float64) ** 2 + columns["vy"] ** 2 + columns["vz"] ** 2), 2).tolist()
+    xs = np.round(columns["x"].astype(np.float64), 2).tolist()
+    ys = np.round(columns["y"].astype(np.float64), 2).tolist()
+    return [{"id": vehicle_id, "speed": speed, "location": {"x": x, "y": y}, "control_mode": modes[mode]}
+            for vehicle_id, speed, x, y, mode in zip(columns["vehicle_id"].tolist(), speeds, xs, ys, columns["mode"].tolist())]
+
+
+def recording_name():
+    return time.strftime("run_%Y%m%d_%H%M%S")
@@ -1,5 +1,8 @@
 import socket
 import json
+import asyncio
+import argparse
+import os
 import numpy as np
 from prettytable import PrettyTable
 import carla
@@ -7,90 +10,2428 @@ import threading
 import psutil
 import GPUtil
 import time
+import heapq
+import itertools
+import contextlib
+import copy
+import hashlib
+import secrets
+import struct
 import cv2
+import protocol
+import recorder
+import shared_ring
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import av  # H.264 через PyAV; без него видео передаётся в JPEG
+except ImportError:
+    av = None
+
+
+class OutboundQueue:
+    """Ограниченная очередь исходящих сообщений одного клиента.
+
+    Сообщения с kind (телеметрия) вытесняют более старые того же вида и первыми
+    отбрасываются при превышении high_water. Если и после этого очередь переполнена,
+    put возвращает False - клиент не успевает читать и его нужно отключить.
+    """
+
+    def __init__(self, high_water=8 * 1024 * 1024, max_batch=256 * 1024, on_drop=None, on_ready=None):
+        self.high_water = high_water
+        self.max_batch = max_batch
+        self.on_drop = on_drop  # вызывается с kind отброшенного сообщения
+        self.on_ready = on_ready  # вызывается, когда в пустую очередь пришло сообщение
+        self.items = deque()  # [(data, kind)]
+        self.size = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.stats = {"queued": 0, "sent_bytes": 0, "writes": 0, "dropped": 0}
+
+    def put(self, data, kind=None):
+        dropped = []
+        with self.cond:
+            if self.closed:
+                return True
+            if kind is not None:
+                dropped += self.remove(lambda item_kind: item_kind == kind)
+            was_empty = not self.items
+            self.items.append((data, kind))
+            self.size += len(data)
+            self.stats["queued"] += 1
+            if self.size > self.high_water:
+                dropped += self.remove(lambda item_kind: item_kind is not None)
+            overflow = self.size > self.high_water
+            self.cond.notify()
+        for dropped_kind in dropped:
+            if self.on_drop is not None:
+                self.on_drop(dropped_kind)
+        if was_empty and self.on_ready is not None:
+            self.on_ready()
+        return not overflow
+
+    def remove(self, predicate):
+        """Убирает устаревшую телеметрию (вызывать под self.cond)"""
+        kept = deque()
+        dropped = []
+        for data, kind in self.items:
+            if predicate(kind):
+                self.size -= len(data)
+                dropped.append(kind)
+            else:
+                kept.append((data, kind))
+        self.items = kept
+        self.stats["dropped"] += len(dropped)
+        return dropped
+
+    def take_nowait(self):
+        """Забирает пачку сообщений до max_batch байт: [] - пусто, None - очередь закрыта"""
+        with self.cond:
+            if not self.items:
+                return None if self.closed else []
+            batch = [self.items.popleft()[0]]
+            size = len(batch[0])
+            while self.items and size + len(self.items[0][0]) <= self.max_batch:
+                data = self.items.popleft()[0]
+                batch.append(data)
+                size += len(data)
+            self.size -= size
+            self.stats["sent_bytes"] += size
+            self.stats["writes"] += 1
+            return batch
+
+    def take(self):
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+        return self.take_nowait()
+
+    def close(self, discard=False):
+        with self.cond:
+            self.closed = True
+            if discard:
+                self.items.clear()
+                self.size = 0
+            self.cond.notify()
+        if self.on_ready is not None:
+            self.on_ready()
+
+
+class ClientConnection:
+    """Соединение клиента в режиме threaded: очередь исходящих и один поток-писатель"""
+
+    def __init__(self, client_id, sock, on_drop=None, tracer=None, console=None):
+        self.client_id = client_id
+        self.socket = sock
+        self.tracer = tracer
+        self.console = console
+        self.queue = OutboundQueue(on_drop=on_drop)
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def send(self, data, kind=None):
+        return self.queue.put(data, kind)
+
+    def write_loop(self):
+        while True:
+            batch = self.queue.take()
+            if batch is None:
+                break
+            try:
+                # Мелкие сообщения склеиваются в один системный вызов
+                data = batch[0] if len(batch) == 1 else b"".join(batch)
+                started = time.perf_counter_ns()
+                self.socket.sendall(data)
+                if self.tracer is not None and self.tracer.enabled:
+                    self.tracer.complete("write", "net", started, time.perf_counter_ns(),
+                                         {"client": self.client_id, "bytes": len(data), "messages": len(batch)})
+            except OSError:
+                if self.console is not None:
+                    self.console.log("Ошибка отправки сообщения клиенту {}: соединение потеряно.", self.client_id)
+                self.queue.close(discard=True)
+                break
+        self.shutdown()
+
+    def shutdown(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+    def close(self):
+        """Закрывает соединение после отправки уже поставленных сообщений"""
+        self.queue.close()
+
+    def abort(self):
+        """Немедленный разрыв: очередь отбрасывается, заблокированная отправка прерывается"""
+        self.queue.close(discard=True)
+        self.shutdown()
+
+
+class AsyncClientConnection:
+    """Соединение клиента в асинхронном режиме: очередь исходящих разбирает одна задача event loop"""
+
+    def __init__(self, loop, client_id, writer, on_drop=None, tracer=None, console=None):
+        self.loop = loop
+        self.client_id = client_id
+        self.writer = writer
+        self.tracer = tracer
+        self.console = console
+        self.ready = asyncio.Event()
+        self.queue = OutboundQueue(on_drop=on_drop, on_ready=lambda: self.loop.call_soon_threadsafe(self.ready.set))
+        self.task = loop.create_task(self.write_loop())
+
+    def send(self, data, kind=None):
+        # Можно вызывать из любого потока
+        return self.queue.put(data, kind)
+
+    async def write_loop(self):
+        try:
+            while True:
+                batch = self.queue.take_nowait()
+                if batch is None:
+                    break
+                if not batch:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                data = b"".join(batch)
+                started = time.perf_counter_ns()
+                self.writer.write(data)
+                await self.writer.drain()
+                if self.tracer is not None and self.tracer.enabled:
+                    self.tracer.complete("write", "net", started, time.perf_counter_ns(),
+                                         {"client": self.client_id, "bytes": len(data), "messages": len(batch)})
+        except (ConnectionError, OSError):
+            if self.console is not None:
+                self.console.log("Ошибка отправки сообщения клиенту {}: соединение потеряно.", self.client_id)
+            self.queue.close(discard=True)
+        self.writer.close()
+
+    def close(self):
+        self.queue.close()
+
+    def abort(self):
+        self.queue.close(discard=True)
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+
+class DetachedConnection:
+    """Место соединения сессии, ожидающей возобновления: сообщения копятся в очереди без сокета.
+
+    Телеметрия, как и в обычной очереди, вытесняет более старую того же вида; при
+    переполнении send возвращает False и сессия завершается. При возобновлении
+    накопленное отправляется в новое соединение, если кодек не изменился.
+    """
+
+    def __init__(self, client_id, codec, on_drop=None, high_water=4 * 1024 * 1024):
+        self.client_id = client_id
+        self.codec = codec  # накопленные сообщения уже закодированы
+        self.since = time.monotonic()
+        self.queue = OutboundQueue(high_water=high_water, on_drop=on_drop)
+
+    def send(self, data, kind=None):
+        return self.queue.put(data, kind)
+
+    def take_all(self):
+        """Забирает накопленные сообщения и закрывает очередь"""
+        with self.queue.cond:
+            held = [data for data, _ in self.queue.items]
+        self.queue.close(discard=True)
+        return held
+
+    def close(self):
+        self.queue.close(discard=True)
+
+    def abort(self):
+        self.close()
+
+
+class InstrumentedLock:
+    """threading.Lock с учётом конкуренции: сколько ждали захвата и сколько держали (нс).
+
+    Счётчики меняются только владельцем блокировки, поэтому своей синхронизации не нужно.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired_at = 0
+        self.stats = {"acquired": 0, "contended": 0, "wait_ns": 0, "max_wait_ns": 0, "hold_ns": 0, "max_hold_ns": 0}
+
+    def __enter__(self):
+        wait = 0
+        if not self.lock.acquire(False):
+            started = time.perf_counter_ns()
+            self.lock.acquire()
+            wait = time.perf_counter_ns() - started
+        stats = self.stats
+        stats["acquired"] += 1
+        if wait:
+            stats["contended"] += 1
+            stats["wait_ns"] += wait
+            stats["max_wait_ns"] = max(stats["max_wait_ns"], wait)
+        self.acquired_at = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        held = time.perf_counter_ns() - self.acquired_at
+        stats = self.stats
+        stats["hold_ns"] += held
+        stats["max_hold_ns"] = max(stats["max_hold_ns"], held)
+        self.lock.release()
+
+    def summary(self):
+        return dict(self.stats)
+
+
+class SnapshotDict:
+    """Словарь copy-on-write для таблиц, которые меняются редко (подключение, отключение), а читаются постоянно.
+
+    Запись копирует словарь под блокировкой и подменяет его целиком, чтение и обход
+    идут по текущему снимку без блокировок: обходящий никогда не видит изменяющийся
+    словарь, и копировать ключи перед циклом не нужно.
+    """
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def keys(self):
+        return self.data.keys()
+
+    def values(self):
+        return self.data.values()
+
+    def items(self):
+        return self.data.items()
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            data = dict(self.data)
+            data[key] = value
+            self.data = data
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self.data:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            data = dict(self.data)
+            value = data.pop(key)
+            self.data = data
+        return value
+
+    def update(self, key, fn):
+        """Атомарно заменяет значение на fn(текущее или None); None удаляет ключ.
+
+        Для вложенных коллекций: fn строит новую, опубликованную никто не меняет.
+        """
+        with self.lock:
+            data = dict(self.data)
+            value = fn(data.get(key))
+            if value is None:
+                data.pop(key, None)
+            else:
+                data[key] = value
+            self.data = data
+        return value
+
+
+class ConsoleLog:
+    """Журнал в консоль из фонового потока с ограничением частоты.
+
+    log() не ждёт консоль: строка с аргументами кладётся в очередь и форматируется уже
+    в потоке вывода. Строки сверх rate в секунду (или сверх capacity в очереди)
+    отбрасываются, о пропуске выводится одна сводная строка. С quiet строки только
+    считаются (сервер внутри бенчмарков не пишет в их вывод).
+    """
+
+    def __init__(self, rate=20.0, capacity=1000, quiet=False):
+        self.rate = rate
+        self.capacity = capacity
+        self.quiet = quiet
+        self.items = deque()  # [(шаблон, аргументы)]
+        self.allowance = rate  # сколько строк можно вывести прямо сейчас (token bucket)
+        self.last = time.monotonic()
+        self.unreported = 0  # отброшено с последней сводки
+        self.cond = threading.Condition()
+        self.stats = {"logged": 0, "printed": 0, "suppressed": 0}
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def log(self, message, *args):
+        """message - шаблон str.format, если переданы args"""
+        with self.cond:
+            self.stats["logged"] += 1
+            if self.quiet:
+                return
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            if self.allowance < 1 or len(self.items) >= self.capacity:
+                self.stats["suppressed"] += 1
+                self.unreported += 1
+                return
+            self.allowance -= 1
+            self.items.append((message, args))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.items:
+                    self.cond.wait(1.0)
+                items, self.items = self.items, deque()
+                suppressed, self.unreported = self.unreported, 0
+            for message, args in items:
+                print(message.format(*args) if args else message)
+            if suppressed:
+                print(f"🔇 Журнал: пропущено {suppressed} строк (не больше {self.rate:g} в секунду)")
+            with self.cond:
+                self.stats["printed"] += len(items)
+
+
+class TraceRecorder:
+    """Трассировка в формате Chrome trace-event (chrome://tracing, ui.perfetto.dev).
+
+    Пока трассировка выключена, span() возвращает пустой контекст, а остальные точки
+    проверяют только флаг enabled. События копятся в ограниченной очереди и пишутся
+    в файл при stop().
+    """
+
+    NULL_SPAN = contextlib.nullcontext()
+
+    def __init__(self, max_events=1_000_000):
+        self.enabled = False
+        self.path = None
+        self.events = deque(maxlen=max_events)
+        self.pid = os.getpid()
+        self.origin_ns = time.perf_counter_ns()
+
+    def start(self, path):
+        self.events.clear()
+        self.path = path
+        self.enabled = True
+
+    def stop(self):
+        """Записывает трассу, возвращает (путь, число событий)"""
+        self.enabled = False
+        events = list(self.events)
+        self.events.clear()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        events += [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": names[tid]}}
+                   for tid in {event["tid"] for event in events} if tid in names]
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return self.path, len(events)
+
+    def complete(self, name, category, started_ns, finished_ns, args=None):
+        """Событие длительностью от started_ns до finished_ns (time.perf_counter_ns)"""
+        event = {"name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": threading.get_ident(),
+                 "ts": (started_ns - self.origin_ns) / 1000, "dur": (finished_ns - started_ns) / 1000}
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    def span(self, name, category, args=None):
+        return self.traced_span(name, category, args) if self.enabled else self.NULL_SPAN
+
+    @contextlib.contextmanager
+    def traced_span(self, name, category, args):
+        started = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.complete(name, category, started, time.perf_counter_ns(), args)
+
+    def decode(self, client_id, decoder):
+        """Команды из буфера декодера, разбор каждой - отдельное событие decode"""
+        while True:
+            started = time.perf_counter_ns()
+            command = decoder.next_message()
+            if command is None:
+                return
+            self.complete("decode", "net", started, time.perf_counter_ns(), {"client": client_id})
+            yield command
+
+
+class ActionStats:
+    """Число вызовов, ошибки и гистограмма длительности одной команды.
+
+    Корзина b - длительности до 2**b мкс, поэтому перцентили - верхние границы корзин.
+    """
+
+    BUCKETS = 25  # последняя корзина - от ~16 с
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, elapsed_ns, failed=False):
+        bucket = min(self.BUCKETS - 1, (elapsed_ns // 1000).bit_length())
+        with self.lock:
+            self.count += 1
+            self.errors += failed
+            self.total_ns += elapsed_ns
+            self.max_ns = max(self.max_ns, elapsed_ns)
+            self.buckets[bucket] += 1
+
+    def percentile(self, p):
+        """Верхняя граница корзины, в которую попадает p-й перцентиль, мс"""
+        with self.lock:
+            buckets, count = list(self.buckets), self.count
+        rank = p / 100.0 * count
+        seen = 0
+        for bucket, hits in enumerate(buckets):
+            seen += hits
+            if hits and seen >= rank:
+                return 2 ** bucket / 1000
+        return 0.0
+
+
+class CommandDispatcher:
+    """Таблица команд клиента: action -> обработчик(client_id, command) со статистикой по каждому действию"""
+
+    def __init__(self, console, tracer, on_error=None):
+        self.console = console
+        self.tracer = tracer
+        self.on_error = on_error  # on_error(client_id, action, исключение) - ответ клиенту об ошибке
+        self.handlers = {}  # {action: (обработчик, писать ли в журнал)}
+        self.stats = {}  # {action: ActionStats}
+        self.unknown = 0
+
+    def register(self, action, handler, log=True):
+        self.handlers[action] = (handler, log)
+        self.stats[action] = ActionStats()
+
+    def dispatch(self, client_id, command):
+        action = command.get("action")
+        entry = self.handlers.get(action)
+        if entry is None:
+            self.unknown += 1
+            self.console.log("Неизвестная команда от {}: {}", client_id, command)
+            return
+        handler, log = entry
+        if log:
+            self.console.log("📩 Получена команда от {}: {}", client_id, command)
+        started = time.perf_counter_ns()
+        failed = True
+        try:
+            handler(client_id, command)
+            failed = False
+        except Exception as e:
+            # Ошибка одной команды (например, без обязательного поля) не рвёт соединение клиента
+            self.console.log("❌ Команда {} от {} не выполнена: {!r}", action, client_id, e)
+            if self.on_error is not None:
+                self.on_error(client_id, action, e)
+        finally:
+            finished = time.perf_counter_ns()
+            self.stats[action].add(finished - started, failed)
+            if self.tracer.enabled:
+                self.tracer.complete(action, "dispatch", started, finished, {"client": client_id})
+
+    def summary(self):
+        """[(action, статистика)] по убыванию суммарного времени - сверху то, что нагружает сервер"""
+        rows = []
+        for action, stats in self.stats.items():
+            if not stats.count:
+                continue
+            rows.append((action, {"count": stats.count, "errors": stats.errors, "total_ms": stats.total_ns / 1e6,
+                                  "mean_ms": stats.total_ns / stats.count / 1e6, "p50_ms": stats.percentile(50),
+                                  "p99_ms": stats.percentile(99), "max_ms": stats.max_ns / 1e6}))
+        return sorted(rows, key=lambda row: row[1]["total_ms"], reverse=True)
+
+
+class VehicleRecord:
+    """Запись о машине на сервере (__slots__ вместо словаря на каждую машину)"""
+
+    __slots__ = ("vehicle", "id", "actor_id", "shard", "owner", "control_mode", "spawn_point", "tm_port")
+
+    def __init__(self, vehicle, shard, owner=None, control_mode="autopilot", spawn_point=None):
+        self.vehicle = vehicle
+        self.actor_id = vehicle.id  # id актора внутри своего экземпляра CARLA
+        self.id = shard.vehicle_id(vehicle.id)  # id машины на сервере, уникальный между шардами
+        self.shard = shard
+        self.owner = owner
+        self.control_mode = control_mode
+        self.spawn_point = spawn_point
+        self.tm_port = shard.tm_port  # Traffic Manager автопилота (в режиме большого парка - парковый или детальный)
+
+
+class SpawnPointAllocator:
+    """Общий для всех клиентов учёт свободных точек спавна"""
+
+    def __init__(self, spawn_points):
+        self.spawn_points = spawn_points
+        self.free = deque(range(len(spawn_points)))
+        self.taken = set()  # выданные индексы: повторный или устаревший release не дублирует точку
+        self.lock = threading.Lock()
+
+    def acquire(self, count):
+        """Выдаёт до count индексов свободных точек, не пересекающихся с уже выданными"""
+        with self.lock:
+            indices = [self.free.popleft() for _ in range(min(count, len(self.free)))]
+            self.taken.update(indices)
+            return indices
+
+    def release(self, indices):
+        """Возвращает точки в конец очереди (занятые чужими акторами попробуем позже)"""
+        with self.lock:
+            for i in indices:
+                if i in self.taken:
+                    self.taken.discard(i)
+                    self.free.append(i)
+
+    def reset(self, spawn_points):
+        """Новая карта: все точки свободны, индексы машин старой карты больше не принимаются"""
+        with self.lock:
+            self.spawn_points = spawn_points
+            self.free = deque(range(len(spawn_points)))
+            self.taken = set()
+
+    def available(self):
+        return len(self.free)
+
+    def in_use(self):
+        return len(self.taken)
+
+
+class WorldSnapshotCache:
+    """Состояние всех акторов на текущий тик симуляции в массивах NumPy (один проход на тик)"""
+
+    def __init__(self, world):
+        self.world = world
+        self.lock = threading.Lock()
+        self.snapshot = None  # последний WorldSnapshot из on_tick
+        self.tick_seconds = 0.0  # сглаженный интервал между тиками по часам симулятора
+        self.ticked = threading.Event()  # будит поток записи телеметрии
+        # (кадр, отсортированные id, позиции Nx3, yaw, скорости Nx3, модули скоростей)
+        self.state = (None, np.empty(0, dtype=np.int64), np.empty((0, 3)), np.empty(0), np.empty((0, 3)), np.empty(0))
+        self.callback_id = world.on_tick(self.on_tick)
+
+    def close(self):
+        try:
+            self.world.remove_on_tick(self.callback_id)
+        except Exception:
+            pass  # эпизод уже сменился, колбэк удалён вместе с ним
+
+    def on_tick(self, snapshot):
+        # Вызывается из потока CARLA, только сохраняем ссылку - массивы строятся по запросу
+        previous, self.snapshot = self.snapshot, snapshot
+        if previous is not None and snapshot.frame > previous.frame:
+            interval = ((snapshot.timestamp.platform_timestamp - previous.timestamp.platform_timestamp)
+                        / (snapshot.frame - previous.frame))
+            self.tick_seconds = interval if not self.tick_seconds else self.tick_seconds + 0.1 * (interval - self.tick_seconds)
+        self.ticked.set()
+
+    def actor_count(self):
+        """Число акторов в последнем тике (без RPC)"""
+        snapshot = self.snapshot
+        return len(snapshot) if snapshot is not None else 0
+
+    def refresh(self):
+        """Строит массивы для последнего тика, если это ещё не сделано"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            snapshot = self.world.get_snapshot()
+        if snapshot.frame == self.state[0]:
+            return self.state
+        with self.lock:
+            if snapshot.frame == self.state[0]:
+                return self.state
+            actors = list(snapshot)
+            ids = np.fromiter((actor.id for actor in actors), dtype=np.int64, count=len(actors))
+            data = np.empty((len(actors), 7))
+            for row, actor in enumerate(actors):
+                transform = actor.get_transform()
+                velocity = actor.get_velocity()
+                data[row] = (transform.location.x, transform.location.y, transform.location.z,
+                             transform.rotation.yaw, velocity.x, velocity.y, velocity.z)
+            order = np.argsort(ids)
+            data = data[order]
+            velocities = data[:, 4:7]
+            self.state = (snapshot.frame, ids[order], data[:, 0:3], data[:, 3], velocities,
+                          np.sqrt(np.einsum("ij,ij->i", velocities, velocities)))
+            return self.state
+
+    def vehicle_states(self, actor_ids):
+        """Возвращает (найден ли актор в тике, позиции, yaw, модули скоростей) для списка id"""
+        _, ids, locations, yaws, _, speeds = self.refresh()
+        query = np.asarray(actor_ids, dtype=np.int64)
+        if not len(ids):
+            return np.zeros(len(query), dtype=bool), np.zeros((len(query), 3)), np.zeros(len(query)), np.zeros(len(query))
+        rows = np.minimum(np.searchsorted(ids, query), len(ids) - 1)
+        alive = ids[rows] == query
+        return alive, locations[rows], yaws[rows], speeds[rows]
+
+
+class WorldMetadata:
+    """Метаданные одной карты CARLA: чертежи, точки спавна, топология и точки дорог.
+
+    После world.get_map() OpenDRIVE уже у сервера, поэтому топология и точки дорог
+    считаются локально и только при первом запросе. version - хэш имени карты, точек
+    спавна и чертежей: клиент с той же версией может не скачивать метаданные заново.
+    """
+
+    def __init__(self, world, carla_map, library):
+        self.world = world
+        self.episode_id = world.id
+        self.map = carla_map
+        self.map_name = carla_map.name
+        self.library = library
+        self.spawn_points = carla_map.get_spawn_points()
+        self.filters = {}  # {шаблон: [чертежи]}, filter перебирает всю библиотеку
+        self.topology = None  # [x1, y1, x2, y2, ...] отрезков дорог
+        self.road_points = {}  # {шаг: [x, y, ...]} для мини-карт клиентов
+        self.payload = None  # поля ответа map_info
+        self.lock = threading.Lock()
+        digest = hashlib.blake2b(self.map_name.encode(), digest_size=8)
+        for point in self.spawn_points:
+            digest.update(struct.pack("<4d", point.location.x, point.location.y, point.location.z, point.rotation.yaw))
+        digest.update(",".join(sorted(blueprint.id for blueprint in library)).encode())
+        self.version = digest.hexdigest()
+
+    def for_episode(self, world):
+        """Тот же мир после reload_world: карта и всё посчитанное по ней остаются"""
+        metadata = copy.copy(self)
+        metadata.world, metadata.episode_id = world, world.id
+        return metadata
+
+    def blueprints(self, pattern):
+        blueprints = self.filters.get(pattern)
+        if blueprints is None:
+            blueprints = self.filters[pattern] = list(self.library.filter(pattern))
+        return blueprints
+
+    def get_topology(self):
+        with self.lock:
+            if self.topology is None:
+                segments = np.array([(start.transform.location.x, start.transform.location.y,
+                                      end.transform.location.x, end.transform.location.y)
+                                     for start, end in self.map.get_topology()]).reshape(-1, 4)
+                self.topology = np.round(segments, 1).ravel().tolist()
+            return self.topology
+
+    def get_road_points(self, spacing=2.0):
+        with self.lock:
+            points = self.road_points.get(spacing)
+            if points is None:
+                points = np.array([(wp.transform.location.x, wp.transform.location.y)
+                                   for wp in self.map.generate_waypoints(spacing)]).reshape(-1, 2)
+                points = self.road_points[spacing] = np.round(points, 1).ravel().tolist()
+            return points
+
+    def describe(self):
+        """Поля map_info: точки спавна [x, y, z, yaw, ...], отрезки дорог и чертежи машин"""
+        if self.payload is None:
+            spawn_points = np.array([(point.location.x, point.location.y, point.location.z, point.rotation.yaw)
+                                     for point in self.spawn_points]).reshape(-1, 4)
+            self.payload = {"spawn_points": np.round(spawn_points, 2).ravel().tolist(),
+                            "topology": self.get_topology(),
+                            "blueprints": [blueprint.id for blueprint in self.blueprints("vehicle.*")]}
+        return self.payload
+
+
+class WorldMetadataCache:
+    """Кэш метаданных мира шарда с проверкой смены карты.
+
+    get_map() передаёт по RPC весь OpenDRIVE карты, поэтому метаданные загружаются один раз.
+    Смена эпизода проверяется по world.id (короткий RPC get_world, не чаще check_interval
+    секунд); карта перечитывается, только если сменилось её имя.
+    """
+
+    def __init__(self, client, check_interval=1.0):
+        self.client = client
+        self.check_interval = check_interval
+        self.metadata = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "checks": 0, "loads": 0, "episodes": 0, "load_ms": 0.0}
+
+    def current(self):
+        """Метаданные текущей карты (без RPC, пока не пришло время проверки)"""
+        metadata = self.metadata
+        if metadata is not None and time.monotonic() - self.checked < self.check_interval:
+            self.stats["hits"] += 1
+            return metadata
+        with self.lock:
+            if self.metadata is not None and time.monotonic() - self.checked < self.check_interval:
+                return self.metadata
+            world = self.client.get_world()
+            self.checked = time.monotonic()
+            self.stats["checks"] += 1
+            if self.metadata is None or world.id != self.metadata.episode_id:
+                self.metadata = self.load(world)
+            return self.metadata
+
+    def load(self, world):
+        started = time.perf_counter()
+        carla_map = world.get_map()
+        previous = self.metadata
+        if previous is not None and carla_map.name == previous.map_name:
+            metadata = previous.for_episode(world)
+        else:
+            metadata = WorldMetadata(world, carla_map, world.get_blueprint_library())
+            self.stats["loads"] += 1
+        self.stats["episodes"] += 1
+        self.stats["load_ms"] += (time.perf_counter() - started) * 1000
+        return metadata
+
+    def invalidate(self):
+        """Следующий current() перечитает карту и чертежи"""
+        with self.lock:
+            self.metadata = None
+
+
+class CarlaShard:
+    """Один экземпляр CARLA: клиент, мир, точки спавна и кэш тика"""
+
+    ID_STRIDE = 10 ** 9  # id машины на сервере = номер шарда * ID_STRIDE + id актора
+    DETAIL_TM_OFFSET = 100  # детальный Traffic Manager режима большого парка: tm_port + 100
+
+    def __init__(self, index, host, port, tm_port, timeout=10.0):
+        self.index = index
+        self.name = f"{host}:{port}"
+        self.tm_port = tm_port
+        self.detail_tm_port = tm_port + self.DETAIL_TM_OFFSET
+        self.client = carla.Client(host, port)
+        self.client.set_timeout(timeout)
+        self.metadata = WorldMetadataCache(self.client)
+        metadata = self.metadata.current()
+        self.world = metadata.world
+        self.spawn_allocator = SpawnPointAllocator(metadata.spawn_points)
+        self.snapshot_cache = WorldSnapshotCache(self.world)
+        self.world_lock = threading.Lock()
+
+    def vehicle_id(self, actor_id):
+        return self.index * self.ID_STRIDE + actor_id
+
+    def load(self):
+        """Оценка загрузки для размещения машин: акторы, взвешенные длительностью тика"""
+        # Только что выданные точки спавна попадут в снимок лишь на следующем тике
+        actors = max(self.snapshot_cache.actor_count(), self.spawn_allocator.in_use())
+        return (actors + 1) * max(self.snapshot_cache.tick_seconds, 0.001)
+
+    def get_road_points(self, spacing=2.0):
+        """(имя карты, точки дорог), считаются один раз на карту"""
+        metadata = self.metadata.current()
+        return metadata.map_name, metadata.get_road_points(spacing)
+
+    def refresh_world(self):
+        """Сверяет эпизод CARLA с кэшем метаданных.
+
+        После load_world/reload_world акторы старого эпизода исчезли: мир, кэш тика и
+        точки спавна заменяются. Возвращает метаданные нового эпизода или None, если он не сменился.
+        """
+        metadata = self.metadata.current()
+        if metadata.world is self.world:
+            return None
+        with self.world_lock:
+            if metadata.world is self.world:
+                return None
+            previous = self.snapshot_cache
+            self.world = metadata.world
+            self.snapshot_cache = WorldSnapshotCache(self.world)
+            previous.close()
+            self.spawn_allocator.reset(metadata.spawn_points)
+        return metadata
+
+
+def parse_carla_endpoint(endpoint, index, base_tm_port=8000):
+    """'host:port[:tm_port]' -> (host, port, tm_port); Traffic Manager у каждого шарда на своём порту"""
+    parts = endpoint.split(":")
+    host = parts[0] or "localhost"
+    port = int(parts[1]) if len(parts) > 1 else 2000
+    tm_port = int(parts[2]) if len(parts) > 2 else base_tm_port + index
+    return host, port, tm_port
+
+
+class MetricSeries:
+    """Временной ряд метрик клиента в кольцевом буфере фиксированного размера"""
+
+    def __init__(self, capacity=120):
+        self.capacity = capacity
+        self.times = np.zeros(capacity)
+        self.values = {}  # {метрика: np.array(capacity)}
+        self.latest = {}  # последние значения (клиент присылает только изменения)
+        self.pos = 0
+        self.count = 0
+
+    def append(self, timestamp, sample):
+        self.latest.update(sample)
+        for name, value in self.latest.items():
+            if name not in self.values:
+                self.values[name] = np.full(self.capacity, np.nan)
+            self.values[name][self.pos] = value
+        self.times[self.pos] = timestamp
+        self.pos = (self.pos + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def recent(self, name, seconds=60.0):
+        """Значения метрики за последние seconds секунд"""
+        if name not in self.values or not self.count:
+            return np.empty(0)
+        mask = self.times > time.time() - seconds
+        if self.count < self.capacity:
+            mask[self.count:] = False
+        values = self.values[name][mask]
+        return values[~np.isnan(values)]
+
+    def trend(self, name, seconds=60.0):
+        """(последнее значение, среднее за окно, стрелка направления)"""
+        latest = self.latest.get(name)
+        values = self.recent(name, seconds)
+        if latest is None or not len(values):
+            return latest, latest, ""
+        mean = float(values.mean())
+        arrow = "↑" if latest > mean * 1.05 else "↓" if latest < mean * 0.95 else "→"
+        return latest, mean, arrow
+
+
+class TickCoordinator:
+    """Синхронный режим: сервер сам вызывает world.tick() с фиксированным шагом.
+
+    Управление от всех клиентов за окно тика собирается (последняя команда на машину
+    побеждает) и применяется одним apply_batch на шард перед tick, шарды тикают
+    параллельно. После тика клиентам, подписанным на тики, рассылается номер тика.
+
+    Вне синхронного режима то же окно работает без тика: поток flush_loop применяет
+    накопленное управление сразу, а всё, что пришло во время вызова apply_batch,
+    уходит следующим пакетом.
+    """
+
+    def __init__(self, server, fixed_delta=0.05):
+        self.server = server
+        self.fixed_delta = fixed_delta
+        self.lock = threading.Lock()
+        self.pending = {}  # {vehicle_id: (client_id, VehicleRecord, VehicleControl, отключить автопилот)}
+        self.late_clients = set()  # клиенты, чьё управление опоздало к своему тику
+        self.tick_id = 0
+        self.frame = None
+        self.running = False
+        self.thread = None
+        self.original_settings = {}  # {шард: WorldSettings до включения синхронного режима}
+        self.history = deque(maxlen=200)  # статистика последних тиков
+        self.ready = threading.Event()  # есть управление для flush_loop
+        self.apply_lock = threading.Lock()  # применение управления и перевод машин между Traffic Manager'ами
+        self.control_stats = {"submitted": 0, "coalesced": 0, "batches": 0, "applied": 0}
+
+    def enable(self):
+        if self.running:
+            return
+
+        def enable_shard(shard):
+            self.original_settings[shard] = shard.world.get_settings()
+            settings = shard.world.get_settings()
+            settings.synchronous_mode = True
+            settings.fixed_delta_seconds = self.fixed_delta
+            shard.world.apply_settings(settings)
+            # Traffic Manager должен идти в такт с сервером, иначе автопилот рассинхронизируется
+            for tm_port in self.server.fleet.tm_ports(shard):
+                shard.client.get_trafficmanager(tm_port).set_synchronous_mode(True)
+
+        self.server.map_shards(enable_shard)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print(f"⏱️ Синхронный режим включён (шаг {self.fixed_delta * 1000:.0f} мс)")
+
+    def disable(self):
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+
+        def disable_shard(shard):
+            for tm_port in self.server.fleet.tm_ports(shard):
+                shard.client.get_trafficmanager(tm_port).set_synchronous_mode(False)
+            shard.world.apply_settings(self.original_settings.pop(shard))
+
+        self.server.map_shards(disable_shard)
+        print("⏱️ Синхронный режим выключен")
+        self.ready.set()  # управление, пришедшее после последнего тика, применит flush_loop
+
+    def submit(self, client_id, record, control, disable_autopilot=False, tick_id=None):
+        """Принимает управление до следующего тика; tick_id - тик, к которому клиент его готовил"""
+        with self.lock:
+            if tick_id is not None and tick_id <= self.tick_id:
+                self.late_clients.add(client_id)
+            previous = self.pending.get(record.id)
+            self.pending[record.id] = (client_id, record, control,
+                                       disable_autopilot or (previous is not None and previous[3]))
+            self.control_stats["submitted"] += 1
+            if previous is not None:
+                self.control_stats["coalesced"] += 1
+        if not self.running:
+            self.ready.set()
+
+    def discard(self, vehicle_id):
+        """Забывает неприменённое управление машиной (например, перед возвратом автопилота)"""
+        with self.lock:
+            self.pending.pop(vehicle_id, None)
+
+    def apply_pending(self):
+        """Применяет всё накопленное управление одним apply_batch на шард, возвращает число машин"""
+        with self.apply_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return 0
+            ApplyVehicleControl = carla.command.ApplyVehicleControl
+            SetAutopilot = carla.command.SetAutopilot
+            commands = {}  # {шард: [команды]}
+            for _, record, control, disable_autopilot in pending.values():
+                shard_commands = commands.setdefault(record.shard, [])
+                if disable_autopilot:
+                    shard_commands.append(SetAutopilot(record.actor_id, False, record.tm_port))
+                shard_commands.append(ApplyVehicleControl(record.actor_id, control))
+
+            def apply_on_shard(shard):
+                with self.server.tracer.span("apply_batch", "rpc", {"shard": shard.name, "commands": len(commands[shard])}):
+                    shard.client.apply_batch(commands[shard])
+
+            self.server.map_shards(apply_on_shard, list(commands))
+        self.control_stats["batches"] += len(commands)
+        self.control_stats["applied"] += len(pending)
+        return len(pending)
+
+    def flush_loop(self):
+        """Асинхронный режим мира: управление применяется пакетами без ожидания тика"""
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            if self.running:
+                continue  # в синхронном режиме управление применяет run() перед тиком
+            try:
+                self.apply_pending()
+            except Exception as e:
+                self.server.console.log("❌ Ошибка применения управления: {}", e)
+
+    def run(self):
+        next_tick = time.perf_counter()
+        while self.running:
+            started = time.perf_counter()
+            with self.lock:
+                late, self.late_clients = self.late_clients, set()
+            try:
+                batch = self.apply_pending()
+                frame = self.server.map_shards(self.tick_shard)[0]
+            except Exception as e:
+                self.server.console.log("❌ Ошибка тика: {}", e)
+                time.sleep(self.fixed_delta)
+                continue
+            with self.lock:
+                self.tick_id += 1
+                tick_id = self.tick_id
+            self.frame = frame
+            duration = time.perf_counter() - started
+            self.history.append({"tick_id": tick_id, "frame": frame, "duration_ms": duration * 1000,
+                                 "batch": batch, "late": sorted(late)})
+            if duration > self.fixed_delta:
+                self.server.console.log("⚠️ Тик {} занял {:.1f} мс (шаг {:.0f} мс)", tick_id, duration * 1000,
+                                        self.fixed_delta * 1000)
+            self.server.broadcast_tick(tick_id, frame)
+
+            # Держим темп реального времени, если симулятор успевает
+            next_tick = max(next_tick + self.fixed_delta, time.perf_counter())
+            time.sleep(max(0.0, next_tick - time.perf_counter()))
+
+    def tick_shard(self, shard):
+        with self.server.tracer.span("world.tick", "rpc", {"shard": shard.name}):
+            return shard.world.tick()
+
+    def stats(self):
+        ticks = list(self.history)
+        if not ticks:
+            return None
+        durations = [t["duration_ms"] for t in ticks]
+        return {
+            "ticks": len(ticks),
+            "last_tick": ticks[-1]["tick_id"],
+            "mean_ms": sum(durations) / len(durations),
+            "max_ms": max(durations),
+            "mean_batch": sum(t["batch"] for t in ticks) / len(ticks),
+            "max_batch": max(t["batch"] for t in ticks),
+            "late": sorted({client_id for t in ticks for client_id in t["late"]}),
+        }
+
+
+class FleetLOD:
+    """Режим большого парка: гибридная физика Traffic Manager и уровни детализации машин.
+
+    Автопилот машин шарда идёт в «парковом» Traffic Manager (tm_port) с гибридной физикой:
+    он выключает машинам физику и ведёт их по полосам переносом, а уснувшие машины
+    больших карт возрождает вокруг героя. Героя CARLA узнаёт только по role_name при
+    спавне, а машины сервера становятся ручными или получают камеру позже, поэтому
+    радиус полной физики сервер держит сам: раз в interval секунд машины автопилота
+    ближе radius к машине с ручным управлением или камерой переводятся в «детальный»
+    Traffic Manager (detail_tm_port, физика включена), дальние возвращаются в парковый.
+
+    Независимо от режима поток раз в interval секунд записывает FPS симулятора и число
+    акторов - так видно, сколько машин выдерживает каждый режим.
+    """
+
+    def __init__(self, server, radius=70.0, interval=0.5, respawn_dormant=True, respawn_bounds=(25.0, 700.0)):
+        self.server = server
+        self.radius = radius  # м вокруг машин с ручным управлением или камерой
+        self.interval = interval
+        self.respawn_dormant = respawn_dormant
+        self.respawn_bounds = respawn_bounds  # (мин., макс.) расстояние возрождения от героя, м
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.samples = {}  # {режим: {акторов до 2^k: [замеров, сумма FPS, мин. FPS]}}
+        self.stats = {"passes": 0, "promoted": 0, "demoted": 0, "focus": 0, "detail": 0, "fleet": 0, "last_ms": 0.0}
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def mode(self):
+        return "large_fleet" if self.enabled else "default"
+
+    def tm_ports(self, shard):
+        """Traffic Manager'ы шарда, которые должны идти в такт синхронному режиму"""
+        return [shard.tm_port, shard.detail_tm_port] if self.enabled else [shard.tm_port]
+
+    def configure_shard(self, shard, enabled):
+        fleet = shard.client.get_trafficmanager(shard.tm_port)
+        fleet.set_hybrid_physics_mode(enabled)
+        fleet.set_hybrid_physics_radius(self.radius)
+        if self.respawn_dormant:
+            fleet.set_respawn_dormant_vehicles(enabled)
+            fleet.set_boundaries_respawn_dormant_vehicles(*self.respawn_bounds)
+        detail = shard.client.get_trafficmanager(shard.detail_tm_port)
+        detail.set_hybrid_physics_mode(False)
+        detail.set_synchronous_mode(enabled and self.server.tick_coordinator.running)
+
+    def enable(self):
+        with self.lock:
+            if self.enabled:
+                return
+            self.server.map_shards(lambda shard: self.configure_shard(shard, True))
+            self.enabled = True
+        self.update()
+        print(f"🚦 Режим большого парка включён: гибридная физика, полная физика в радиусе {self.radius:.0f} м "
+              f"от машин с ручным управлением или камерой")
+
+    def disable(self):
+        with self.lock:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self.apply_moves({record: record.shard.tm_port for record in list(self.server.vehicle_index.values())
+                              if record.control_mode == "autopilot" and record.tm_port != record.shard.tm_port})
+            self.server.map_shards(lambda shard: self.configure_shard(shard, False))
+        print("🚦 Режим большого парка выключен: вся физика снова полная")
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+                if self.enabled:
+                    self.update()
+            except Exception as e:
+                self.server.console.log("❌ Ошибка обновления детализации машин: {}", e)
+
+    def sample(self):
+        """FPS симулятора и число акторов по всем шардам в статистику текущего режима"""
+        shards = [shard for shard in self.server.shards if shard.snapshot_cache.tick_seconds]
+        if not shards:
+            return
+        actors = sum(shard.snapshot_cache.actor_count() for shard in shards)
+        fps = min(1.0 / shard.snapshot_cache.tick_seconds for shard in shards)  # шарды тикают вместе - по самому медленному
+        bucket = 1 << max(0, actors - 1).bit_length()
+        with self.lock:
+            entry = self.samples.setdefault(self.mode(), {}).setdefault(bucket, [0, 0.0, fps])
+            entry[0] += 1
+            entry[1] += fps
+            entry[2] = min(entry[2], fps)
+
+    def update(self):
+        """Один проход: какие машины автопилота должны быть в детальном Traffic Manager"""
+        started = time.perf_counter()
+        focus_ids = {stream.record.id for streams in self.server.video_streams.values() for stream in streams.values()}
+        by_shard = {}
+        for record in list(self.server.vehicle_index.values()):
+            by_shard.setdefault(record.shard, []).append(record)
+
+        def shard_moves(shard):
+            records = by_shard[shard]
+            actor_ids = np.fromiter((record.actor_id for record in records), dtype=np.int64, count=len(records))
+            alive, locations, _, _ = shard.snapshot_cache.vehicle_states(actor_ids)
+            focus = alive & np.fromiter((record.control_mode == "manual" or record.id in focus_ids for record in records),
+                                        dtype=bool, count=len(records))
+            near = np.zeros(len(records), dtype=bool)
+            if focus.any():
+                # Квадрат расстояния до ближайшей машины в фокусе: N x F, фокусных машин единицы
+                offsets = locations[:, None, :2] - locations[focus][None, :, :2]
+                near = np.einsum("ijk,ijk->ij", offsets, offsets).min(axis=1) < self.radius * self.radius
+            moves = {}
+            for record, is_alive, is_near in zip(records, alive.tolist(), near.tolist()):
+                if not is_alive or record.control_mode != "autopilot":
+                    continue
+                port = shard.detail_tm_port if is_near else shard.tm_port
+                if record.tm_port != port:
+                    moves[record] = port
+            return moves, int(focus.sum()), int(near.sum())
+
+        results = self.server.map_shards(shard_moves, list(by_shard))
+        moves = {record: port for shard_moves_, _, _ in results for record, port in shard_moves_.items()}
+        with self.lock:
+            if self.enabled:
+                self.apply_moves(moves)
+        self.stats["passes"] += 1
+        self.stats["focus"] = sum(focus for _, focus, _ in results)
+        self.stats["detail"] = sum(1 for record in list(self.server.vehicle_index.values())
+                                   if record.tm_port != record.shard.tm_port and record.control_mode == "autopilot")
+        self.stats["fleet"] = sum(len(records) for records in by_shard.values()) - self.stats["detail"]
+        self.stats["last_ms"] = (time.perf_counter() - started) * 1000
+
+    def apply_moves(self, moves):
+        """Переводит машины между Traffic Manager'ами шарда одним apply_batch на шард"""
+        if not moves:
+            return
+        SetAutopilot = carla.command.SetAutopilot
+        SetSimulatePhysics = carla.command.SetSimulatePhysics
+        commands = {}
+        # Под блокировкой управления: машину, которую как раз берут под ручное управление, не перехватим
+        with self.server.tick_coordinator.apply_lock:
+            for record, port in moves.items():
+                if record.control_mode != "autopilot":
+                    continue
+                shard_commands = commands.setdefault(record.shard, [])
+                shard_commands += [SetAutopilot(record.actor_id, False, record.tm_port),
+                                   SetAutopilot(record.actor_id, True, port)]
+                if port != record.shard.tm_port:
+                    shard_commands.append(SetSimulatePhysics(record.actor_id, True))  # гибридный режим её выключил
+                    self.stats["promoted"] += 1
+                else:
+                    self.stats["demoted"] += 1
+                record.tm_port = port
+
+            def apply_on_shard(shard):
+                with self.server.tracer.span("lod", "rpc", {"shard": shard.name, "commands": len(commands[shard])}):
+                    shard.client.apply_batch(commands[shard])
+
+            self.server.map_shards(apply_on_shard, list(commands))
+
+
+class TeardownScheduler:
+    """Отложенное отключение клиентов: таймер ожидания и пакетное уничтожение машин в фоновом потоке"""
+
+    def __init__(self, server, grace_period=5.0):
+        self.server = server
+        self.grace_period = grace_period
+        self.timers = []  # куча (срок, client_id)
+        self.pending = {}  # {client_id: срок}
+        self.destroy_queue = []  # [(время постановки, машина)]
+        self.cond = threading.Condition()
+        self.stats = {"scheduled": 0, "cancelled": 0, "completed": 0, "destroyed": 0, "failed": 0, "batches": 0,
+                      "last_batch_ms": 0.0, "max_batch_ms": 0.0, "max_delay_ms": 0.0}
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, client_id, delay=None):
+        """Ставит клиента в очередь на отключение, False если он уже в очереди"""
+        deadline = time.monotonic() + (self.grace_period if delay is None else delay)
+        with self.cond:
+            if client_id in self.pending:
+                return False
+            self.pending[client_id] = deadline
+            heapq.heappush(self.timers, (deadline, client_id))
+            self.stats["scheduled"] += 1
+            self.cond.notify()
+        return True
+
+    def cancel(self, client_id):
+        """Снимает клиента с очереди на отключение; False - его нет в очереди или отключение уже идёт"""
+        with self.cond:
+            if self.pending.pop(client_id, None) is None:
+                return False
+            self.stats["cancelled"] += 1
+        return True
+
+    def destroy(self, records):
+        """Ставит машины в очередь на уничтожение без ожидания"""
+        now = time.monotonic()
+        with self.cond:
+            self.destroy_queue.extend((now, record) for record in records)
+            self.cond.notify()
+
+    def queue_depth(self):
+        with self.cond:
+            return {"clients": len(self.pending), "vehicles": len(self.destroy_queue)}
+
+    def deadlines(self):
+        """Копия сроков отключения: pending меняется потоком планировщика"""
+        with self.cond:
+            return dict(self.pending)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.destroy_queue and (not self.timers or self.timers[0][0] > time.monotonic()):
+                    self.cond.wait(self.timers[0][0] - time.monotonic() if self.timers else None)
+                due = []
+                while self.timers and self.timers[0][0] <= time.monotonic():
+                    deadline, client_id = heapq.heappop(self.timers)
+                    if self.pending.get(client_id) != deadline:
+                        continue  # отменён (cancel) или перепланирован
+                    del self.pending[client_id]
+                    due.append((deadline, client_id))
+                batch, self.destroy_queue = self.destroy_queue, []
+
+            # Машины клиентов с истёкшим таймером паркуются в пул, не поместившиеся уничтожаются одним пакетом
+            for deadline, client_id in due:
+                records = self.server.vehicle_pool.park(self.server.finish_client_teardown(client_id))
+                batch.extend((deadline, record) for record in records)
+            if batch:
+                self.destroy_batch(batch)
+            with self.cond:
+                self.stats["completed"] += len(due)
+
+    def destroy_batch(self, batch):
+        started = time.perf_counter()
+        destroyed, failed = self.server.destroy_vehicles([record for _, record in batch])
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        delay_ms = (time.monotonic() - min(queued for queued, _ in batch)) * 1000
+        with self.cond:
+            self.stats["destroyed"] += destroyed
+            self.stats["failed"] += failed
+            self.stats["batches"] += 1
+            self.stats["last_batch_ms"] = elapsed_ms
+            self.stats["max_batch_ms"] = max(self.stats["max_batch_ms"], elapsed_ms)
+            self.stats["max_delay_ms"] = max(self.stats["max_delay_ms"], delay_ms)
+        self.server.console.log("🧹 Уничтожено машин: {} (ошибок: {}) за {:.1f} мс", destroyed, failed, elapsed_ms)
+
+
+class SessionRegistry:
+    """Токены возобновления сессий: обрыв сети не отнимает у клиента машины.
+
+    Токен выдаётся при подключении. Если соединение оборвалось без disconnect, сессия
+    отсоединяется на grace_period: машины едут на автопилоте, сообщения копятся. Клиент,
+    подключившийся заново с токеном, получает прежний ID, машины и пропущенные сообщения.
+    """
+
+    def __init__(self, grace_period=30.0):
+        self.grace_period = grace_period  # 0 - без возобновления, обрыв = отключение
+        self.tokens = {}  # {токен: client_id}
+        self.client_tokens = {}  # {client_id: токен}
+        self.lock = threading.Lock()
+        # Отсоединение, возобновление и разрыв одной сессии не должны пересекаться; RLock - разрыв
+        # медленного клиента может случиться при отправке ответа изнутри возобновления
+        self.handover = threading.RLock()
+        self.stats = {"issued": 0, "detached": 0, "resumed": 0, "taken_over": 0, "rejected": 0, "expired": 0,
+                      "evicted": 0}
+
+    def issue(self, client_id):
+        token = secrets.token_urlsafe(16)
+        with self.lock:
+            self.tokens[token] = client_id
+            self.client_tokens[client_id] = token
+            self.stats["issued"] += 1
+        return token
+
+    def lookup(self, token):
+        with self.lock:
+            return self.tokens.get(token)
+
+    def token(self, client_id):
+        with self.lock:
+            return self.client_tokens.get(client_id)
+
+    def revoke(self, client_id):
+        """Сессия завершена: по её токену больше нельзя возобновиться"""
+        with self.lock:
+            token = self.client_tokens.pop(client_id, None)
+            if token is not None:
+                del self.tokens[token]
+        return token is not None
+
+
+class VehiclePool:
+    """Пул припаркованных машин вместо уничтожения и повторного спавна при переподключениях.
+
+    Машины отключившегося клиента паркуются: автопилот и физика выключаются, машина
+    переносится на площадку под картой, точка спавна освобождается. Следующий спавн на
+    том же шарде сначала забирает машины из пула (перенос на точку, физика, автопилот -
+    один apply_batch_sync) и только на остаток создаёт новые акторы. Сверх max_size
+    машин на шард паркуемые уничтожаются как раньше. По умолчанию пул выключен
+    (max_size 0): машины отключившихся клиентов уничтожаются, а не остаются под картой.
+    """
+
+    HOLDING_Z = -500.0  # площадка хранения под картой, м
+    HOLDING_SPACING = 10.0  # м между машинами на площадке
+    HOLDING_ROW = 100  # машин в ряду площадки
+
+    def __init__(self, server, max_size=0):
+        self.server = server
+        self.max_size = max_size  # машин на шард, 0 - пул выключен
+        self.parked = {}  # {шард: [VehicleRecord]}
+        self.slots = {}  # {шард: номер следующего места на площадке}
+        self.lock = threading.Lock()
+        self.stats = {"parked": 0, "reused": 0, "spawned": 0, "evicted": 0, "failed": 0,
+                      "reuse_ms": 0.0, "spawn_ms": 0.0}
+
+    def holding_transform(self, shard):
+        slot = self.slots.get(shard, 0)
+        self.slots[shard] = (slot + 1) % (self.HOLDING_ROW * self.HOLDING_ROW)
+        row, column = divmod(slot, self.HOLDING_ROW)
+        return carla.Transform(carla.Location(x=column * self.HOLDING_SPACING, y=row * self.HOLDING_SPACING,
+                                              z=self.HOLDING_Z))
+
+    def size(self):
+        with self.lock:
+            return {shard: len(records) for shard, records in self.parked.items()}
+
+    def park(self, records):
+        """Паркует машины в пул, возвращает те, что не поместились или не запарковались, - их нужно уничтожить"""
+        if not self.max_size or not records:
+            return records
+        accepted, rest = {}, []
+        with self.lock:
+            for record in records:
+                shard_records = accepted.setdefault(record.shard, [])
+                if len(self.parked.get(record.shard, ())) + len(shard_records) < self.max_size:
+                    shard_records.append(record)
+                else:
+                    rest.append(record)
+            transforms = {shard: [self.holding_transform(shard) for _ in shard_records]
+                          for shard, shard_records in accepted.items()}
+            self.stats["evicted"] += len(rest)
+        SetAutopilot = carla.command.SetAutopilot
+        SetSimulatePhysics = carla.command.SetSimulatePhysics
+        ApplyTransform = carla.command.ApplyTransform
+
+        def park_on_shard(shard):
+            shard_records = accepted[shard]
+            batch = []
+            for record, transform in zip(shard_records, transforms[shard]):
+                self.server.tick_coordinator.discard(record.id)
+                batch += [SetAutopilot(record.actor_id, False, record.tm_port),
+                          SetSimulatePhysics(record.actor_id, False), ApplyTransform(record.actor_id, transform)]
+            try:
+                with self.server.tracer.span("park", "rpc", {"shard": shard.name, "vehicles": len(shard_records)}):
+                    responses = shard.client.apply_batch_sync(batch, False)
+            except Exception as e:
+                self.server.console.log("❌ Ошибка парковки машин на шарде {}: {}", shard.name, e)
+                return [], shard_records
+            parked, failed = [], []
+            for index, record in enumerate(shard_records):
+                (failed if any(r.error for r in responses[3 * index:3 * index + 3]) else parked).append(record)
+            shard.spawn_allocator.release([record.spawn_point for record in parked])
+            for record in parked:
+                record.owner, record.control_mode, record.spawn_point, record.tm_port = None, "parked", None, shard.tm_port
+            return parked, failed
+
+        results = self.server.map_shards(park_on_shard, list(accepted))
+        with self.lock:
+            for shard, (parked, failed) in zip(accepted, results):
+                self.parked.setdefault(shard, []).extend(parked)
+                self.stats["parked"] += len(parked)
+                self.stats["failed"] += len(failed)
+                rest += failed
+        return rest
+
+    def forget(self, shard):
+        """Эпизод шарда сменился - припаркованные акторы исчезли вместе с ним"""
+        with self.lock:
+            self.slots.pop(shard, None)
+            return len(self.parked.pop(shard, ()))
+
+    def take(self, shard, count):
+        with self.lock:
+            records = self.parked.get(shard, [])
+            taken = records[len(records) - count:] if count < len(records) else list(records)
+            del records[len(records) - len(taken):]
+        return taken
+
+    def reuse(self, client_id, shard, points):
+        """Выдаёт клиенту машины из пула на первые точки points.
+
+        Возвращает (записи, оставшиеся точки для нового спавна, точки, на которые машину поставить не удалось).
+        """
+        pooled = self.take(shard, len(points)) if self.max_size else []
+        if not pooled:
+            return [], points, []
+        SetAutopilot = carla.command.SetAutopilot
+        SetSimulatePhysics = carla.command.SetSimulatePhysics
+        ApplyTransform = carla.command.ApplyTransform
+        used, points = points[:len(pooled)], points[len(pooled):]
+        batch = []
+        for record, point in zip(pooled, used):
+            batch += [ApplyTransform(record.actor_id, shard.spawn_allocator.spawn_points[point]),
+                      SetSimulatePhysics(record.actor_id, True), SetAutopilot(record.actor_id, True, shard.tm_port)]
+        started = time.perf_counter()
+        try:
+            with self.server.tracer.span("reuse", "rpc", {"shard": shard.name, "vehicles": len(pooled)}):
+                responses = shard.client.apply_batch_sync(batch, False)
+        except Exception as e:
+            self.server.console.log("❌ Ошибка выдачи машин из пула на шарде {}: {}", shard.name, e)
+            with self.lock:
+                self.parked.setdefault(shard, []).extend(pooled)
+            return [], used + points, []
+        records, rejected = [], []
+        for index, (record, point) in enumerate(zip(pooled, used)):
+            if any(r.error for r in responses[3 * index:3 * index + 3]):
+                rejected.append(point)  # актор пропал из симулятора, машину забываем
+                continue
+            record.owner, record.control_mode, record.spawn_point = client_id, "autopilot", point
+            records.append(record)
+        with self.lock:
+            self.stats["reused"] += len(records)
+            self.stats["failed"] += len(rejected)
+            self.stats["reuse_ms"] += (time.perf_counter() - started) * 1000
+        return records, points, rejected
+
+    def record_spawn(self, count, elapsed):
+        """Учитывает новые акторы: промахи пула для доли попаданий и стоимость спавна для сравнения"""
+        with self.lock:
+            self.stats["spawned"] += count
+            self.stats["spawn_ms"] += elapsed * 1000
+
+    def drain(self):
+        """Забирает все припаркованные машины (например, для уничтожения)"""
+        with self.lock:
+            records = [record for shard_records in self.parked.values() for record in shard_records]
+            self.parked = {}
+        return records
+
+
+class SpawnAdmission:
+    """Допуск запросов на спавн с учётом квот и загрузки сервера и симулятора.
+
+    Запросы ставятся в очередь и выдаются порциями: за раунд ожидающие клиенты делят
+    бюджет поровну, первыми обслуживаются дольше всех ждавшие. Пока CPU/RAM сервера
+    или интервал тика CARLA близки к порогу, бюджет уменьшается, выше порога - спавн
+    приостанавливается. Запрос сверх квоты клиента выполняется частично.
+    """
+
+    def __init__(self, server, client_quota=None, round_budget=64, interval=0.2, max_requests=4,
+                 cpu_limit=90.0, ram_limit=90.0, frame_budget=0.1):
+        self.server = server
+        self.client_quota = client_quota  # машин на клиента, None - без ограничения
+        self.round_budget = round_budget  # машин за раунд на всех клиентов
+        self.interval = interval  # пауза между раундами, с
+        self.max_requests = max_requests  # запросов в очереди на клиента
+        self.cpu_limit = cpu_limit  # %
+        self.ram_limit = ram_limit  # %
+        self.frame_budget = frame_budget  # допустимый интервал тика CARLA, с
+        self.queue = OrderedDict()  # {client_id: deque(запросов)}, порядок - очередь обслуживания
+        self.cond = threading.Condition()
+        self.cpu = (0.0, 0.0)  # (время замера, % CPU)
+        self.stats = {"requests": 0, "granted": 0, "rejected": 0, "throttled_rounds": 0, "max_wait_ms": 0.0}
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, client_id, num):
+        """Ставит запрос в очередь; сверх квоты запрос урезается, переполнение очереди - отказ"""
+        with self.cond:
+            self.stats["requests"] += 1
+            requests = self.queue.get(client_id, ())
+            allowed = num
+            if self.client_quota is not None:
+                queued = sum(request["remaining"] for request in requests)
+                allowed = min(num, max(0, self.client_quota - len(self.server.client_vehicles.get(client_id, {})) - queued))
+            request = {"requested": num, "remaining": allowed, "spawned": 0, "queued_at": time.monotonic(),
+                       "reason": "quota" if allowed < num else None, "notified": False}
+            if len(requests) >= self.max_requests:
+                request.update(remaining=0, reason="queue_full")
+            elif not self.server.shards:
+                request.update(remaining=0, reason="no_carla")
+            if not request["remaining"]:
+                self.stats["rejected"] += num
+            else:
+                self.queue.setdefault(client_id, deque()).append(request)
+                self.cond.notify()
+                return
+        self.reply(client_id, request)
+
+    def cancel(self, client_id):
+        """Забывает запросы отключившегося клиента"""
+        with self.cond:
+            self.queue.pop(client_id, None)
+
+    def health(self):
+        """(доля бюджета 0..1, причина ограничения, шарды с тиком в пределах бюджета)"""
+        now = time.monotonic()
+        if now - self.cpu[0] >= 1.0:
+            self.cpu = (now, psutil.cpu_percent())
+        shards = [shard for shard in self.server.shards if shard.snapshot_cache.tick_seconds <= self.frame_budget]
+        tick = min((shard.snapshot_cache.tick_seconds for shard in self.server.shards), default=0.0)
+        factor, reason = 1.0, None
+        for name, value, limit in (("cpu", self.cpu[1], self.cpu_limit),
+                                   ("ram", psutil.virtual_memory().percent, self.ram_limit),
+                                   ("frame_time", tick, self.frame_budget)):
+            # Последние 20% до порога бюджет убывает линейно до нуля
+            headroom = min(1.0, (limit - value) / (0.2 * limit))
+            if headroom < factor:
+                factor, reason = max(0.0, headroom), name
+        return factor, reason, shards
+
+    def next_grants(self, budget):
+        """Делит бюджет раунда поровну между клиентами в очереди (вызывать под self.cond)"""
+        grants = []
+        share = max(1, budget // len(self.queue))
+        for client_id in list(self.queue):
+            if budget <= 0:
+                break
+            request = self.queue[client_id][0]
+            count = min(share, request["remaining"], budget)
+            request["remaining"] -= count
+            budget -= count
+            grants.append((client_id, request, count))
+            # Обслуженные уходят в конец, остальные будут первыми в следующем раунде
+            self.queue.move_to_end(client_id)
+        return grants
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+            factor, reason, shards = self.health()
+            budget = int(self.round_budget * factor)
+            if budget <= 0 or not shards:
+                self.stats["throttled_rounds"] += 1
+                self.notify_queued(reason or "frame_time")
+                time.sleep(self.interval)
+                continue
+
+            with self.cond:
+                grants = self.next_grants(budget) if self.queue else []
+            for client_id, request, count in grants:
+                if client_id not in self.server.clients:
+                    continue
+                try:
+                    spawned = self.server.spawn_vehicles(client_id, count, shards)
+                except Exception as e:
+                    self.server.console.log("❌ Ошибка спавна для клиента {}: {}", client_id, e)
+                    spawned = 0
+                request["spawned"] += spawned
+                if spawned < count:
+                    # Свободных точек не хватило - остаток запроса не выполнится и позже
+                    request.update(remaining=0, reason="no_spawn_points")
+                if not request["remaining"]:
+                    self.finish(client_id, request)
+            self.notify_queued("fair_share")
+            time.sleep(self.interval)
+
+    def finish(self, client_id, request):
+        with self.cond:
+            requests = self.queue.get(client_id)
+            if requests and requests[0] is request:
+                requests.popleft()
+                if not requests:
+                    del self.queue[client_id]
+            wait_ms = (time.monotonic() - request["queued_at"]) * 1000
+            self.stats["granted"] += request["spawned"]
+            self.stats["rejected"] += request["requested"] - request["spawned"]
+            self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], wait_ms)
+        self.reply(client_id, request)
+
+    def notify_queued(self, reason):
+        """Один раз сообщает клиенту, что его запрос ждёт в очереди"""
+        with self.cond:
+            waiting = [(client_id, request) for client_id, requests in self.queue.items() for request in requests
+                       if not request["notified"]]
+            for _, request in waiting:
+                request["notified"] = True
+        for client_id, request in waiting:
+            self.server.send_message(client_id, {"action": "spawn_queued", "requested": request["requested"],
+                                                 "spawned": request["spawned"], "pending": request["remaining"],
+                                                 "reason": reason})
+
+    def reply(self, client_id, request):
+        spawned = request["spawned"]
+        self.server.console.log("Заспавнено {}/{} автомобилей для клиента {}{}", spawned, request["requested"], client_id,
+                                f" (ограничение: {request['reason']})" if request["reason"] else "")
+        self.server.send_message(client_id, {
+            "action": "spawn_vehicles",
+            "num_vehicles": spawned,
+            "requested": request["requested"],
+            "spawned": spawned,
+            "rejected": request["requested"] - spawned,
+            "reason": request["reason"],
+        })
+
+    def queue_depth(self):
+        with self.cond:
+            return {"clients": len(self.queue), "vehicles": sum(request["remaining"] for requests in self.queue.values()
+                                                                for request in requests)}
+
+
+class JpegEncoder:
+    """Каждый кадр сжимается независимо, поэтому устаревшие кадры можно отбрасывать в очереди"""
+
+    name = "jpeg"
+    droppable = True
+
+    def __init__(self, width, height, fps, quality):
+        self.quality = quality  # меняется на лету
+
+    def encode(self, image):
+        """image - BGR, возвращает [(данные, ключевой кадр)]"""
+        ok, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return [(data, True)] if ok else []
+
+
+class H264Encoder:
+    """H.264 (PyAV): кадры зависят от предыдущих, поэтому в очереди не отбрасываются"""
+
+    name = "h264"
+    droppable = False
+
+    def __init__(self, width, height, fps, quality):
+        self.quality = quality  # x264 не меняет CRF на лету - при смене качества кодер создаётся заново
+        self.context = av.CodecContext.create("libx264", "w")
+        self.context.width = width
+        self.context.height = height
+        self.context.pix_fmt = "yuv420p"
+        self.context.framerate = round(fps)
+        self.context.options = {"preset": "ultrafast", "tune": "zerolatency", "crf": str(int(51 - quality * 0.33))}
+
+    def encode(self, image):
+        frame = av.VideoFrame.from_ndarray(image, format="bgr24")
+        return [(bytes(packet), packet.is_keyframe) for packet in self.context.encode(frame)]
+
+
+VIDEO_ENCODERS = {"h264": H264Encoder, "jpeg": JpegEncoder} if av is not None else {"jpeg": JpegEncoder}
+
+
+class VideoStream:
+    """Камера на машине клиента: кадры сжимаются в пуле потоков, побеждает последний кадр.
+
+    Поток сенсора только запоминает последний кадр; если предыдущий ещё сжимается,
+    кадр между ними пропускается. Качество и разрешение подстраиваются под очередь
+    отправки клиента: растущая очередь снижает их, пустая - постепенно возвращает.
+    """
+
+    MIN_QUALITY = 30
+    MAX_QUALITY = 85
+    MIN_SCALE = 0.25
+
+    def __init__(self, server, client_id, stream_id, record, video_format="jpeg", width=1280, height=720, fps=20.0):
+        self.server = server
+        self.client_id = client_id
+        self.stream_id = stream_id
+        self.record = record
+        self.format = video_format
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.quality = 75
+        self.scale = 1.0
+        self.encoder = None  # создаётся под текущее разрешение
+        self.seq = 0
+        self.calm_frames = 0  # кадров подряд с пустой очередью
+        self.latest = None  # последний ещё не сжатый кадр
+        self.encoding = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.stats = {"captured": 0, "skipped": 0, "encoded": 0, "dropped": 0}
+        self.encode_ms = deque(maxlen=120)
+        self.frame_bytes = deque(maxlen=120)
+        self.sent_times = deque(maxlen=120)
+
+        world = record.shard.world
+        blueprint = world.get_blueprint_library().find("sensor.camera.rgb")
+        blueprint.set_attribute("image_size_x", str(width))
+        blueprint.set_attribute("image_size_y", str(height))
+        blueprint.set_attribute("sensor_tick", str(1.0 / fps))
+        self.camera = world.spawn_actor(blueprint, carla.Transform(carla.Location(x=-5, z=3)), attach_to=record.vehicle)
+
+    def start(self):
+        self.camera.listen(self.on_image)
+
+    def on_image(self, image):
+        # Поток сенсора CARLA: только ссылка на кадр, сжатие - в пуле
+        with self.lock:
+            if self.closed:
+                return
+            self.stats["captured"] += 1
+            if self.latest is not None:
+                self.stats["skipped"] += 1
+            self.latest = image
+            if self.encoding:
+                return
+            self.encoding = True
+        self.server.video_pool.submit(self.encode_loop)
+
+    def encode_loop(self):
+        while True:
+            with self.lock:
+                image, self.latest = self.latest, None
+                if image is None or self.closed:
+                    self.encoding = False
+                    return
+            try:
+                self.encode(image)
+            except Exception as e:
+                self.server.console.log("❌ Ошибка сжатия видео {} клиента {}: {}", self.stream_id, self.client_id, e)
+
+    def encode(self, image):
+        started = time.perf_counter()
+        frame = np.frombuffer(image.raw_data, dtype=np.uint8).reshape(image.height, image.width, 4)
+        width, height = (int(image.width * self.scale) // 2 * 2, int(image.height * self.scale) // 2 * 2)
+        if self.scale < 1.0:
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+        if self.encoder is None or (self.encoder.quality != self.quality and not self.encoder.droppable):
+            # Новый кодер H.264 начинает поток с ключевого кадра
+            self.encoder = VIDEO_ENCODERS[self.format](width, height, self.fps, self.quality)
+        self.encoder.quality = self.quality
+        packets = self.encoder.encode(frame)
+        self.encode_ms.append((time.perf_counter() - started) * 1000)
+        self.stats["encoded"] += 1
+
+        connection = self.server.clients.get(self.client_id)
+        if connection is None:
+            return
+        kind = ("video", self.stream_id) if self.encoder.droppable else None
+        for data, keyframe in packets:
+            self.seq += 1
+            self.frame_bytes.append(len(data))
+            self.sent_times.append(time.monotonic())
+            message = protocol.encode_video_frame(self.stream_id, self.seq, width, height, self.format, data, keyframe)
+            if not connection.send(message, kind):
+                self.server.console.log("🐢 Клиент {} не успевает получать видео, соединение разорвано.", self.client_id)
+                self.server.evict_client(self.client_id, connection)
+                return
+        self.adapt(connection.queue.size)
+
+    def adapt(self, backlog):
+        """Подстройка качества и разрешения по числу байт в очереди клиента"""
+        frame_size = self.frame_bytes[-1] if self.frame_bytes else 0
+        if backlog > 2 * frame_size:
+            self.calm_frames = 0
+            if self.quality > self.MIN_QUALITY:
+                self.quality = max(self.MIN_QUALITY, self.quality - 10)
+            elif self.scale > self.MIN_SCALE:
+                self.set_scale(max(self.MIN_SCALE, self.scale * 0.75))
+        elif backlog == 0:
+            self.calm_frames += 1
+            if self.calm_frames >= self.fps:  # около секунды без очереди
+                self.calm_frames = 0
+                if self.scale < 1.0:
+                    self.set_scale(min(1.0, self.scale / 0.75))
+                elif self.quality < self.MAX_QUALITY:
+                    self.quality = min(self.MAX_QUALITY, self.quality + 5)
+
+    def set_scale(self, scale):
+        self.scale = scale
+        self.encoder = None  # кодер пересоздаётся под новое разрешение
+
+    def on_dropped(self):
+        """Кадр вытеснен из очереди клиента более свежим"""
+        self.stats["dropped"] += 1
+
+    def summary(self):
+        now = time.monotonic()
+        window = min(5.0, max(now - self.started, 1e-3))
+        recent = [t for t in self.sent_times if t > now - window]
+        delivered = self.stats["encoded"] - self.stats["dropped"]
+        return {
+            "vehicle": self.record.id,
+            "format": self.format,
+            "resolution": f"{int(self.width * self.scale)}x{int(self.height * self.scale)}",
+            "quality": self.quality,
+            "encode_ms": sum(self.encode_ms) / len(self.encode_ms) if self.encode_ms else 0.0,
+            "frame_kb": sum(self.frame_bytes) / len(self.frame_bytes) / 1024 if self.frame_bytes else 0.0,
+            "fps": len(recent) / window,
+            "delivered_fps": delivered / max(now - self.started, 1e-3),
+            "captured": self.stats["captured"],
+            "skipped": self.stats["skipped"],
+            "dropped": self.stats["dropped"],
+        }
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.latest = None
+        try:
+            self.camera.stop()
+            self.camera.destroy()
+        except Exception as e:
+            self.server.console.log("Ошибка удаления камеры потока {}: {}", self.stream_id, e)
+
+
+class TelemetryRecorder:
+    """Запись состояния всех машин сервера на каждом тике в фоновом потоке.
+
+    Тик CARLA только будит поток записи. Массивы берутся из кэша тика (того же, что
+    отвечает на vehicle_info) и копируются в отображённые в память колонки.
+    """
+
+    def __init__(self, server, root="recordings", chunk_rows=1 << 20):
+        self.server = server
+        self.root = root
+        self.chunk_rows = chunk_rows
+        self.writer = None
+        self.name = None
+        self.running = False
+        self.thread = None
+        self.capture_ms = deque(maxlen=200)
+        self.stats = {"ticks": 0, "rows": 0, "missed": 0}
+
+    def start(self, name=None):
+        """Начинает новую запись, возвращает её имя (None - нет CARLA или запись уже идёт)"""
+        if self.running or not self.server.shards:
+            return None
+        self.name = name or recorder.recording_name()
+        self.writer = recorder.TelemetryWriter(os.path.join(self.root, self.name), self.chunk_rows)
+        self.stats = {"ticks": 0, "rows": 0, "missed": 0}
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print(f"⏺️ Запись телеметрии: {os.path.join(self.root, self.name)}")
+        return self.name
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        self.writer.close()
+        print(f"⏹️ Запись {self.name} остановлена: тиков {self.stats['ticks']}, строк {self.stats['rows']}")
+
+    def run(self):
+        cache = self.server.shards[0].snapshot_cache
+        last_frame = None
+        while self.running:
+            if not cache.ticked.wait(1.0):
+                continue
+            cache.ticked.clear()
+            frame = cache.snapshot.frame
+            if last_frame is not None and frame > last_frame + 1:
+                self.stats["missed"] += frame - last_frame - 1
+            last_frame = frame
+            try:
+                self.capture()
+            except Exception as e:
+                self.server.console.log("❌ Ошибка записи телеметрии: {}", e)
+
+    def capture(self):
+        """Дописывает текущий тик: все машины сервера, найденные в снимках своих шардов"""
+        started = time.perf_counter()
+        by_shard = {}
+        for record in list(self.server.vehicle_index.values()):
+            by_shard.setdefault(record.shard, []).append(record)
+        records, locations, yaws, velocities = [], [], [], []
+        for shard, shard_records in by_shard.items():
+            _, ids, shard_locations, shard_yaws, shard_velocities, _ = shard.snapshot_cache.refresh()
+            if not len(ids):
+                continue
+            actor_ids = np.fromiter((record.actor_id for record in shard_records), dtype=np.int64, count=len(shard_records))
+            rows = np.minimum(np.searchsorted(ids, actor_ids), len(ids) - 1)
+            alive = ids[rows] == actor_ids
+            rows = rows[alive]
+            records += [record for record, is_alive in zip(shard_records, alive.tolist()) if is_alive]
+            locations.append(shard_locations[rows])
+            yaws.append(shard_yaws[rows])
+            velocities.append(shard_velocities[rows])
+        if not records:
+            return
+        mode_codes = recorder.MODE_CODES
+        self.writer.append(self.stats["ticks"], time.time(),
+                           np.fromiter((record.id for record in records), dtype=np.int64, count=len(records)),
+                           [record.owner for record in records], np.concatenate(locations), np.concatenate(yaws),
+                           np.concatenate(velocities),
+                           np.fromiter((mode_codes.get(record.control_mode, 0) for record in records), dtype=np.uint8,
+                                       count=len(records)))
+        self.stats["ticks"] += 1
+        self.stats["rows"] += len(records)
+        self.capture_ms.append((time.perf_counter() - started) * 1000)
+
+
+class ReplaySession:
+    """Воспроизведение записи клиенту обычными сообщениями vehicle_info (CARLA не нужна)"""
+
+    def __init__(self, server, client_id, reader, speed=1.0, owner=None):
+        self.server = server
+        self.client_id = client_id
+        self.reader = reader
+        self.speed = speed  # 0 - без пауз, как можно быстрее
+        self.owner = owner
+        self.stopped = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        started = time.monotonic()
+        first_time = None
+        ticks = vehicles = 0
+        for tick, timestamp, columns in self.reader.ticks(self.owner):
+            if self.stopped or self.client_id not in self.server.clients:
+                break
+            first_time = timestamp if first_time is None else first_time
+            if self.speed > 0:
+                time.sleep(max(0.0, (timestamp - first_time) / self.speed - (time.monotonic() - started)))
+            self.server.send_message(self.client_id, {
+                "action": "vehicle_info",
+                "subscription": True,
+                "full": True,
+                "replay": {"tick": tick, "time": timestamp},
+                "vehicles": recorder.replay_vehicles(columns, self.reader.modes),
+                "removed": [],
+            }, kind=CarlaServer.REPLAY_KIND)
+            ticks += 1
+            vehicles += len(columns["tick"])
+        elapsed = time.monotonic() - started
+        self.server.send_message(self.client_id, {"action": "replay_finished", "ticks": ticks, "vehicles": vehicles,
+                                                  "seconds": round(elapsed, 3)})
+        if self.server.replays.get(self.client_id) is self:
+            self.server.replays.pop(self.client_id, None)
+        self.server.console.log("⏯️ Воспроизведение для {}: {} тиков, {} машин за {:.2f} с", self.client_id, ticks, vehicles, elapsed)
+
+    def stop(self):
+        self.stopped = True
+
 
 class CarlaServer:
-    def __init__(self, host, port):
+    # Рассылки vehicle_info вытесняют только более старые рассылки того же вида; ответ на get_vehicle_info не вытесняется
+    SUBSCRIPTION_KIND = ("vehicle_info", "subscription")
+    REPLAY_KIND = ("vehicle_info", "replay")
+
+    def __init__(self, host, port, mode="threaded", rpc_workers=8, backlog=128, carla_endpoints=("localhost:2000",),
+                 admission_options=None, video_workers=4, recordings_dir="recordings",
+                 pool_size=0, log_rate=20.0, fleet_options=None, session_grace=30.0, quiet=False):
         self.host = host
         self.port = port
+        self.mode = mode  # "threaded" - поток на клиента, "async" - event loop + пул RPC
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
-        self.clients = {}  # {client_id: socket}
-        self.client_vehicles = {}  # {client_id: [список машин]}
-        self.world = None
+        self.server_socket.listen(backlog)
+        self.loop = None
+        self.console = ConsoleLog(rate=log_rate, quiet=quiet)  # журнал команд и подключений, не блокирует обработку
+        self.tracer = TraceRecorder()
+        self.commands = CommandDispatcher(self.console, self.tracer, on_error=self.command_failed)
+        self.register_commands()
+        # Ограниченный пул для блокирующих вызовов CARLA в асинхронном режиме
+        self.rpc_pool = ThreadPoolExecutor(max_workers=rpc_workers, thread_name_prefix="carla-rpc")
+        # Таблицы клиентов меняются при подключении и отключении, а читаются на каждом сообщении
+        # и обходятся меню: copy-on-write, чтение без блокировок
+        self.clients_lock = InstrumentedLock("clients")
+        self.clients = SnapshotDict(self.clients_lock)  # {client_id: ClientConnection | AsyncClientConnection}
+        # Машины меняются часто (спавн порциями, передача, отключение): изменения под одной короткой блокировкой,
+        # чтобы client_vehicles и vehicle_index всегда совпадали
+        self.vehicles_lock = InstrumentedLock("vehicles")
+        self.client_vehicles = {}  # {client_id: {vehicle_id: VehicleRecord}}, машины могут быть на разных шардах
+        self.vehicle_index = {}  # {vehicle_id: VehicleRecord} по всем клиентам и шардам
+        self.client_decoders = SnapshotDict(self.clients_lock)  # {client_id: protocol.MessageDecoder}
+        self.client_codecs = SnapshotDict(self.clients_lock)  # {client_id: кодек кадров}, нет записи - JSON-строки
         self.monitoring_active = True
-        self.client_info = {}
+        self.client_info_lock = InstrumentedLock("client_info")
+        self.client_info = SnapshotDict(self.client_info_lock)
+        self.client_metrics = SnapshotDict(self.client_info_lock)  # {client_id: MetricSeries}
+        self.shards = []  # [CarlaShard] - подключённые экземпляры CARLA
+        # Параллельные запросы ко всем шардам (отдельно от rpc_pool, который их вызывает)
+        self.shard_pool = ThreadPoolExecutor(max_workers=4 * max(1, len(carla_endpoints)), thread_name_prefix="carla-shard")
+        self.spawn_batch_size = 256  # Команд в одном apply_batch_sync
+        self.teardown = TeardownScheduler(self, grace_period=5.0)
+        self.sessions = SessionRegistry(grace_period=session_grace)
+        self.vehicle_pool = VehiclePool(self, max_size=pool_size)
+        self.admission = SpawnAdmission(self, **(admission_options or {}))
+        self.subscriptions_lock = InstrumentedLock("subscriptions")
+        self.subscriptions = SnapshotDict(self.subscriptions_lock)  # {client_id: параметры подписки на vehicle_info}
+        self.tick_coordinator = TickCoordinator(self)
+        self.fleet = FleetLOD(self, **(fleet_options or {}))
+        self.tick_listeners = SnapshotDict(self.clients_lock)  # {client_id: True} - клиенты, получающие номер каждого тика
+        threading.Thread(target=self.tick_coordinator.flush_loop, daemon=True).start()
+        self.subscriptions_changed = threading.Event()
+        self.rings_lock = threading.Lock()  # публикация в кольцо и его закрытие
+        self.video_streams = SnapshotDict(self.clients_lock)  # {client_id: {stream_id: VideoStream}}, вложенные не меняются
+        self.video_stream_ids = itertools.count(1)
+        self.video_pool = ThreadPoolExecutor(max_workers=video_workers, thread_name_prefix="video-encode")
+        self.recorder = TelemetryRecorder(self, recordings_dir)
+        self.replays = SnapshotDict(self.clients_lock)  # {client_id: ReplaySession}
+        threading.Thread(target=self.telemetry_push_loop, daemon=True).start()
 
-        # Подключение к CARLA
-        try:
-            self.client = carla.Client("localhost", 2000)
-            self.client.set_timeout(10.0)
-            self.world = self.client.get_world()
-            print(f"✅ CARLA запущена (доступных точек спавна: {len(self.world.get_map().get_spawn_points())})")
-        except Exception as e:
-            print(f"❌ Ошибка подключения к CARLA: {e}")
+        # Подключение к CARLA: каждый экземпляр - отдельный шард
+        for endpoint in carla_endpoints:
+            try:
+                shard = CarlaShard(len(self.shards), *parse_carla_endpoint(endpoint, len(self.shards)))
+                self.shards.append(shard)
+                print(f"✅ CARLA {shard.name} запущена (доступных точек спавна: {len(shard.spawn_allocator.spawn_points)})")
+            except Exception as e:
+                print(f"❌ Ошибка подключения к CARLA {endpoint}: {e}")
 
+    def map_shards(self, fn, items=None):
+        """Выполняет fn для каждого шарда (или элемента items) параллельно, результаты - по порядку"""
+        items = self.shards if items is None else items
+        if len(items) == 1:
+            return [fn(items[0])]
+        return list(self.shard_pool.map(fn, items))
 
     def start(self):
+        if self.mode == "async":
+            asyncio.run(self.start_async())
+            return
+
         print(f"🚀 Сервер запущен на {self.host}:{self.port}")
         while True:
             client_socket, client_address = self.server_socket.accept()
             client_id = str(client_address)
-            self.clients[client_id] = client_socket
-            self.client_vehicles[client_id] = []
-            print(f"🔗 Подключен клиент: {client_address} (ID: {client_id})")
-            threading.Thread(target=self.handle_client, args=(client_id, client_socket), daemon=True).start()
+            connection = ClientConnection(client_id, client_socket, self.on_message_dropped(client_id), self.tracer,
+                                          self.console)
+            self.register_client(client_id, connection)
+            self.console.log("🔗 Подключен клиент: {} (ID: {})", client_address, client_id)
+            self.open_session(client_id)
+            threading.Thread(target=self.handle_client, args=(connection,), daemon=True).start()
+
+    def register_client(self, client_id, connection):
+        with self.vehicles_lock:
+            self.client_vehicles[client_id] = {}
+        self.clients[client_id] = connection
 
-    def handle_client(self, client_id, client_socket):
-        buffer = ""
+    def handle_client(self, connection):
+        # connection.client_id меняется, если соединение возобновило прежнюю сессию (resume_session)
+        decoder = self.client_decoders[connection.client_id] = protocol.MessageDecoder()
+        tracer = self.tracer
         try:
             while True:
-                chunk = client_socket.recv(1024).decode()
-                if not chunk:
+                started = time.perf_counter_ns()
+                received = decoder.recv_from(connection.socket)
+                if not received:
                     break
-                buffer += chunk
-                while "\n" in buffer:
-                    json_obj, buffer = buffer.split("\n", 1)
-                    command = json.loads(json_obj)
-                    self.process_command(client_id, command)
+                if tracer.enabled:
+                    # Включает ожидание данных: конец события - момент их прихода
+                    tracer.complete("recv", "net", started, time.perf_counter_ns(),
+                                    {"client": connection.client_id, "bytes": received})
+                for command in (tracer.decode(connection.client_id, decoder) if tracer.enabled else decoder):
+                    self.process_command(connection.client_id, command)
         except ConnectionResetError:
-            print(f"⚠️ Клиент {client_id} неожиданно отключился (WinError 10054)")
+            self.console.log("⚠️ Клиент {} неожиданно отключился (WinError 10054)", connection.client_id)
         except Exception as e:
-            print(f"❌ Ошибка клиента {client_id}: {e}")
+            self.console.log("❌ Ошибка клиента {}: {}", connection.client_id, e)
         finally:
-            self.cleanup_client(client_id)
+            self.connection_lost(connection.client_id, connection)
+
+    async def start_async(self):
+        """Асинхронный режим: один event loop на все соединения"""
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_client_async, sock=self.server_socket)
+        print(f"🚀 Сервер запущен на {self.host}:{self.port} (async, пул RPC: {self.rpc_pool._max_workers})")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client_async(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        client_id = str(client_address)
+        connection = AsyncClientConnection(self.loop, client_id, writer, self.on_message_dropped(client_id), self.tracer,
+                                           self.console)
+        self.register_client(client_id, connection)
+        decoder = self.client_decoders[client_id] = protocol.MessageDecoder()
+        self.console.log("🔗 Подключен клиент: {} (ID: {})", client_address, client_id)
+        self.open_session(client_id)
+        tracer = self.tracer
+        try:
+            while True:
+                started = time.perf_counter_ns()
+                data = await reader.read(65536)
+                if not data:
+                    break
+                if tracer.enabled:
+                    tracer.complete("recv", "net", started, time.perf_counter_ns(),
+                                    {"client": connection.client_id, "bytes": len(data)})
+                decoder.feed(data)
+                for command in (tracer.decode(connection.client_id, decoder) if tracer.enabled else decoder):
+                    # Команды одного клиента выполняются по порядку, но не блокируют остальных
+                    await self.loop.run_in_executor(self.rpc_pool, self.process_command, connection.client_id, command)
+        except ConnectionResetError:
+            self.console.log("⚠️ Клиент {} неожиданно отключился (WinError 10054)", connection.client_id)
+        except Exception as e:
+            self.console.log("❌ Ошибка клиента {}: {}", connection.client_id, e)
+        finally:
+            await self.loop.run_in_executor(self.rpc_pool, self.connection_lost, connection.client_id, connection)
+
+    def register_commands(self):
+        """Таблица команд клиента; частые команды (управление, телеметрия устройства) не пишутся в журнал"""
+        register = self.commands.register
+        register("request_spawn", lambda client_id, command: self.admission.submit(
+            client_id, max(0, int(command.get("num_vehicles", 10)))))
+        register("get_vehicle_info", lambda client_id, command: self.send_vehicle_info(client_id))
+        register("subscribe_vehicle_info", self.subscribe_vehicle_info)
+        register("unsubscribe_vehicle_info", lambda client_id, command: self.drop_subscription(client_id))
+        register("disconnect", self.handle_disconnect)
+        register("send_device_info", self.handle_device_info, log=False)
+        register("negotiate_protocol", self.negotiate_protocol)
+        register("control", self.handle_control, log=False)
+        register("apply_control", self.handle_apply_control, log=False)
+        register("release_control", lambda client_id, command: self.release_vehicle_control(client_id, command.get("vehicle_id")))
+        register("subscribe_video", self.subscribe_video)
+        register("unsubscribe_video", lambda client_id, command: self.close_video_streams(client_id, [command.get("stream")]))
+        register("get_minimap", lambda client_id, command: self.send_minimap(client_id, command.get("vehicle_id")))
+        register("get_map_info", self.send_map_info)
+        register("list_recordings", lambda client_id, command: self.send_message(
+            client_id, {"action": "recordings", "recordings": self.list_recordings()}))
+        register("replay", self.start_replay)
+        register("stop_replay", self.stop_replay)
+        register("subscribe_ticks", self.subscribe_ticks)
+        register("resume_session", self.resume_session, log=False)  # в журнал не попадает токен
+
+    def command_failed(self, client_id, action, error):
+        self.send_message(client_id, {"action": "error", "message": f"Команда {action} не выполнена: {error!r}"})
 
     def process_command(self, client_id, command):
         """Обрабатывает команды от клиента"""
-        if command.get("action") != "send_device_info" :
-            print(f"📩 Получена команда от {client_id}: {command}")
+        self.commands.dispatch(client_id, command)
+
+    def handle_disconnect(self, client_id, command):
+        self.end_session(client_id)
+        self.send_message(client_id, {"action": "disconnect"})
+
+    def handle_device_info(self, client_id, command):
+        device_info = command.get("device_info", {})
+        if "static" in device_info or "sample" in device_info:
+            self.update_client_metrics(client_id, device_info)
+        elif device_info:
+            self.client_info[client_id] = device_info  # Старые клиенты присылают готовые строки
+
+    def handle_control(self, client_id, command):
+        """Компактный кадр ручного управления, в ответ - скорость и положение машины"""
+        vehicle_id, throttle, steer, brake, hand_brake, reverse = protocol.unpack_control(command["c"])
+        record = self.apply_vehicle_control(client_id, vehicle_id, throttle, steer, brake, hand_brake, reverse,
+                                            command.get("tick_id"))
+        if record is not None:
+            self.send_control_state(client_id, record, command.get("seq"))
+
+    def handle_apply_control(self, client_id, command):
+        self.apply_vehicle_control(client_id, command.get("vehicle_id"), float(command.get("throttle", 0.0)),
+                                   float(command.get("steer", 0.0)), float(command.get("brake", 0.0)),
+                                   bool(command.get("hand_brake", False)), bool(command.get("reverse", False)),
+                                   command.get("tick_id"))
+
+    def stop_replay(self, client_id, command):
+        replay = self.replays.pop(client_id, None)
+        if replay is not None:
+            replay.stop()
+
+    def subscribe_ticks(self, client_id, command):
+        self.tick_listeners[client_id] = True
+        self.send_message(client_id, {"action": "tick", "tick_id": self.tick_coordinator.tick_id,
+                                      "frame": self.tick_coordinator.frame,
+                                      "synchronous": self.tick_coordinator.running,
+                                      "fixed_delta": self.tick_coordinator.fixed_delta})
+
+    def negotiate_protocol(self, client_id, command):
+        """Переводит клиента на кадры с длиной; ответ ещё отправляется JSON-строкой"""
+        offered = command.get("codecs", [])
+        codec = next((name for name in protocol.supported_codecs() if name in offered), None)
+        if command.get("framing") != protocol.FRAMING or codec is None:
+            self.send_message(client_id, {"action": "protocol", "framing": "newline"})
+            return
+        self.send_message(client_id, {"action": "protocol", "framing": protocol.FRAMING, "codec": codec})
+        self.client_codecs[client_id] = protocol.CODEC_NAMES[codec]
+        # Следующие байты от клиента уже идут кадрами
+        self.client_decoders[client_id].switch_to_framed()
+
+    def update_client_metrics(self, client_id, device_info):
+        """Статические данные сохраняются один раз, числовые изменения - в кольцевой временной ряд"""
+        if "static" in device_info:
+            self.client_info[client_id] = device_info["static"]
+        if "sample" in device_info:
+            series = self.client_metrics.get(client_id)
+            if series is None:
+                series = self.client_metrics[client_id] = MetricSeries()
+            series.append(time.time(), device_info["sample"])
+
+    def client_display_info(self, client_id):
+        """Данные клиента для таблицы: последние значения с трендом за минуту"""
+        info = dict(self.client_info.get(client_id, {}))
+        series = self.client_metrics.get(client_id)
+        if series is None:
+            return info
+
+        def fmt(name, unit):
+            latest, mean, arrow = series.trend(name)
+            if latest is None:
+                return "N/A"
+            return f"{latest:.1f}{unit} {arrow} (ср. {mean:.1f}{unit})"
+
+        info["RAM Total"] = f"{info.get('RAM Total', 'N/A')} GB"
+        info["CPU Usage"] = fmt("cpu_percent", "%")
+        info["RAM Used"] = fmt("ram_used_gb", " GB")
+        info["RAM Usage"] = fmt("ram_percent", "%")
+        info["GPU"] = [{
+            "Name": gpu["Name"],
+            "Load": fmt(f"gpu{index}_load", "%"),
+            "Memory Used": f"{series.latest.get(f'gpu{index}_memory_used', 'N/A')} MB",
+            "Memory Total": f"{gpu['Memory Total']} MB",
+        } for index, gpu in enumerate(info.get("GPU", []))]
+        return info
+
+    def owned_vehicle(self, client_id, vehicle_id):
+        record = self.vehicle_index.get(vehicle_id)
+        if record is None or record.owner != client_id:
+            self.send_message(client_id, {"action": "error", "message": f"Машина {vehicle_id} не найдена"})
+            return None
+        return record
 
-        if command.get("action") == "request_spawn":
-            num_vehicles = command.get("num_vehicles", 10)
-            self.spawn_vehicles(client_id, num_vehicles)
+    def apply_vehicle_control(self, client_id, vehicle_id, throttle, steer, brake, hand_brake, reverse, tick_id=None):
+        """Ставит управление машиной в очередь: последняя команда побеждает, применяются пакетом"""
+        record = self.owned_vehicle(client_id, vehicle_id)
+        if record is None:
+            return None
+        control = carla.VehicleControl(throttle=throttle, steer=steer, brake=brake, hand_brake=hand_brake, reverse=reverse)
+        disable_autopilot = record.control_mode == "autopilot"
+        record.control_mode = "manual"
+        self.tick_coordinator.submit(client_id, record, control, disable_autopilot, tick_id)
+        return record
 
-        elif command.get("action") == "get_vehicle_info":
-            self.send_vehicle_info(client_id)
+    def release_vehicle_control(self, client_id, vehicle_id):
+        """Возвращает машину под автопилот после ручного управления"""
+        record = self.owned_vehicle(client_id, vehicle_id)
+        if record is None:
+            return
+        # Под apply_lock: пакет управления, уже взятый apply_pending, применится раньше и не вернёт машину в ручной режим
+        with self.tick_coordinator.apply_lock:
+            self.tick_coordinator.discard(record.id)
+            record.vehicle.set_autopilot(True, record.shard.tm_port)
+            record.control_mode, record.tm_port = "autopilot", record.shard.tm_port
+        self.console.log("🚙 Машина {} клиента {} снова на автопилоте", record.id, client_id)
+
+    def subscribe_video(self, client_id, command):
+        """Ставит камеру на машину клиента, сжатые кадры идут по его соединению"""
+        record = self.owned_vehicle(client_id, command.get("vehicle_id"))
+        if record is None:
+            return
+        if client_id not in self.client_codecs:
+            self.send_message(client_id, {"action": "error", "message": "Видео передаётся только кадрами с длиной"})
+            return
+        video_format = next((name for name in command.get("formats", ["jpeg"]) if name in VIDEO_ENCODERS), None)
+        if video_format is None:
+            self.send_message(client_id, {"action": "error", "message": f"Поддерживаемые форматы видео: {', '.join(VIDEO_ENCODERS)}"})
+            return
+        width = min(max(int(command.get("width", 1280)), 64), 1920)
+        height = min(max(int(command.get("height", 720)), 64), 1080)
+        fps = min(max(float(command.get("fps", 20.0)), 1.0), 60.0)
+        stream_id = next(self.video_stream_ids)
+        try:
+            stream = VideoStream(self, client_id, stream_id, record, video_format, width, height, fps)
+        except Exception as e:
+            self.send_message(client_id, {"action": "error", "message": f"Не удалось установить камеру: {e}"})
+            return
+        self.video_streams.update(client_id, lambda streams: {**(streams or {}), stream_id: stream})
+        self.send_message(client_id, {"action": "video_stream", "stream": stream_id, "vehicle_id": record.id,
+                                      "format": video_format, "width": width, "height": height, "fps": fps})
+        stream.start()
+        self.console.log("📹 Видео {} ({}, {}x{}, {:g} к/с) для машины {} клиента {}", stream_id, video_format, width, height,
+                         fps, record.id, client_id)
 
-        elif command.get("action") == "disconnect":
-            self.cleanup_client(client_id)
-            self.send_message(client_id, {"action": "disconnect"})
+    def close_video_streams(self, client_id, stream_ids=None):
+        """Снимает камеры клиента (stream_ids=None - все потоки)"""
+        closed = []
 
-        elif command.get("action") == "send_device_info":
-            device_info = command.get("device_info", {})
-            if device_info:
-                self.client_info[client_id] = device_info
+        def remove(streams):
+            streams = dict(streams or {})
+            for stream_id in list(streams) if stream_ids is None else stream_ids:
+                stream = streams.pop(stream_id, None)
+                if stream is not None:
+                    closed.append(stream)
+            return streams or None
 
+        self.video_streams.update(client_id, remove)
+        for stream in closed:
+            stream.close()
+
+    def send_minimap(self, client_id, vehicle_id):
+        """Точки дорог для мини-карты: клиенту не нужен собственный доступ к CARLA"""
+        record = self.owned_vehicle(client_id, vehicle_id)
+        if record is None:
+            return
+        map_name, points = record.shard.get_road_points()
+        self.send_message(client_id, {"action": "minimap", "map": map_name, "points": points})
+
+    def send_map_info(self, client_id, command):
+        """Метаданные карт шардов (все, shard или шард машины vehicle_id).
+
+        Версии из known у клиента уже есть - для них отправляется только подтверждение.
+        """
+        if command.get("vehicle_id") is not None:
+            record = self.owned_vehicle(client_id, command["vehicle_id"])
+            if record is None:
+                return
+            shards = [record.shard]
+        elif command.get("shard") is not None:
+            shards = [shard for shard in self.shards if shard.index == command["shard"]]
+            if not shards:
+                self.send_message(client_id, {"action": "error", "message": f"Шард {command['shard']} не найден"})
+                return
         else:
-            print(f"Неизвестная команда от {client_id}: {command}")
+            shards = self.shards
+        known = set(command.get("known") or ())
+        for shard, metadata in zip(shards, self.map_shards(lambda shard: shard.metadata.current(), shards)):
+            message = {"action": "map_info", "shard": shard.index, "map": metadata.map_name, "version": metadata.version}
+            if metadata.version in known:
+                message["unchanged"] = True
+            else:
+                message.update(metadata.describe())
+            self.send_message(client_id, message)
+
+    def list_recordings(self):
+        root = self.recorder.root
+        if not os.path.isdir(root):
+            return []
+        return sorted(name for name in os.listdir(root) if os.path.isfile(os.path.join(root, name, recorder.MANIFEST)))
+
+    def start_replay(self, client_id, command):
+        """Воспроизводит запись клиенту; owner - только машины одного клиента записи"""
+        name = os.path.basename(str(command.get("recording", "")))
+        if name not in self.list_recordings():
+            self.send_message(client_id, {"action": "error", "message": f"Запись {name} не найдена"})
+            return
+        previous = self.replays.pop(client_id, None)
+        if previous is not None:
+            previous.stop()
+        reader = recorder.TelemetryReader(os.path.join(self.recorder.root, name))
+        self.replays[client_id] = ReplaySession(self, client_id, reader, max(0.0, float(command.get("speed", 1.0))),
+                                                command.get("owner"))
+        self.console.log("⏯️ Клиент {} воспроизводит запись {} ({} строк)", client_id, name, reader.summary()["rows"])
+
+    def send_control_state(self, client_id, record, seq):
+        """Ответ на кадр управления: скорость и положение машины из кэша последнего тика"""
+        frame, ids, locations, yaws, _, speeds = record.shard.snapshot_cache.refresh()
+        row = int(np.searchsorted(ids, record.actor_id))
+        if row == len(ids) or ids[row] != record.actor_id:
+            return
+        x, y, z = np.round(locations[row], 2).tolist()
+        self.send_message(client_id, {"action": "control_state", "seq": seq, "frame": frame,
+                                      "s": [record.id, round(float(speeds[row]), 2), x, y, z, round(float(yaws[row]), 1)]},
+                          kind="control_state")  # нужно только последнее состояние машины
+
+    def broadcast_tick(self, tick_id, frame):
+        for client_id in self.tick_listeners:
+            if client_id in self.clients:
+                self.send_message(client_id, {"action": "tick", "tick_id": tick_id, "frame": frame}, kind="tick")
+            else:
+                self.tick_listeners.pop(client_id, None)
 
     def show_clients_table(self):
         table = PrettyTable()
+        client_info = {client_id: self.client_display_info(client_id) for client_id in self.client_info}
 
         # Заголовки таблицы (динамически подстраиваемся под все возможные поля)
         all_keys = set()
-        for info in self.client_info.values():
+        for info in client_info.values():
             all_keys.update(info.keys())
 
         # Фильтруем и сортируем ключи для удобства
@@ -100,7 +2441,7 @@ class CarlaServer:
 
         table.field_names = ["Client ID"] + main_keys + other_keys + ["GPU Info"]
 
-        for client_id, info in self.client_info.items():
+        for client_id, info in client_info.items():
             row = [client_id]  # Начинаем с ID клиента
 
             # Добавляем основную информацию
@@ -120,74 +2461,538 @@ class CarlaServer:
 
         print("\n" + table.get_string() + "\n")
 
-    def spawn_vehicles(self, client_id, num):
-        blueprint_library = self.world.get_blueprint_library()
-        vehicle_bp = blueprint_library.filter("vehicle.*")[0]
-        spawn_points = self.world.get_map().get_spawn_points()
-        spawned_vehicles = []
+    def place_vehicles(self, num, shards=None):
+        """Размещает машины по шардам: сначала наименее загруженный, остаток - на следующие.
 
-        for i in range(min(num, len(spawn_points))):
-            vehicle = self.world.try_spawn_actor(vehicle_bp, spawn_points[i])
-            if vehicle:
-                vehicle.set_autopilot(True)
-                spawned_vehicles.append({"vehicle": vehicle, "control_mode": "autopilot"})
-                self.client_vehicles[client_id].append({"vehicle": vehicle, "control_mode": "autopilot"})
-                print(f"Автомобиль {vehicle.id} заспавнен для клиента {client_id} (автопилот)")
+        Возвращает [(шард, индексы выданных точек спавна)].
+        """
+        placement = []
+        for shard in sorted(self.shards if shards is None else shards, key=lambda shard: shard.load()):
+            if num <= 0:
+                break
+            points = shard.spawn_allocator.acquire(num)
+            if points:
+                placement.append((shard, points))
+                num -= len(points)
+        return placement
 
-        self.send_message(client_id, {"action": "spawn_vehicles", "num_vehicles": len(spawned_vehicles)})
+    def spawn_vehicles(self, client_id, num, shards=None):
+        """Пакетный спавн на наименее загруженных шардах, шарды обрабатываются параллельно.
 
-    def send_vehicle_info(self, client_id):
-        """Отправка информации о транспортных средствах клиента"""
+        Вызывается из SpawnAdmission порциями, возвращает число заспавненных машин.
+        """
+        self.map_shards(self.refresh_world, self.shards if shards is None else shards)
+        placement = self.place_vehicles(num, shards)
+        counts = self.map_shards(lambda item: self.spawn_on_shard(client_id, *item), placement)
+        num_spawned = sum(counts)
+        shards = ", ".join(f"{shard.name}: {count}" for (shard, _), count in zip(placement, counts))
+        self.console.log("Порция спавна {}/{} для клиента {} (автопилот; {})", num_spawned, num, client_id, shards or "нет шардов")
+        return num_spawned
+
+    def refresh_world(self, shard):
+        """Проверяет, не сменилась ли карта шарда; машины старого эпизода больше не держат точки спавна"""
+        metadata = shard.refresh_world()
+        if metadata is None:
+            return
+        lost = self.vehicle_pool.forget(shard)
+        for record in list(self.vehicle_index.values()):
+            if record.shard is shard:
+                record.spawn_point = None
+        self.console.log("🗺️ CARLA {}: новый эпизод {}, карта {}, пул машин очищен ({})",
+                         shard.name, metadata.episode_id, metadata.map_name, lost)
+
+    def spawn_on_shard(self, client_id, shard, points):
+        """Сначала машины из пула шарда, на остальные точки - SpawnActor + SetAutopilot одним apply_batch_sync.
+
+        Возвращает число машин.
+        """
+        SpawnActor = carla.command.SpawnActor
+        SetAutopilot = carla.command.SetAutopilot
+        FutureActor = carla.command.FutureActor
+
+        records, points, rejected_points = self.vehicle_pool.reuse(client_id, shard, points)
+        spawned = []  # [(actor_id, индекс точки)]
+        actors = {}
+        started = time.perf_counter()
+        try:
+            if points:
+                vehicle_bp = shard.metadata.current().blueprints("vehicle.*")[0]
+            for start in range(0, len(points), self.spawn_batch_size):
+                chunk = points[start:start + self.spawn_batch_size]
+                batch = [SpawnActor(vehicle_bp, shard.spawn_allocator.spawn_points[i])
+                         .then(SetAutopilot(FutureActor, True, shard.tm_port)) for i in chunk]
+                with self.tracer.span("apply_batch_sync", "rpc", {"shard": shard.name, "spawn": len(chunk)}):
+                    responses = shard.client.apply_batch_sync(batch, False)
+                for point, response in zip(chunk, responses):
+                    if response.error:
+                        rejected_points.append(point)
+                    else:
+                        spawned.append((response.actor_id, point))
+            # Объекты акторов получаем одним запросом
+            if spawned:
+                with self.tracer.span("get_actors", "rpc", {"shard": shard.name, "actors": len(spawned)}):
+                    actors = {actor.id: actor for actor in shard.world.get_actors([actor_id for actor_id, _ in spawned])}
+        except Exception as e:
+            self.console.log("❌ Ошибка спавна на шарде {}: {}", shard.name, e)
+            rejected_points += points
+            spawned = []
+
+        new_vehicles = 0
+        for actor_id, point in spawned:
+            vehicle = actors.get(actor_id)
+            if vehicle is None:
+                rejected_points.append(point)
+                continue
+            records.append(VehicleRecord(vehicle, shard, client_id, "autopilot", point))
+            new_vehicles += 1
+        if points:
+            self.vehicle_pool.record_spawn(new_vehicles, time.perf_counter() - started)
+        shard.spawn_allocator.release(rejected_points)
+        if not self.register_vehicles(client_id, records):
+            # Клиент отключился, пока шёл спавн: машины больше никому не принадлежат
+            self.teardown.destroy(records)
+            return 0
+        return len(records)
+
+    def collect_vehicle_states(self, client_id):
+        """Живые машины клиента из кэша текущего тика своих шардов: (записи, id, позиции x/y, скорости)"""
+        with self.vehicles_lock:
+            records = list(self.client_vehicles.get(client_id, {}).values())
+        by_shard = {}
+        for record in records:
+            by_shard.setdefault(record.shard, []).append(record)
+        if not by_shard:
+            return [], np.empty(0, dtype=np.int64), np.empty((0, 2)), np.empty(0)
+
+        def shard_states(shard):
+            shard_records = by_shard[shard]
+            actor_ids = np.fromiter((record.actor_id for record in shard_records), dtype=np.int64, count=len(shard_records))
+            alive, locations, _, speeds = shard.snapshot_cache.vehicle_states(actor_ids)
+            return [record for record, is_alive in zip(shard_records, alive.tolist()) if is_alive], locations[alive, :2], speeds[alive]
+
+        # Кэши разных шардов обновляются параллельно
+        results = self.map_shards(shard_states, list(by_shard))
+        records = [record for shard_records, _, _ in results for record in shard_records]
+        ids = np.fromiter((record.id for record in records), dtype=np.int64, count=len(records))
+        return records, ids, np.concatenate([r[1] for r in results]), np.concatenate([r[2] for r in results])
+
+    def format_vehicle_info(self, records, locations, speeds, fields=None):
+        """Формирует элементы сообщения vehicle_info (fields=None - все поля)"""
         vehicles_info = []
-        if client_id in self.client_vehicles:
-            for item in self.client_vehicles[client_id]:
-                vehicle = item["vehicle"]
-                if vehicle.is_alive:
-                    transform = vehicle.get_transform()
-                    velocity = vehicle.get_velocity()
-                    vehicles_info.append({
-                        "id": vehicle.id,
-                        "speed": round((velocity.x ** 2 + velocity.y ** 2 + velocity.z ** 2) ** 0.5, 2),
-                        "location": {"x": round(transform.location.x, 2), "y": round(transform.location.y, 2)},
-                        "control_mode": item["control_mode"]
-                    })
-            self.send_message(client_id, {"action": "vehicle_info", "vehicles": vehicles_info})
+        locations = np.round(locations, 2).tolist()
+        speeds = np.round(speeds, 2).tolist()
+        for record, (x, y), speed in zip(records, locations, speeds):
+            info = {"id": record.id}
+            if fields is None or "speed" in fields:
+                info["speed"] = speed
+            if fields is None or "location" in fields:
+                info["location"] = {"x": x, "y": y}
+            if fields is None or "control_mode" in fields:
+                info["control_mode"] = record.control_mode
+            vehicles_info.append(info)
+        return vehicles_info
+
+    def send_vehicle_info(self, client_id):
+        """Отправка информации о транспортных средствах клиента из кэша текущего тика (без RPC на машину)"""
+        records, _, locations, speeds = self.collect_vehicle_states(client_id)
+        self.send_message(client_id, {"action": "vehicle_info", "vehicles": self.format_vehicle_info(records, locations, speeds)})
+
+    def subscribe_vehicle_info(self, client_id, command):
+        """Подписка на vehicle_info: сервер сам присылает изменения с заданной частотой.
+
+        transport "shm" - клиент на том же хосте: полное состояние машин публикуется в
+        кольцо разделяемой памяти, в сокет идёт только сообщение shm_telemetry с его именем.
+        """
+        rate = min(max(float(command.get("rate", 5.0)), 0.1), 60.0)  # Гц
+        fields = set(command.get("fields") or ["location", "speed", "control_mode"])
+        ring = None
+        if command.get("transport") == "shm":
+            ring = self.open_ring(client_id, len(self.client_vehicles.get(client_id, ())))
+        self.drop_subscription(client_id)
+        self.subscriptions[client_id] = {
+            "ring": ring,
+            "interval": 1.0 / rate,
+            "fields": fields,
+            "threshold": float(command.get("threshold", 0.5)),  # м
+            "speed_threshold": float(command.get("speed_threshold", 0.2)),  # м/с
+            "next": time.monotonic(),
+            "full": True,  # следующая отправка - полный список
+            "ids": np.empty(0, dtype=np.int64),
+            "locations": np.empty((0, 2)),
+            "speeds": np.empty(0),
+            "modes": {},
+        }
+        self.subscriptions_changed.set()
+        if ring is not None:
+            self.send_message(client_id, {"action": "shm_telemetry", "name": ring.name, "capacity": ring.capacity(), "rate": rate})
+        self.console.log("📡 Клиент {} подписан на vehicle_info ({:g} Гц, {})", client_id, rate,
+                         "разделяемая память" if ring is not None else "поля: " + ", ".join(sorted(fields)))
+
+    def open_ring(self, client_id, vehicles):
+        """Кольцо разделяемой памяти под подписку клиента; None - не удалось, остаётся сокет"""
+        capacity = max(1024, 1 << (2 * vehicles - 1).bit_length())  # запас на дозаказ машин
+        try:
+            return shared_ring.RingWriter(f"carla_{os.getpid()}_{os.urandom(4).hex()}", capacity=capacity)
+        except Exception as e:
+            self.send_message(client_id, {"action": "error", "message": f"Разделяемая память недоступна: {e}"})
+            return None
+
+    def drop_subscription(self, client_id):
+        sub = self.subscriptions.pop(client_id, None)
+        if sub is not None and sub["ring"] is not None:
+            with self.rings_lock:
+                sub["ring"].close()
+
+    def publish_vehicle_states(self, client_id, sub):
+        """Полное состояние машин клиента в кольцо: без JSON, дельт и записи в сокет"""
+        records, ids, locations, speeds = self.collect_vehicle_states(client_id)
+        state = np.empty(len(ids), dtype=shared_ring.VEHICLE_DTYPE)
+        state["id"] = ids
+        state["x"] = locations[:, 0]
+        state["y"] = locations[:, 1]
+        state["speed"] = speeds
+        state["mode"] = np.fromiter((shared_ring.MODE_CODES.get(record.control_mode, 0) for record in records),
+                                    dtype=np.uint8, count=len(records))
+        with self.rings_lock:
+            ring = sub["ring"]
+            if ring.closed:
+                return
+            if len(state) > ring.capacity():
+                # Машин стало больше, чем помещается в слот: новое кольцо, клиент переподключится
+                replacement = self.open_ring(client_id, len(state))
+                if replacement is None:
+                    return
+                ring.close()
+                sub["ring"] = ring = replacement
+                self.send_message(client_id, {"action": "shm_telemetry", "name": ring.name, "capacity": ring.capacity(),
+                                              "rate": 1.0 / sub["interval"]})
+            ring.publish(shared_ring.KIND_VEHICLES, state)
+
+    def telemetry_push_loop(self):
+        """Рассылка обновлений подписчикам по их собственному расписанию"""
+        while True:
+            if not self.subscriptions:
+                self.subscriptions_changed.wait()
+            self.subscriptions_changed.clear()
+            now = time.monotonic()
+            for client_id, sub in self.subscriptions.items():
+                if sub["next"] > now:
+                    continue
+                sub["next"] = now + sub["interval"]
+                try:
+                    self.push_vehicle_updates(client_id, sub)
+                except Exception as e:
+                    self.console.log("❌ Ошибка рассылки телеметрии клиенту {}: {}", client_id, e)
+            upcoming = [sub["next"] for sub in self.subscriptions.values()]
+            if upcoming:
+                self.subscriptions_changed.wait(max(0.0, min(upcoming) - time.monotonic()))
+
+    def push_vehicle_updates(self, client_id, sub):
+        """Отправляет только машины, сместившиеся или изменившие скорость больше порога, и удалённые id"""
+        if sub["ring"] is not None:
+            self.publish_vehicle_states(client_id, sub)
+            return
+        records, ids, locations, speeds = self.collect_vehicle_states(client_id)
+        modes = [record.control_mode for record in records]
+        if sub["full"]:
+            changed = np.ones(len(ids), dtype=bool)
+            removed = []
+            last_locations, last_speeds = locations.copy(), speeds.copy()
+        else:
+            # Сопоставляем текущие машины с последним отправленным состоянием
+            order = np.argsort(sub["ids"])
+            known_ids = sub["ids"][order]
+            rows = np.minimum(np.searchsorted(known_ids, ids), max(len(known_ids) - 1, 0))
+            known = (known_ids[rows] == ids) if len(known_ids) else np.zeros(len(ids), dtype=bool)
+            prev_locations = sub["locations"][order][rows] if len(known_ids) else np.zeros_like(locations)
+            prev_speeds = sub["speeds"][order][rows] if len(known_ids) else np.zeros_like(speeds)
+            moved = np.hypot(*(locations - prev_locations).T) > sub["threshold"]
+            accelerated = np.abs(speeds - prev_speeds) > sub["speed_threshold"]
+            mode_changed = np.fromiter((sub["modes"].get(actor_id) != mode for actor_id, mode in zip(ids.tolist(), modes)),
+                                       dtype=bool, count=len(ids))
+            changed = ~known | moved | accelerated | mode_changed
+            removed = np.setdiff1d(sub["ids"], ids).tolist()
+            # Для неотправленных машин храним старое значение, чтобы накапливать смещение
+            last_locations = np.where(changed[:, None], locations, prev_locations)
+            last_speeds = np.where(changed, speeds, prev_speeds)
+
+        if sub["full"] or changed.any() or removed:
+            indices = np.flatnonzero(changed).tolist()
+            self.send_message(client_id, {
+                "action": "vehicle_info",
+                "subscription": True,
+                "full": sub["full"],
+                "vehicles": self.format_vehicle_info([records[i] for i in indices], locations[changed], speeds[changed],
+                                                     sub["fields"]),
+                "removed": removed,
+            }, kind=self.SUBSCRIPTION_KIND)
+        sub.update(full=False, ids=ids, locations=last_locations, speeds=last_speeds,
+                   modes=dict(zip(ids.tolist(), modes)))
+    def open_session(self, client_id):
+        """Выдаёт новому соединению токен возобновления сессии"""
+        if self.sessions.grace_period > 0:
+            self.send_message(client_id, {"action": "session", "client_id": client_id,
+                                          "token": self.sessions.issue(client_id), "grace": self.sessions.grace_period})
+
+    def end_session(self, client_id):
+        """Клиент уходит насовсем: токен отзывается, отсоединённая сессия не ждёт возобновления"""
+        self.sessions.revoke(client_id)
+        if isinstance(self.clients.get(client_id), DetachedConnection):
+            self.teardown.cancel(client_id)
+        self.cleanup_client(client_id)
+
+    def evict_client(self, client_id, connection):
+        """Сервер сам разрывает соединение не успевающего клиента: сессия не ждёт возобновления, отключение сразу"""
+        with self.sessions.handover:
+            if self.clients.get(client_id) is not connection:
+                return  # соединение уже заменено отсоединённой сессией или новым соединением
+            self.sessions.revoke(client_id)
+            connection.abort()
+            # Срок ожидания (медленного клиента или возобновления) заменяется немедленным отключением
+            self.teardown.cancel(client_id)
+            if self.teardown.schedule(client_id, 0):
+                self.sessions.stats["evicted"] += 1
+
+    def connection_lost(self, client_id, connection):
+        """Соединение закрылось: после disconnect или разрыва сервером - обычное отключение, иначе сессия ждёт возобновления"""
+        with self.sessions.handover:
+            if self.clients.get(client_id) is not connection:
+                return  # сессию уже забрало новое соединение
+            if self.sessions.token(client_id) is None:
+                self.cleanup_client(client_id)
+                return
+            self.clients[client_id] = DetachedConnection(client_id, self.client_codecs.get(client_id),
+                                                         self.on_message_dropped(client_id))
+            connection.abort()
+            self.client_decoders.pop(client_id, None)
+            # Срок, назначенный медленному клиенту, заменяется сроком возобновления
+            self.teardown.cancel(client_id)
+            self.teardown.schedule(client_id, self.sessions.grace_period)
+            self.sessions.stats["detached"] += 1
+        # Без водителя ручные машины возвращаются под автопилот; камеры и воспроизведение не ждут клиента
+        for record in list(self.client_vehicles.get(client_id, {}).values()):
+            if record.control_mode == "manual":
+                self.release_vehicle_control(client_id, record.id)
+        self.close_video_streams(client_id)
+        replay = self.replays.pop(client_id, None)
+        if replay is not None:
+            replay.stop()
+        self.console.log("📴 Клиент {} потерял соединение: машин {}, сессия ждёт возобновления {:g} с", client_id,
+                         len(self.client_vehicles.get(client_id, ())), self.sessions.grace_period)
+
+    def resume_session(self, client_id, command):
+        """Новое соединение забирает сессию по токену: прежний ID, машины, подписки и пропущенные сообщения"""
+        with self.sessions.handover:
+            session_id = self.sessions.lookup(command.get("token"))
+            connection = self.clients.get(client_id)
+            if connection is None or session_id == client_id:
+                return
+            previous = self.clients.get(session_id) if session_id is not None else None
+            # Отсоединённую сессию нельзя забрать, если её отключение уже началось
+            cancelled = previous is not None and self.teardown.cancel(session_id)
+            if previous is None or (isinstance(previous, DetachedConnection) and not cancelled):
+                self.sessions.stats["rejected"] += 1
+                self.send_message(client_id, {"action": "session_expired", "client_id": client_id,
+                                              "token": self.sessions.token(client_id)})
+                return
+
+            # Соединение переходит на ID сессии вместе с кодеком и декодером; временный ID больше не нужен
+            self.sessions.revoke(client_id)
+            codec = self.client_codecs.pop(client_id, None)
+            self.client_decoders[session_id] = self.client_decoders.pop(client_id)
+            if codec is None:
+                self.client_codecs.pop(session_id, None)
+            else:
+                self.client_codecs[session_id] = codec
+            if client_id in self.client_info:
+                self.client_info[session_id] = self.client_info.pop(client_id)
+            metrics = self.client_metrics.pop(client_id, None)
+            if metrics is not None:
+                # Устройство то же: его последние значения продолжают ряд сессии
+                series = self.client_metrics.get(session_id)
+                if series is None:
+                    self.client_metrics[session_id] = metrics
+                else:
+                    series.append(time.time(), metrics.latest)
+            with self.vehicles_lock:
+                leftovers = self.client_vehicles.pop(client_id, {})
+                for record in leftovers.values():
+                    record.owner = session_id
+                self.client_vehicles[session_id].update(leftovers)
+                vehicle_ids = list(self.client_vehicles[session_id])
+            connection.client_id = session_id
+            connection.queue.on_drop = self.on_message_dropped(session_id)
+            self.clients.pop(client_id, None)
+            self.clients[session_id] = connection
+        # Подписки, видео и запросы временного ID остались бы без адресата - у сессии свои
+        self.drop_client_streams(client_id)
+
+        if isinstance(previous, DetachedConnection):
+            held = previous.take_all()
+            if previous.codec != codec:
+                held = []  # накоплено в другом кодеке - состояние восстановит полная рассылка подписки
+            detached_for = time.monotonic() - previous.since
+            self.sessions.stats["resumed"] += 1
         else:
-            self.send_message(client_id, {"action": "vehicle_info", "vehicles": []})
+            previous.abort()  # полуоткрытое старое соединение, о разрыве которого сервер ещё не узнал
+            held, detached_for = [], 0.0
+            self.sessions.stats["taken_over"] += 1
+        self.send_message(session_id, {"action": "session_resumed", "client_id": session_id,
+                                       "token": self.sessions.token(session_id), "vehicles": vehicle_ids,
+                                       "missed": len(held)})
+        for data in held:
+            connection.send(data)
+        subscription = self.subscriptions.get(session_id)
+        if subscription is not None:
+            # Дельты, ушедшие в оборванный сокет, потеряны - следующая рассылка полная
+            subscription["full"] = True
+            if subscription["ring"] is not None:
+                ring = subscription["ring"]
+                self.send_message(session_id, {"action": "shm_telemetry", "name": ring.name, "capacity": ring.capacity(),
+                                               "rate": 1.0 / subscription["interval"]})
+        self.console.log("🔁 Клиент {} возобновил сессию {} через {:.1f} с: машин {}, пропущенных сообщений {}",
+                         client_id, session_id, detached_for, len(vehicle_ids), len(held))
+
     def cleanup_client(self, client_id):
-        """Очистка информации о клиенте и уничтожение его транспортных средств с задержкой 5 секунд."""
-        if client_id in self.clients:
+        """Планирует отключение клиента: машины уничтожаются в фоне по истечении grace period, вызов не блокируется."""
+        if client_id in self.clients and self.teardown.schedule(client_id):
+            grace = self.teardown.grace_period
             self.send_message(client_id, {
                 "action": "disconnect_warning",
-                "message": "Время ожидания истекло. Через 5 секунд произойдет отключение."
+                "message": f"Время ожидания истекло. Через {grace:g} секунд произойдет отключение."
             })
-            print(f"Отключение клиента {client_id} через 5 секунд...")
-            time.sleep(5)
-            if client_id in self.client_vehicles:
-                for item in self.client_vehicles[client_id]:
-                    vehicle = item["vehicle"]
-                    try:
-                        if vehicle and vehicle.is_alive:
-                            print(f"Уничтожение автомобиля {vehicle.id} (клиент {client_id})...")
-                            vehicle.destroy()
-                            print(f"Автомобиль {vehicle.id} уничтожен.")
-                        else:
-                            print(f"Автомобиль {vehicle.id} уже не активен (клиент {client_id}).")
-                    except Exception as e:
-                        print(f"Ошибка уничтожения автомобиля {vehicle.id}: {e}")
-                del self.client_vehicles[client_id]
-            if client_id in self.clients:
-                self.clients[client_id].close()
-                del self.clients[client_id]
-            print(f"Клиент {client_id} отключен.")
+            self.console.log("Отключение клиента {} через {:g} секунд...", client_id, grace)
 
-    def send_message(self, client_id, message):
-        """Отправка JSON-сообщения клиенту"""
-        try:
-            if client_id in self.clients:
-                self.clients[client_id].send((json.dumps(message) + "\n").encode())
-        except (BrokenPipeError, ConnectionResetError):
-            print(f"Ошибка отправки сообщения клиенту {client_id}: соединение потеряно.")
+    def drop_client_streams(self, client_id):
+        """Забывает подписки, запросы на спавн, видео и воспроизведение клиента"""
+        self.drop_subscription(client_id)
+        self.tick_listeners.pop(client_id, None)
+        self.admission.cancel(client_id)
+        self.close_video_streams(client_id)
+        replay = self.replays.pop(client_id, None)
+        if replay is not None:
+            replay.stop()
+
+    def finish_client_teardown(self, client_id):
+        """Закрывает соединение клиента и возвращает его машины для пакетного уничтожения"""
+        with self.vehicles_lock:
+            records = list(self.client_vehicles.pop(client_id, {}).values())
+            for record in records:
+                self.vehicle_index.pop(record.id, None)
+        connection = self.clients.pop(client_id, None)
+        if self.sessions.revoke(client_id) and isinstance(connection, DetachedConnection):
+            self.sessions.stats["expired"] += 1
+        self.client_decoders.pop(client_id, None)
+        self.client_codecs.pop(client_id, None)
+        self.client_metrics.pop(client_id, None)  # временной ряд нужен только подключённому клиенту
+        self.drop_client_streams(client_id)
+        if connection is not None:
+            connection.close()
+        self.console.log("Клиент {} отключен.", client_id)
+        return records
+
+    def destroy_vehicles(self, records):
+        """Уничтожает машины пакетами DestroyActor (шарды параллельно), возвращает (уничтожено, ошибок)"""
+        DestroyActor = carla.command.DestroyActor
+        by_shard = {}
+        for record in records:
+            by_shard.setdefault(record.shard, []).append(record)
+
+        def destroy_on_shard(shard):
+            shard_records = by_shard[shard]
+            destroyed = failed = 0
+            freed = []  # точки только уничтоженных машин: уцелевшая машина всё ещё стоит на своей
+            for start in range(0, len(shard_records), self.spawn_batch_size):
+                chunk = shard_records[start:start + self.spawn_batch_size]
+                try:
+                    with self.tracer.span("apply_batch_sync", "rpc", {"shard": shard.name, "destroy": len(chunk)}):
+                        responses = shard.client.apply_batch_sync([DestroyActor(record.actor_id) for record in chunk], False)
+                except Exception as e:
+                    self.console.log("Ошибка пакетного уничтожения машин на шарде {}: {}", shard.name, e)
+                    failed += len(chunk)
+                    continue
+                for record, response in zip(chunk, responses):
+                    if response.error:
+                        failed += 1
+                    else:
+                        destroyed += 1
+                        freed.append(record.spawn_point)
+            shard.spawn_allocator.release(freed)
+            return destroyed, failed
+
+        results = self.map_shards(destroy_on_shard, list(by_shard))
+        return sum(r[0] for r in results), sum(r[1] for r in results)
+
+    def release_spawn_points(self, records):
+        """Освобождает точки спавна уничтоженных машин"""
+        for record in records:
+            record.shard.spawn_allocator.release([record.spawn_point])
+
+    def add_vehicle(self, client_id, vehicle, control_mode="autopilot", spawn_point=None, shard=None):
+        record = VehicleRecord(vehicle, shard or self.shards[0], client_id, control_mode, spawn_point)
+        return record if self.register_vehicles(client_id, [record]) else None
+
+    def register_vehicles(self, client_id, records):
+        """Добавляет машины клиенту одной блокировкой; False, если клиент уже отключён"""
+        with self.vehicles_lock:
+            vehicles = self.client_vehicles.get(client_id)
+            if vehicles is None:
+                return False
+            for record in records:
+                vehicles[record.id] = record
+                self.vehicle_index[record.id] = record
+        return True
+
+    def detach_vehicle(self, vehicle_id):
+        """Убирает машину из индекса и у владельца за O(1), возвращает запись или None"""
+        with self.vehicles_lock:
+            record = self.vehicle_index.pop(vehicle_id, None)
+            if record is not None:
+                self.client_vehicles.get(record.owner, {}).pop(vehicle_id, None)
+            return record
+
+    def transfer_vehicle(self, vehicle_id, new_owner):
+        """Передаёт машину другому клиенту за O(1)"""
+        with self.vehicles_lock:
+            record = self.vehicle_index.get(vehicle_id)
+            if record is None or new_owner not in self.client_vehicles:
+                return False
+            self.client_vehicles.get(record.owner, {}).pop(vehicle_id, None)
+            record.owner = new_owner
+            self.client_vehicles[new_owner][vehicle_id] = record
+            return True
+
+    def send_message(self, client_id, message, kind=None):
+        """Ставит сообщение в очередь клиента в согласованном формате (JSON-строка или кадр).
+
+        kind задают только рассылки телеметрии: более свежее сообщение того же вида вытесняет
+        старое из очереди. Ответы на запросы (kind=None) не вытесняются.
+        """
+        connection = self.clients.get(client_id)
+        if connection is None:
+            return
+        action = message.get("action")
+        started = time.perf_counter_ns()
+        data = protocol.encode_message(message, self.client_codecs.get(client_id))
+        queued = connection.send(data, kind)
+        if self.tracer.enabled:
+            self.tracer.complete("send", "net", started, time.perf_counter_ns(),
+                                 {"client": client_id, "action": action, "bytes": len(data)})
+        if not queued:
+            self.console.log("🐢 Клиент {} не успевает получать данные, соединение разорвано.", client_id)
+            self.evict_client(client_id, connection)
+
+    def on_message_dropped(self, client_id):
+        """Отброшенная дельта телеметрии - следующая рассылка подписки должна быть полной"""
+        def resync(kind):
+            subscription = self.subscriptions.get(client_id)
+            if subscription is not None and kind == self.SUBSCRIPTION_KIND:
+                subscription["full"] = True
+            elif isinstance(kind, tuple) and kind[0] == "video":
+                stream = self.video_streams.get(client_id, {}).get(kind[1])
+                if stream is not None:
+                    stream.on_dropped()
+        return resync
 
     def server_menu(self):
         """Меню управления сервером"""
@@ -202,6 +3007,23 @@ class CarlaServer:
             print("7. Отключить все (убить все транспортные средства)")
             print("8. Показать информацию о клиентах")
             print("9. Выход")
+            print("10. Статистика очистки клиентов")
+            print("11. Передать автомобиль другому клиенту")
+            print("12. Очереди отправки клиентов")
+            print("13. Синхронный режим (вкл/выкл)")
+            print("14. Статистика тиков и управления")
+            print("15. Загрузка экземпляров CARLA")
+            print("16. Допуск спавна: очередь и ограничения")
+            print("17. Видеопотоки клиентов")
+            print("18. Запись телеметрии (вкл/выкл)")
+            print("19. Блокировки состояния: ожидание и удержание")
+            print("20. Статистика команд: задержки по действиям")
+            print("21. Трассировка Chrome trace (вкл/выкл)")
+            print("22. Пул припаркованных машин")
+            print("23. Кэш карт и чертежей CARLA")
+            print("24. Режим большого парка: гибридная физика (вкл/выкл)")
+            print("25. FPS симулятора по режимам и числу акторов")
+            print("26. Сессии клиентов: ожидающие возобновления")
 
             choice = input("Выберите действие: ")
             if choice == "1":
@@ -213,7 +3035,7 @@ class CarlaServer:
                 self.remove_vehicle_by_id(vehicle_id)
             elif choice == "4":
                 client_id = input("Введите ID клиента для отключения: ")
-                self.cleanup_client(client_id)
+                self.end_session(client_id)
             elif choice == "5":
                 if not hasattr(self, "monitor_thread") or not self.monitor_thread.is_alive():
                     self.monitoring_active = True
@@ -234,36 +3056,82 @@ class CarlaServer:
                 self.show_clients_table()
             elif choice == "9":
                 break
+            elif choice == "10":
+                self.show_teardown_stats()
+            elif choice == "11":
+                vehicle_id = int(input("Введите ID машины: "))
+                client_id = input("Введите ID нового владельца: ")
+                if self.transfer_vehicle(vehicle_id, client_id):
+                    print(f"Автомобиль {vehicle_id} передан клиенту {client_id}.")
+                else:
+                    print("Автомобиль или клиент не найден.")
+            elif choice == "12":
+                self.show_outbound_queues()
+            elif choice == "13":
+                if self.tick_coordinator.running:
+                    self.tick_coordinator.disable()
+                else:
+                    self.tick_coordinator.enable()
+            elif choice == "14":
+                self.show_tick_stats()
+            elif choice == "15":
+                self.show_shards()
+            elif choice == "16":
+                self.show_admission()
+            elif choice == "17":
+                self.show_video_streams()
+            elif choice == "18":
+                if self.recorder.running:
+                    self.recorder.stop()
+                    self.show_recorder_stats()
+                elif self.recorder.start() is None:
+                    print("⚠️ Нет подключения к CARLA - записывать нечего")
+            elif choice == "19":
+                self.show_lock_stats()
+            elif choice == "20":
+                self.show_command_stats()
+            elif choice == "21":
+                self.toggle_trace()
+            elif choice == "22":
+                self.show_vehicle_pool()
+            elif choice == "23":
+                self.show_world_metadata()
+            elif choice == "24":
+                if self.fleet.enabled:
+                    self.fleet.disable()
+                else:
+                    self.fleet.enable()
+            elif choice == "25":
+                self.show_fleet_stats()
+            elif choice == "26":
+                self.show_sessions()
 
     def show_clients(self):
         """Выводит список клиентов"""
         print("\n🔗 Клиенты на сервере:")
-        for client_id in self.clients.keys():
-            print(f"🔹 {client_id}")
+        for client_id, connection in self.clients.items():
+            print(f"🔹 {client_id}" + (" (ждёт возобновления сессии)" if isinstance(connection, DetachedConnection) else ""))
 
     def show_vehicles(self):
         """Вывод списка транспортных средств"""
         print("\nТранспортные средства:")
-        for client_id, vehicles in self.client_vehicles.items():
-            for item in vehicles:
-                vehicle = item["vehicle"]
-                mode = item["control_mode"]
-                print(f" - ID: {vehicle.id}, Клиент: {client_id}, Режим: {mode}")
+        for record in list(self.vehicle_index.values()):
+            print(f" - ID: {record.id}, Клиент: {record.owner}, Режим: {record.control_mode}, CARLA: {record.shard.name}")
 
     def remove_vehicle_by_id(self, vehicle_id):
         """Удаление автомобиля по его ID"""
-        for client_id, vehicles in self.client_vehicles.items():
-            for item in vehicles:
-                if item["vehicle"].id == vehicle_id:
-                    try:
-                        item["vehicle"].destroy()
-                        vehicles.remove(item)
-                        print(f"Автомобиль {vehicle_id} удален.")
-                        return
-                    except Exception as e:
-                        print(f"Ошибка удаления автомобиля {vehicle_id}: {e}")
-                        return
-        print("Автомобиль не найден.")
+        record = self.detach_vehicle(vehicle_id)
+        if record is None:
+            print("Автомобиль не найден.")
+            return
+        streams = self.video_streams.get(record.owner, {})
+        self.close_video_streams(record.owner, [sid for sid, stream in streams.items() if stream.record is record])
+        try:
+            record.vehicle.destroy()
+            print(f"Автомобиль {vehicle_id} удален.")
+        except Exception as e:
+            print(f"Ошибка удаления автомобиля {vehicle_id}: {e}")
+        self.release_spawn_points([record])
 
     def monitor_resources_loop(self):
         """Непрерывный мониторинг ресурсов с возможностью остановки"""
@@ -292,23 +3160,216 @@ class CarlaServer:
         self.monitoring_active = False
 
     def cleanup_all(self):
-        """Удаляет всех клиентов и машины на сервере"""
+        """Удаляет всех клиентов и машины на сервере (без ожидания, очистка идёт в фоне)"""
         print("\n🧹 Очистка CARLA от всех машин и клиентов...")
 
-        # Удаляем все машины
-        all_vehicles = self.world.get_actors().filter("vehicle.*")
-        for vehicle in all_vehicles:
-            try:
-                vehicle.destroy()
-                print(f"✅ Машина {vehicle.id} удалена")
-            except Exception as e:
-                print(f"❌ Ошибка при удалении машины {vehicle.id}: {e}")
+        # Машины без владельца и из пула уничтожаем сразу, машины клиентов - вместе с их отключением
+        parked = self.vehicle_pool.drain()
+        parked_ids = {record.id for record in parked}
+
+        def shard_orphans(shard):
+            records = (VehicleRecord(vehicle, shard) for vehicle in shard.world.get_actors().filter("vehicle.*"))
+            return [record for record in records if record.id not in self.vehicle_index and record.id not in parked_ids]
+
+        orphans = [record for records in self.map_shards(shard_orphans) for record in records] + parked
+        self.teardown.destroy(orphans)
 
         # Отключаем всех клиентов
-        for client_id in list(self.clients.keys()):  # Создаём копию списка ключей, чтобы изменять словарь в процессе
-            self.cleanup_client(client_id)
+        for client_id in self.clients.keys():  # Снимок: отключение не меняет обходимый словарь
+            self.end_session(client_id)
 
-        print("🛑 Все машины и клиенты успешно удалены!")
+        print(f"🛑 Очистка запланирована: машин без владельца {len(orphans)}, клиентов {self.teardown.queue_depth()['clients']}")
+
+    def show_outbound_queues(self):
+        """Заполненность очередей отправки и отброшенная телеметрия по клиентам"""
+        table = PrettyTable()
+        table.field_names = ["Client ID", "В очереди, КБ", "Поставлено", "Отправлено, КБ", "Записей", "Отброшено"]
+        for client_id, connection in self.clients.items():
+            queue = connection.queue
+            table.add_row([client_id, f"{queue.size / 1024:.1f}", queue.stats["queued"],
+                           f"{queue.stats['sent_bytes'] / 1024:.1f}", queue.stats["writes"], queue.stats["dropped"]])
+        print("\n" + table.get_string() + "\n")
+
+    def show_tick_stats(self):
+        """Длительность тиков, размер пакетов управления и опоздавшие клиенты"""
+        control = self.tick_coordinator.control_stats
+        print(f"\n🎮 Команд управления: {control['submitted']}, вытеснено более новыми: {control['coalesced']}, "
+              f"применено {control['applied']} в {control['batches']} пакетах")
+        stats = self.tick_coordinator.stats()
+        if stats is None:
+            print("⚠️ Синхронный режим ещё не запускался")
+            return
+        print(f"\n⏱️ Последний тик: {stats['last_tick']}, за последние {stats['ticks']} тиков: "
+              f"среднее {stats['mean_ms']:.1f} мс, макс. {stats['max_ms']:.1f} мс "
+              f"(шаг {self.tick_coordinator.fixed_delta * 1000:.0f} мс)")
+        print(f"Пакет управления: в среднем {stats['mean_batch']:.1f}, макс. {stats['max_batch']} машин")
+        print(f"Опоздавшие клиенты: {', '.join(stats['late']) if stats['late'] else 'нет'}")
+
+    def show_shards(self):
+        """Машины сервера, акторы, длительность тика и свободные точки спавна по шардам"""
+        vehicles = {}
+        for record in list(self.vehicle_index.values()):
+            vehicles[record.shard] = vehicles.get(record.shard, 0) + 1
+        table = PrettyTable()
+        table.field_names = ["Шард", "CARLA", "Машин сервера", "Акторов", "Тик, мс", "Свободных точек", "Нагрузка"]
+        for shard in self.shards:
+            table.add_row([shard.index, shard.name, vehicles.get(shard, 0), shard.snapshot_cache.actor_count(),
+                           f"{shard.snapshot_cache.tick_seconds * 1000:.1f}", shard.spawn_allocator.available(),
+                           f"{shard.load():.2f}"])
+        print("\n" + table.get_string() + "\n")
+
+    def show_fleet_stats(self):
+        """Детализация машин в режиме большого парка и FPS симулятора по режимам"""
+        fleet = self.fleet
+        stats = dict(fleet.stats)
+        names = {"default": "обычный", "large_fleet": "большой парк"}
+        print(f"\n🚦 Режим: {names[fleet.mode()]}; радиус полной физики {fleet.radius:.0f} м, "
+              f"возрождение уснувших машин: {'да' if fleet.respawn_dormant else 'нет'}")
+        if fleet.enabled:
+            print(f"Машин в фокусе (ручное управление, камера): {stats['focus']}, с полной физикой: {stats['detail']}, "
+                  f"в гибридном режиме: {stats['fleet']}; переводов в детальный TM {stats['promoted']}, "
+                  f"обратно {stats['demoted']}, проход {stats['last_ms']:.1f} мс")
+        with fleet.lock:
+            samples = {mode: {bucket: list(entry) for bucket, entry in buckets.items()} for mode, buckets in fleet.samples.items()}
+        if not samples:
+            print("⚠️ Замеров FPS ещё нет")
+            return
+        modes = [mode for mode in ("default", "large_fleet") if mode in samples]
+        table = PrettyTable(["Акторов до"] + [f"FPS: {names[mode]} (мин.)" for mode in modes])
+        for bucket in sorted({bucket for mode in modes for bucket in samples[mode]}):
+            row = [bucket]
+            for mode in modes:
+                entry = samples[mode].get(bucket)
+                row.append(f"{entry[1] / entry[0]:.1f} ({entry[2]:.1f})" if entry else "-")
+            table.add_row(row)
+        print(table)
+
+    def show_admission(self):
+        """Очередь запросов на спавн, текущий бюджет и причина ограничения"""
+        admission = self.admission
+        factor, reason, shards = admission.health()
+        depth = admission.queue_depth()
+        stats = dict(admission.stats)
+        print(f"\n🚦 Бюджет раунда: {int(admission.round_budget * factor)}/{admission.round_budget} машин"
+              f"{f' (ограничение: {reason})' if factor < 1.0 else ''}, шардов в пределах тика: {len(shards)}/{len(self.shards)}")
+        print(f"Квота на клиента: {admission.client_quota if admission.client_quota is not None else 'нет'}; "
+              f"в очереди: клиентов {depth['clients']}, машин {depth['vehicles']}")
+        print(f"Запросов: {stats['requests']}, выдано машин: {stats['granted']}, отклонено: {stats['rejected']}, "
+              f"раундов без спавна: {stats['throttled_rounds']}, макс. ожидание {stats['max_wait_ms']:.0f} мс")
+
+    def show_video_streams(self):
+        """Время сжатия, размер кадра и частота кадров по каждому видеопотоку"""
+        table = PrettyTable()
+        table.field_names = ["Поток", "Клиент", "Машина", "Формат", "Разрешение", "Качество", "Сжатие, мс",
+                             "Кадр, КБ", "к/с", "Доставлено к/с", "Пропущено", "Вытеснено"]
+        for client_id, streams in self.video_streams.items():
+            for stream_id, stream in list(streams.items()):
+                info = stream.summary()
+                table.add_row([stream_id, client_id, info["vehicle"], info["format"], info["resolution"], info["quality"],
+                               f"{info['encode_ms']:.1f}", f"{info['frame_kb']:.1f}", f"{info['fps']:.1f}",
+                               f"{info['delivered_fps']:.1f}", info["skipped"], info["dropped"]])
+        print("\n" + table.get_string() + "\n")
+
+    def show_recorder_stats(self):
+        """Сколько записано и во что обходится запись одного тика"""
+        stats = dict(self.recorder.stats)
+        capture = list(self.recorder.capture_ms)
+        print(f"\n⏺️ Запись {self.recorder.name}: тиков {stats['ticks']}, строк {stats['rows']}, "
+              f"пропущено тиков {stats['missed']}")
+        if capture:
+            print(f"Запись тика: среднее {sum(capture) / len(capture):.2f} мс, макс. {max(capture):.2f} мс")
+
+    def show_lock_stats(self):
+        """Конкуренция за блокировки состояния сервера: доля захватов с ожиданием, время ожидания и удержания"""
+        locks = [(lock.name, lock.summary())
+                 for lock in (self.clients_lock, self.vehicles_lock, self.client_info_lock, self.subscriptions_lock)]
+        table = PrettyTable()
+        table.field_names = ["Блокировка", "Захватов", "С ожиданием", "Ожидание ср., мкс", "Ожидание макс., мкс",
+                             "Удержание ср., мкс", "Удержание макс., мкс"]
+        for name, stats in locks:
+            acquired = max(1, stats["acquired"])
+            table.add_row([name, stats["acquired"], f"{stats['contended'] / acquired:.1%}",
+                           f"{stats['wait_ns'] / max(1, stats['contended']) / 1000:.1f}", f"{stats['max_wait_ns'] / 1000:.1f}",
+                           f"{stats['hold_ns'] / acquired / 1000:.1f}", f"{stats['max_hold_ns'] / 1000:.1f}"])
+        print("\n" + table.get_string() + "\n")
+
+    def show_command_stats(self):
+        """Сколько раз и как долго выполнялась каждая команда; сверху - больше всего суммарного времени"""
+        table = PrettyTable()
+        table.field_names = ["Команда", "Вызовов", "Ошибок", "Всего, мс", "Среднее, мс", "p50 ≤, мс", "p99 ≤, мс", "Макс., мс"]
+        for action, stats in self.commands.summary():
+            table.add_row([action, stats["count"], stats["errors"], f"{stats['total_ms']:.1f}", f"{stats['mean_ms']:.3f}",
+                           f"{stats['p50_ms']:.3f}", f"{stats['p99_ms']:.3f}", f"{stats['max_ms']:.2f}"])
+        print("\n" + table.get_string())
+        log = dict(self.console.stats)
+        print(f"Неизвестных команд: {self.commands.unknown}; журнал: строк {log['logged']}, выведено {log['printed']}, "
+              f"пропущено {log['suppressed']} (лимит {self.console.rate:g}/с)\n")
+
+    def toggle_trace(self, path=None):
+        if self.tracer.enabled:
+            path, events = self.tracer.stop()
+            print(f"🧵 Трасса записана: {path} ({events} событий), открыть в chrome://tracing или ui.perfetto.dev")
+            return
+        path = path or os.path.join("traces", time.strftime("trace_%Y%m%d_%H%M%S.json"))
+        self.tracer.start(path)
+        print(f"🧵 Трассировка включена (recv, decode, команды, вызовы CARLA, send), файл: {path}")
+
+    def show_vehicle_pool(self):
+        """Сколько машин припарковано и насколько выдача из пула дешевле нового спавна"""
+        pool = self.vehicle_pool
+        stats = dict(pool.stats)
+        sizes = pool.size()
+        requested = stats["reused"] + stats["spawned"]
+        print(f"\n🅿️ Пул машин: {sum(sizes.values())} (лимит {pool.max_size} на шард"
+              f"{', выключен' if not pool.max_size else ''}); "
+              + ", ".join(f"{shard.name}: {sizes.get(shard, 0)}" for shard in self.shards))
+        print(f"Припарковано: {stats['parked']}, выдано из пула: {stats['reused']}, создано новых: {stats['spawned']}, "
+              f"попаданий: {stats['reused'] / requested if requested else 0.0:.1%}; "
+              f"уничтожено сверх лимита: {stats['evicted']}, ошибок: {stats['failed']}")
+        print(f"На машину: из пула {stats['reuse_ms'] / max(1, stats['reused']):.3f} мс, "
+              f"новый спавн {stats['spawn_ms'] / max(1, stats['spawned']):.3f} мс")
+
+    def show_world_metadata(self):
+        """Карты шардов, версии метаданных и сколько запросов обошлось без get_map"""
+        table = PrettyTable(["Шард", "CARLA", "Карта", "Версия", "Эпизод", "Попаданий", "Проверок", "Загрузок карты", "Загрузка, мс"])
+        for shard in self.shards:
+            cache = shard.metadata
+            metadata, stats = cache.metadata, dict(cache.stats)
+            table.add_row([shard.index, shard.name, metadata.map_name if metadata else "-", metadata.version if metadata else "-",
+                           metadata.episode_id if metadata else "-", stats["hits"], stats["checks"], stats["loads"],
+                           f"{stats['load_ms'] / max(1, stats['episodes']):.1f}"])
+        print("\n🗺️ Метаданные миров (проверка смены карты не чаще раза в "
+              f"{self.shards[0].metadata.check_interval if self.shards else 0:.0f} с):")
+        print(table)
+
+    def show_teardown_stats(self):
+        """Глубина очереди отключения и задержки уничтожения машин"""
+        depth = self.teardown.queue_depth()
+        stats = dict(self.teardown.stats)
+        print(f"\n🧹 В очереди: клиентов {depth['clients']}, машин {depth['vehicles']}")
+        print(f"Запланировано: {stats['scheduled']}, отменено: {stats['cancelled']}, завершено: {stats['completed']}, "
+              f"уничтожено машин: {stats['destroyed']}, ошибок: {stats['failed']}, пакетов: {stats['batches']}")
+        print(f"Пакет DestroyActor: последний {stats['last_batch_ms']:.1f} мс, макс. {stats['max_batch_ms']:.1f} мс; "
+              f"макс. задержка от срока до уничтожения {stats['max_delay_ms']:.1f} мс")
+
+    def show_sessions(self):
+        """Сессии без соединения: сколько ждут, машины и накопленные сообщения"""
+        stats = dict(self.sessions.stats)
+        table = PrettyTable()
+        table.field_names = ["Client ID", "Без соединения, с", "Осталось, с", "Машин", "Накоплено, КБ", "Сообщений"]
+        now = time.monotonic()
+        deadlines = self.teardown.deadlines()
+        for client_id, connection in self.clients.items():
+            if isinstance(connection, DetachedConnection):
+                deadline = deadlines.get(client_id)
+                table.add_row([client_id, f"{now - connection.since:.1f}", f"{deadline - now:.1f}" if deadline else "-",
+                               len(self.client_vehicles.get(client_id, ())), f"{connection.queue.size / 1024:.1f}",
+                               len(connection.queue.items)])
+        print(f"\n🔁 Сессии (ожидание возобновления {self.sessions.grace_period:g} с): выдано {stats['issued']}, "
+              f"обрывов {stats['detached']}, возобновлено {stats['resumed']}, перехвачено у полуоткрытых соединений "
+              f"{stats['taken_over']}, отказов {stats['rejected']}, истекло {stats['expired']}, "
+              f"разорвано сервером {stats['evicted']}")
+        print(table)
 
     def show_client_info(self, client_id=None):
         """Выводит информацию о клиентах"""
@@ -319,24 +3380,75 @@ class CarlaServer:
         if client_id:
             if client_id in self.client_info:
                 print(f"\n💻 Информация о клиенте {client_id}:")
-                for key, value in self.client_info[client_id].items():
+                for key, value in self.client_display_info(client_id).items():
                     print(f"  {key}: {value}")
             else:
                 print(f"❌ Клиент {client_id} не найден!")
         else:
             print("\n💻 Информация обо всех клиентах:")
-            for cid, info in self.client_info.items():
+            for cid in self.client_info:
                 print(f"\n🔹 Клиент {cid}:")
-                for key, value in info.items():
+                for key, value in self.client_display_info(cid).items():
                     print(f"  {key}: {value}")
                 print("-" * 30)
 
 
 if __name__ == "__main__":
-    server = CarlaServer("0.0.0.0", 52399)
+    parser = argparse.ArgumentParser(description="Сервер параллельных клиентов CARLA")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=52399)
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded",
+                        help="threaded - поток на клиента, async - event loop с пулом RPC")
+    parser.add_argument("--rpc-workers", type=int, default=8, help="Размер пула для вызовов CARLA (async)")
+    parser.add_argument("--sync", action="store_true", help="Синхронный режим: сервер сам вызывает world.tick()")
+    parser.add_argument("--fixed-delta", type=float, default=0.05, help="Шаг симуляции в синхронном режиме, с")
+    parser.add_argument("--vehicle-quota", type=int, default=None, help="Максимум машин на клиента")
+    parser.add_argument("--spawn-budget", type=int, default=64, help="Машин за раунд допуска спавна на всех клиентов")
+    parser.add_argument("--cpu-limit", type=float, default=90.0, help="Загрузка CPU сервера, выше которой спавн приостанавливается, %%")
+    parser.add_argument("--frame-budget-ms", type=float, default=100.0,
+                        help="Интервал тика CARLA, выше которого спавн приостанавливается, мс")
+    parser.add_argument("--video-workers", type=int, default=4, help="Потоков для сжатия видео")
+    parser.add_argument("--record", action="store_true", help="Сразу начать запись телеметрии")
+    parser.add_argument("--recordings-dir", default="recordings", help="Каталог записей телеметрии")
+    parser.add_argument("--pool-size", type=int, default=0,
+                        help="Машин на шард в пуле припаркованных вместо уничтожения при отключении (0 - пул выключен)")
+    parser.add_argument("--log-rate", type=float, default=20.0, help="Строк журнала команд в секунду, остальные отбрасываются")
+    parser.add_argument("--trace", metavar="FILE", help="Сразу включить трассировку Chrome trace в FILE (пишется при выключении)")
+    parser.add_argument("--large-fleet", action="store_true",
+                        help="Режим большого парка: гибридная физика Traffic Manager, полная - только рядом с машинами в фокусе")
+    parser.add_argument("--hybrid-radius", type=float, default=70.0,
+                        help="Радиус полной физики вокруг машин с ручным управлением или камерой, м")
+    parser.add_argument("--no-respawn-dormant", action="store_true",
+                        help="Не возрождать уснувшие машины больших карт рядом с героем")
+    parser.add_argument("--session-grace", type=float, default=30.0,
+                        help="Сколько секунд сессия с оборванным соединением ждёт возобновления по токену (0 - не ждать)")
+    parser.add_argument("--carla", action="append", metavar="HOST:PORT[:TM_PORT]",
+                        help="Экземпляр CARLA (можно несколько, машины распределяются по загрузке), "
+                             "по умолчанию localhost:2000")
+    args = parser.parse_args()
+
+    server = CarlaServer(args.host, args.port, mode=args.mode, rpc_workers=args.rpc_workers,
+                         carla_endpoints=args.carla or ["localhost:2000"],
+                         admission_options={"client_quota": args.vehicle_quota, "round_budget": args.spawn_budget,
+                                            "cpu_limit": args.cpu_limit, "frame_budget": args.frame_budget_ms / 1000.0},
+                         video_workers=args.video_workers, recordings_dir=args.recordings_dir,
+                         pool_size=args.pool_size, log_rate=args.log_rate,
+                         fleet_options={"radius": args.hybrid_radius, "respawn_dormant": not args.no_respawn_dormant},
+                         session_grace=args.session_grace)
+    server.tick_coordinator.fixed_delta = args.fixed_delta
+    if args.large_fleet:
+        server.fleet.enable()
+    if args.sync:
+        server.tick_coordinator.enable()
+    if args.record:
+        server.recorder.start()
+    if args.trace:
+        server.toggle_trace(args.trace)
     # Запускаем сервер в отдельном потоке
     server_thread = threading.Thread(target=server.start, daemon=True)
     server_thread.start()
 
     # Запускаем меню управления сервером
     server.server_menu()
+    if server.tracer.enabled:
+        server.toggle_trace()
@@ -0,0 +1,144 @@
+"""Кольцевой буфер в разделяемой памяти для клиентов на одном хосте с сервером.
+
+Управление остаётся в сокете, а объёмная телеметрия (массивы состояний машин)
+публикуется в слоты кольца multiprocessing.shared_memory. Писатель один (сервер),
+читатель - клиент этого кольца. Каждый слот начинается с номера последовательности:
+нечётный - идёт запись, 2 * seq - слот seq опубликован. Читатель берёт последний
+номер из заголовка и получает массив NumPy прямо поверх разделяемой памяти - без
+копирования и системных вызовов; после обработки valid(seq) подтверждает, что
+писатель не успел перезаписать слот (иначе берётся следующий).
+
+Как и protocol.py, модуль копируется на машину клиента вместе с client .py.
+"""
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+MAGIC = 0x43524E4701  # "CRNG" + версия формата
+HEADER_WORDS = 4  # magic, слотов, размер слота, последний опубликованный номер
+SLOT_WORDS = 4  # номер (2 * seq, нечётный - запись), время публикации (monotonic_ns), вид, записей
+KIND_VEHICLES = 1
+
+# Состояние машины в кольце: выравненная структура, читается как np.recarray без копии
+VEHICLE_DTYPE = np.dtype([("id", "<i8"), ("x", "<f4"), ("y", "<f4"), ("speed", "<f4"), ("mode", "u1")], align=True)
+MODES = ["autopilot", "manual"]
+MODE_CODES = {mode: code for code, mode in enumerate(MODES)}
+
+
+class SharedRing:
+    """Общая разметка сегмента: заголовок и слоты (представления NumPy поверх shm.buf)"""
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.name = shm.name
+        self.header = np.ndarray(HEADER_WORDS, dtype="<u8", buffer=shm.buf)
+        self.slots = self.slot_size = 0
+        self.meta = self.payload = None
+        self.closed = False
+
+    def map_slots(self, slots, slot_size):
+        self.slots, self.slot_size = slots, slot_size
+        offset = HEADER_WORDS * 8
+        self.meta = [np.ndarray(SLOT_WORDS, dtype="<u8", buffer=self.shm.buf, offset=offset + i * slot_size)
+                     for i in range(slots)]
+        self.payload = [self.shm.buf[offset + i * slot_size + SLOT_WORDS * 8:offset + (i + 1) * slot_size]
+                        for i in range(slots)]
+
+    def capacity(self, dtype=VEHICLE_DTYPE):
+        """Сколько записей помещается в слот"""
+        return (self.slot_size - SLOT_WORDS * 8) // dtype.itemsize
+
+    def close(self):
+        # Представления держат буфер - без их удаления shm.close() падает с BufferError
+        self.header = self.meta = self.payload = None
+        self.closed = True
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # у читателя ещё живы массивы из latest(); отображение закроется вместе с ними
+
+
+class RingWriter(SharedRing):
+    """Создаёт сегмент и публикует в него массивы; удаляет сегмент при close()"""
+
+    def __init__(self, name=None, capacity=16384, slots=4, dtype=VEHICLE_DTYPE):
+        slot_size = SLOT_WORDS * 8 + capacity * dtype.itemsize
+        slot_size += -slot_size % 64  # слоты по границе кэш-линии
+        super().__init__(shared_memory.SharedMemory(name=name, create=True, size=HEADER_WORDS * 8 + slots * slot_size))
+        self.map_slots(slots, slot_size)
+        self.header[:] = (MAGIC, slots, slot_size, 0)
+        self.seq = 0
+
+    def publish(self, kind, array):
+        """Копирует array в следующий слот и публикует его; False - массив не помещается в слот"""
+        data = np.ascontiguousarray(array).view(np.uint8).reshape(-1)
+        if len(data) > self.slot_size - SLOT_WORDS * 8:
+            return False
+        seq = self.seq + 1
+        index = seq % self.slots
+        meta = self.meta[index]
+        meta[0] = 2 * seq - 1  # читатель, попавший на этот слот, увидит незавершённую запись
+        np.frombuffer(self.payload[index], dtype=np.uint8, count=len(data))[:] = data
+        meta[1:] = (time.monotonic_ns(), kind, len(array))
+        meta[0] = 2 * seq
+        self.header[3] = seq
+        self.seq = seq
+        return True
+
+    def close(self):
+        super().close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class RingReader(SharedRing):
+    """Подключается к сегменту сервера по имени; читает последний опубликованный слот"""
+
+    def __init__(self, name):
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            # До Python 3.13 подключение тоже регистрируется в resource_tracker, и тот удалил бы
+            # сегмент сервера при выходе клиента
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        except Exception:
+            pass
+        super().__init__(shm)
+        if int(self.header[0]) != MAGIC:
+            self.close()
+            raise ValueError(f"{name}: не кольцо телеметрии")
+        self.map_slots(int(self.header[1]), int(self.header[2]))
+        self.last_seq = 0
+        self.stats = {"read": 0, "skipped": 0, "retries": 0}
+
+    def published(self):
+        """Номер последнего опубликованного слота - одно чтение памяти"""
+        return int(self.header[3])
+
+    def latest(self, dtype=VEHICLE_DTYPE, attempts=4):
+        """(номер, время публикации в нс monotonic, вид, записи) нового слота или None.
+
+        Записи - представление поверх разделяемой памяти, действительное, пока valid(номер).
+        """
+        for _ in range(attempts):
+            seq = int(self.header[3])
+            if seq == self.last_seq:
+                return None
+            meta = self.meta[seq % self.slots]
+            if int(meta[0]) != 2 * seq:
+                self.stats["retries"] += 1  # писатель уже пишет в этот слот следующий номер
+                continue
+            published, kind, count = int(meta[1]), int(meta[2]), int(meta[3])
+            records = np.frombuffer(self.payload[seq % self.slots], dtype=dtype, count=count)
+            self.stats["skipped"] += max(0, seq - self.last_seq - 1)
+            self.stats["read"] += 1
+            self.last_seq = seq
+            return seq, published, kind, records
+        return None
+
+    def valid(self, seq):
+        """Слот seq не перезаписан с момента latest() - прочитанное не порвано"""
+        return int(self.meta[seq % self.slots][0]) == 2 * seq